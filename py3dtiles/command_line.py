@@ -3,6 +3,8 @@ import py3dtiles.convert as convert
 import py3dtiles.info as info
 import py3dtiles.merger as merger
 import py3dtiles.export as export
+import py3dtiles.plan as plan
+import py3dtiles.worker as worker
 import traceback
 
 
@@ -31,6 +33,8 @@ def main():
     info.init_parser(sub_parsers, str2bool)
     merger.init_parser(sub_parsers, str2bool)
     export.init_parser(sub_parsers, str2bool)
+    worker.init_parser(sub_parsers, str2bool)
+    plan.init_parser(sub_parsers, str2bool)
 
     args = parser.parse_args()
 
@@ -43,6 +47,10 @@ def main():
             merger.main(args)
         elif args.command == 'export':
             export.main(args)
+        elif args.command == 'worker':
+            worker.main(args)
+        elif args.command == 'plan':
+            plan.main(args)
         else:
             parser.print_help()
     except Exception:
@@ -5,3 +5,6 @@
 # in most cases this is useless, but sometimes it's useful, for instance when
 # calculating box sizes when all the points are coplanar
 MIN_POINT_SIZE = 0.00001
+
+# a leaf node is split when it contains this number of points
+MAX_LEAF_POINT_COUNT = 20000
@@ -1,5 +1,11 @@
 import argparse
+import asyncio
 import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import heapq
+import hmac
 import json
 import multiprocessing
 import os
@@ -7,32 +13,73 @@ import pickle
 import shutil
 import struct
 import sys
+import tempfile
+import threading
 import time
-from collections import namedtuple
+import traceback
+import uuid
+from collections import deque, namedtuple
 from pathlib import Path, PurePath
 
 import numpy as np
 import psutil
 import zmq
+from zmq.auth.thread import ThreadAuthenticator
+from zmq.utils import z85
 from pyproj import CRS, Transformer
 
 from py3dtiles import TileContentReader
 from py3dtiles.constants import MIN_POINT_SIZE
+from py3dtiles.points.checkpoint import WORKING_FOLDER, load_checkpoint, remove_checkpoints, restore_checkpoint, \
+    save_checkpoint
+from py3dtiles.points.decimation import DECIMATION_MODES
+from py3dtiles.points.header_cache import HeaderCache, default_header_cache_path
+from py3dtiles.points.host_budget import HostCpuBudget
+from py3dtiles.points.incremental import OCTREE_FOLDER, list_nodes, load_octree, nodes_to_rewrite, reusable_tiles, \
+    save_octree
+from py3dtiles.points.job_sizing import JobSizing, memory_limit
+from py3dtiles.points.metrics import Metrics
 from py3dtiles.points.node import Node
+from py3dtiles.points.progress import NodeProcessed, PntsWritten, PortionRead, Progress
+from py3dtiles.points.reprojection import GridTransformer
 from py3dtiles.points.shared_node_store import SharedNodeStore
+from py3dtiles.points.spool import SPOOL_FOLDER, Spool, SpoolFiles, task_point_count
 from py3dtiles.points.task import las_reader, xyz_reader, node_process, pnts_writer
+from py3dtiles.points.trace import Tracer
 from py3dtiles.points.transformations import rotation_matrix, angle_between_vectors, vector_product, inverse_matrix, \
     scale_matrix, translation_matrix
-from py3dtiles.points.utils import CommandType, ResponseType, compute_spacing, name_to_filename
-from py3dtiles.utils import SrsInMissingException
+from py3dtiles.points.utils import CommandType, NodeNameSet, ResponseType, compute_spacing, name_to_filename
+from py3dtiles.utils import JobFailedException, SrsInMissingException
 
 TOTAL_MEMORY_MB = int(psutil.virtual_memory().total / (1024 * 1024))
-IPC_URI = "ipc:///tmp/py3dtiles1"
+
+# the remote workers send a heartbeat every HEARTBEAT_INTERVAL seconds, and are considered dead
+# when the manager doesn't receive anything from them during HEARTBEAT_TIMEOUT seconds
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 60
+# the number of times a job is sent again after a failure, before the conversion is stopped
+MAX_JOB_RETRIES = 3
+# the last frame of a WRITE_PNTS job sent again, whose .pnts files may have been written by the failed attempts
+OVERWRITE_FRAME = b'overwrite'
+
+# the events of a socket whose connection was rejected by the authentication of the manager
+HANDSHAKE_FAILED_EVENTS = \
+    zmq.EVENT_HANDSHAKE_FAILED_NO_DETAIL | zmq.EVENT_HANDSHAKE_FAILED_PROTOCOL | zmq.EVENT_HANDSHAKE_FAILED_AUTH
+
+# the pointclouds up to this size are converted in the process of the manager by default
+IN_PROCESS_MAX_POINT_COUNT = 1_000_000
 
 OctreeMetadata = namedtuple('OctreeMetadata', ['aabb', 'spacing', 'scale'])
 
+# the name of the stages in the metrics, by job command
+JOB_STAGES = {
+    CommandType.READ_FILE.value: 'read',
+    CommandType.PROCESS_JOBS.value: 'process',
+    CommandType.WRITE_PNTS.value: 'write',
+}
 
-def write_tileset(out_folder, octree_metadata, offset, scale, rotation_matrix, include_rgb):
+
+def write_tileset(out_folder, octree_metadata, offset, scale, rotation_matrix, include_rgb, previous_tiles=None):
     # compute tile transform matrix
     if rotation_matrix is None:
         transform = np.identity(4)
@@ -62,10 +109,12 @@ def write_tileset(out_folder, octree_metadata, offset, scale, rotation_matrix, i
                 xyz.copy(),
                 rgb)
 
-    pnts_writer.node_to_pnts(''.encode('ascii'), root_node, out_folder, include_rgb)
+    # when a tileset is updated, the root tile is always written again
+    pnts_writer.node_to_pnts(''.encode('ascii'), root_node, out_folder, include_rgb, overwrite=previous_tiles is not None)
 
     executor = concurrent.futures.ProcessPoolExecutor()
-    root_tileset = Node.to_tileset(executor, ''.encode('ascii'), octree_metadata.aabb, octree_metadata.spacing, out_folder, scale)
+    root_tileset = Node.to_tileset(
+        executor, ''.encode('ascii'), octree_metadata.aabb, octree_metadata.spacing, out_folder, scale, previous_tiles)
     executor.shutdown()
 
     root_tileset['transform'] = transform.T.reshape(16).tolist()
@@ -87,6 +136,22 @@ def write_tileset(out_folder, octree_metadata, offset, scale, rotation_matrix, i
         f.write(json.dumps(tileset))
 
 
+def aabb_in_octree(aabb, transformer, offset, rotation_matrix, scale):
+    """
+    Returns the bounding box of the input aabb in the coordinates of the octree,
+    computed like the root aabb of a conversion.
+    """
+    corners = np.array(aabb, dtype=np.float64)
+    if transformer is not None:
+        corners = np.array(transformer.transform(corners[:, 0], corners[:, 1], corners[:, 2])).T
+    corners = corners - offset
+    if rotation_matrix is not None:
+        corners = np.dot(corners, rotation_matrix[:3, :3].T)
+    corners = corners * scale
+
+    return np.array([np.min(corners, axis=0), np.max(corners, axis=0)])
+
+
 def make_rotation_matrix(z1, z2):
     v0 = z1 / np.linalg.norm(z1)
     v1 = z2 / np.linalg.norm(z2)
@@ -96,37 +161,201 @@ def make_rotation_matrix(z1, z2):
         vector_product(v0, v1))
 
 
+def init_octree(infos, srs_in=None, srs_out=None):
+    """
+    Returns the geometry of the octree containing the pointclouds described by infos (see las_reader.init):
+    (transformer, offset, rotation_matrix, scale, original_aabb, octree_metadata).
+
+    :raises SrsInMissingException: if srs_out is set and the srs of the pointclouds isn't known
+    """
+    avg_min = infos['avg_min']
+    rotation_matrix = None
+    # srs stuff
+    transformer = None
+    if srs_out:
+        crs_out = CRS('epsg:{}'.format(srs_out))
+        if srs_in:
+            crs_in = CRS('epsg:{}'.format(srs_in))
+        elif not infos['srs_in']:
+            raise SrsInMissingException('No SRS information in the provided files')
+        else:
+            crs_in = CRS(infos['srs_in'])
+
+        transformer = Transformer.from_crs(crs_in, crs_out)
+
+        bl = np.array(list(transformer.transform(
+            infos['aabb'][0][0], infos['aabb'][0][1], infos['aabb'][0][2])))
+        tr = np.array(list(transformer.transform(
+            infos['aabb'][1][0], infos['aabb'][1][1], infos['aabb'][1][2])))
+        br = np.array(list(transformer.transform(
+            infos['aabb'][1][0], infos['aabb'][0][1], infos['aabb'][0][2])))
+
+        avg_min = np.array(list(transformer.transform(
+            avg_min[0], avg_min[1], avg_min[2])))
+
+        x_axis = br - bl
+
+        bl = bl - avg_min
+        tr = tr - avg_min
+
+        if srs_out == '4978':
+            # Transform geocentric normal => (0, 0, 1)
+            # and 4978-bbox x axis => (1, 0, 0),
+            # to have a bbox in local coordinates that's nicely aligned with the data
+            rotation_matrix = make_rotation_matrix(avg_min, np.array([0, 0, 1]))
+            rotation_matrix = np.dot(
+                make_rotation_matrix(x_axis, np.array([1, 0, 0])),
+                rotation_matrix)
+
+            bl = np.dot(bl, rotation_matrix[:3, :3].T)
+            tr = np.dot(tr, rotation_matrix[:3, :3].T)
+
+        root_aabb = np.array([
+            np.minimum(bl, tr),
+            np.maximum(bl, tr)
+        ])
+    else:
+        # offset
+        root_aabb = infos['aabb'] - avg_min
+
+    original_aabb = root_aabb
+
+    base_spacing = compute_spacing(root_aabb)
+    if base_spacing > 10:
+        root_scale = np.array([0.01, 0.01, 0.01])
+    elif base_spacing > 1:
+        root_scale = np.array([0.1, 0.1, 0.1])
+    else:
+        root_scale = np.array([1, 1, 1])
+
+    root_aabb = root_aabb * root_scale
+    root_spacing = compute_spacing(root_aabb)
+
+    octree_metadata = OctreeMetadata(aabb=root_aabb, spacing=root_spacing, scale=root_scale[0])
+
+    return transformer, avg_min, rotation_matrix, root_scale, original_aabb, octree_metadata
+
+
+def curve_key_pairs(secret):
+    """
+    Returns the CURVE key pairs (public key, secret key) of the manager and of the workers derived from
+    secret, the secret shared by the manager and the workers of a conversion.
+
+    Only the workers knowing the secret are accepted by the manager, and the workers only accept a manager
+    knowing it. The messages are encrypted.
+    """
+    if not zmq.has('curve'):
+        raise RuntimeError('libzmq is built without CURVE support, the workers can\'t be authenticated')
+    if isinstance(secret, str):
+        secret = secret.encode('utf-8')
+    key_pairs = []
+    for role in (b'manager', b'worker'):
+        secret_key = z85.encode(hmac.new(secret, role, hashlib.sha256).digest())
+        key_pairs.append((zmq.curve_public(secret_key), secret_key))
+    return key_pairs
+
+
+def read_secret(filename):
+    """
+    Returns the secret shared by the manager and the workers, read from filename.
+    """
+    with open(filename, 'rb') as f:
+        secret = f.read().strip()
+    if not secret:
+        raise ValueError(f'The secret file {filename} is empty')
+    return secret
+
+
+class _WorkerKeys:
+    """
+    The credentials provider of the authenticator of the manager, accepting the workers knowing the secret.
+    """
+    def __init__(self, public_key):
+        self.public_key = public_key
+
+    def callback(self, domain, key):
+        return hmac.compare_digest(key, self.public_key)
+
+
 # Worker
-def zmq_process(*args):
-    process = Worker(*args)
+def local_worker_id(pid):
+    """
+    Returns the zmq identity of the worker process pid started by the manager.
+    """
+    return f'local-{pid}'.encode('ascii')
+
+
+def zmq_process(uri, *args, laz_threads=None, secret=None):
+    if laz_threads is not None:
+        # the size of the thread pool decompressing the LAZ chunks (lazrs), read when it is created.
+        # It's only set in the worker processes, the environment of the caller of convert is unchanged.
+        os.environ['RAYON_NUM_THREADS'] = str(laz_threads)
+    process = Worker(uri, *args, secret=secret)
     process.run()
 
 
 class Worker:
     """
     This class waits from jobs commands from the Zmq socket.
+
+    A worker created without octree_metadata (e.g. with the worker command, on another host)
+    registers itself to the manager and receives the conversion parameters from it.
+
+    secret is the secret of the manager, if any (see curve_key_pairs).
     """
-    def __init__(self, activity_graph, transformer, octree_metadata, folder, write_rgb, verbosity):
-        self.activity_graph = activity_graph
+    def __init__(self, uri, transformer=None, octree_metadata=None, folder=None, write_rgb=True, verbosity=0,
+                 overwrite_pnts=False, trace=False, secret=None):
+        self.uri = uri
+        self.secret = secret
         self.transformer = transformer
         self.octree_metadata = octree_metadata
         self.folder = folder
         self.write_rgb = write_rgb
         self.verbosity = verbosity
+        self.overwrite_pnts = overwrite_pnts
+        self.trace = trace
+        self.tracer = None
+        # the points sent to the manager, see run
+        self.spool = None
 
         # Socket to receive messages on
-        self.context = zmq.Context()
-        self.skt = self.context.socket(zmq.DEALER)
+        self.context = None
+        self.skt = None
 
     def run(self):
-        self.skt.connect(IPC_URI)
+        self.context = zmq.Context()
+        self.skt = self.socket()
+        heartbeat = None
+        heartbeat_thread = None
+        if self.octree_metadata is not None:
+            # the manager follows its local workers with their pid
+            self.skt.setsockopt(zmq.IDENTITY, local_worker_id(os.getpid()))
+        else:
+            # the heartbeats give the identity of the worker
+            self.skt.setsockopt(zmq.IDENTITY, f'remote-{uuid.uuid4().hex}'.encode('ascii'))
+
+        if self.octree_metadata is None:
+            try:
+                if not self.register():
+                    return
+            except PermissionError:
+                self.context.destroy(linger=0)
+                raise
+            # the working directory of the manager isn't on this host, the points are sent in the messages
+            self.spool = Spool()
+            # the manager can't see if this process is alive
+            heartbeat = threading.Event()
+            heartbeat_thread = threading.Thread(target=self.send_heartbeats, args=(heartbeat,), daemon=True)
+            heartbeat_thread.start()
+        else:
+            self.skt.connect(self.uri)
+            self.spool = Spool(os.path.join(self.folder, WORKING_FOLDER, SPOOL_FOLDER))
+        if self.trace:
+            self.tracer = Tracer('worker')
 
         startup_time = time.time()
         idle_time = 0
 
-        if self.activity_graph:
-            activity = open('activity.{}.csv'.format(os.getpid()), 'w')
-
         # notify we're ready
         self.skt.send_multipart([ResponseType.IDLE.value])
 
@@ -139,37 +368,13 @@ class Worker:
 
             message = self.skt.recv_multipart()
             content = message[1:]
-            command = content[0]
 
             delta = time.time() - pickle.loads(message[0])
             if delta > 0.01 and self.verbosity >= 1:
                 print('{} / {} : Delta time: {}'.format(os.getpid(), round(after, 2), round(delta, 3)))
 
-            if command == CommandType.READ_FILE.value:
-                self.execute_read_file(content)
-                command_type = 1
-            elif command == CommandType.PROCESS_JOBS.value:
-                self.execute_process_jobs(content)
-                command_type = 2
-            elif command == CommandType.WRITE_PNTS.value:
-                self.execute_write_pnts(content)
-                command_type = 3
-            elif command == CommandType.SHUTDOWN.value:
+            if not self.execute(content):
                 break  # ack
-            else:
-                raise NotImplementedError(f'Unknown command {command}')
-
-            # notify we're idle
-            self.skt.send_multipart([ResponseType.IDLE.value])
-
-            if self.activity_graph:
-                print(f'{before}, {command_type}', file=activity)
-                print(f'{before}, 0', file=activity)
-                print(f'{after}, 0', file=activity)
-                print(f'{after}, {command_type}', file=activity)
-
-        if self.activity_graph:
-            activity.close()
 
         if self.verbosity >= 1:
             print('total: {} sec, idle: {}'.format(
@@ -177,32 +382,150 @@ class Worker:
                 round(idle_time, 1))
             )
 
+        if heartbeat is not None:
+            # the socket of the heartbeats must be closed by its thread before the context is terminated
+            heartbeat.set()
+            heartbeat_thread.join()
         self.skt.send_multipart([ResponseType.HALTED.value])
+        self.skt.close()
+        self.context.term()
+
+    def send_heartbeats(self, stop):
+        """
+        Send a heartbeat to the manager every HEARTBEAT_INTERVAL seconds, until stop is set.
+        """
+        # the sockets can't be shared between threads
+        skt = self.socket()
+        skt.connect(self.uri)
+        identity = self.skt.getsockopt(zmq.IDENTITY)
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            skt.send_multipart([ResponseType.HEARTBEAT.value, identity])
+        skt.close(linger=0)
+
+    def execute(self, content):
+        """
+        Run the job of the message content and notify the manager when it's finished.
+
+        Returns False if the job is the shutdown of the worker.
+        """
+        command = content[0]
+        if command == CommandType.SHUTDOWN.value:
+            return False
+        try:
+            if command == CommandType.READ_FILE.value:
+                self.execute_read_file(content)
+            elif command == CommandType.PROCESS_JOBS.value:
+                self.execute_process_jobs(content)
+            elif command == CommandType.WRITE_PNTS.value:
+                self.execute_write_pnts(content)
+            else:
+                raise NotImplementedError(f'Unknown command {command}')
+        except Exception:
+            # the manager sends the job again, the results sent before the error are discarded
+            error = traceback.format_exc()
+            print(error, file=sys.stderr)
+            self.skt.send_multipart([ResponseType.ERROR.value, error.encode('utf-8')])
+
+        if self.tracer is not None:
+            self.skt.send_multipart([ResponseType.TRACE.value, self.tracer.pop_events()])
+
+        # notify we're idle, with the spool file written by the job, if any
+        spool_filename = self.spool.close()
+        self.skt.send_multipart(
+            [ResponseType.IDLE.value] + ([spool_filename.encode('ascii')] if spool_filename else []))
+        return True
+
+    def socket(self):
+        """
+        Returns a new socket to connect to the manager, authenticated with the secret if any.
+        """
+        skt = self.context.socket(zmq.DEALER)
+        if self.secret is not None:
+            (manager_public_key, _), (public_key, secret_key) = curve_key_pairs(self.secret)
+            skt.curve_serverkey = manager_public_key
+            skt.curve_publickey = public_key
+            skt.curve_secretkey = secret_key
+        return skt
+
+    def register(self):
+        """
+        Connect to the manager and ask it for the conversion parameters.
+
+        Returns False if the manager is shutting down and doesn't need this worker.
+        Raises PermissionError if the manager rejects this worker (e.g. its secret isn't the one of the manager).
+        """
+        # the rejections of the manager are only reported by the events of the socket
+        monitor = self.skt.get_monitor_socket(HANDSHAKE_FAILED_EVENTS)
+        try:
+            self.skt.connect(self.uri)
+            self.skt.send_multipart([ResponseType.REGISTER.value])
+            poller = zmq.Poller()
+            poller.register(self.skt, zmq.POLLIN)
+            poller.register(monitor, zmq.POLLIN)
+            if self.skt not in dict(poller.poll()):
+                raise PermissionError(f'The manager {self.uri} rejected this worker, the secret must be the one '
+                                      'of the conversion')
+            message = self.skt.recv_multipart()
+        finally:
+            self.skt.disable_monitor()
+            monitor.close(linger=0)
+        command = message[1]
+
+        if command == CommandType.SHUTDOWN.value:
+            return False
+        if command != CommandType.CONFIGURE.value:
+            raise NotImplementedError(f'Unknown command {command}')
+
+        # the verbosity is the one of the worker command
+        self.transformer, self.octree_metadata, self.folder, self.write_rgb, _, self.overwrite_pnts, self.trace = \
+            pickle.loads(message[2])
+        return True
+
+    def span(self, name, category, **args):
+        """
+        Record a span of the job if the conversion is traced.
+        """
+        if self.tracer is None:
+            return contextlib.nullcontext(args)
+        return self.tracer.span(name, category, **args)
 
     def execute_read_file(self, content):
         parameters = pickle.loads(content[1])
+        filename, portion = parameters['filename'], parameters['portion']
 
-        ext = PurePath(parameters['filename']).suffix
-        init_reader_fn = las_reader.run if ext in ('.las', '.laz') else xyz_reader.run
-        init_reader_fn(
-            parameters['filename'],
-            parameters['offset_scale'],
-            parameters['portion'],
-            self.skt,
-            self.transformer,
-            self.verbosity
-        )
+        ext = PurePath(filename).suffix
+        if ext in ('.las', '.laz'):
+            init_reader_fn = functools.partial(las_reader.run, laz_threads=parameters['laz_threads'])
+        else:
+            init_reader_fn = xyz_reader.run
+        with self.span(os.path.basename(filename), 'read', portion=portion, point_count=portion[1] - portion[0]):
+            init_reader_fn(
+                filename,
+                parameters['offset_scale'],
+                parameters['portion'],
+                self.skt,
+                self.spool,
+                self.transformer,
+                self.verbosity,
+                parameters.get('decimation'),
+            )
 
     def execute_write_pnts(self, content):
-        pnts_writer.run(self.skt, content[2], content[1], self.folder, self.write_rgb)
+        with self.span('r' + content[1].decode('ascii'), 'write') as args:
+            overwrite = self.overwrite_pnts or content[3:4] == [OVERWRITE_FRAME]
+            args['point_count'] = pnts_writer.run(
+                self.skt, content[2], content[1], self.folder, self.write_rgb, overwrite)
 
     def execute_process_jobs(self, content):
-        node_process.run(
-            content[1:],
-            self.octree_metadata,
-            self.skt,
-            self.verbosity
-        )
+        with self.span('process_jobs', 'process'):
+            node_process.run(
+                content[1:],
+                self.octree_metadata,
+                self.skt,
+                self.spool,
+                self.verbosity,
+                self.tracer
+            )
 
 
 # Manager
@@ -211,50 +534,204 @@ class ZmqManager:
     This class sends messages to the workers.
     We can also request general status.
     """
-    def __init__(self, number_of_jobs: int, process_args: tuple):
+    def __init__(self, number_of_jobs: int, process_args: tuple, uri: str = None, secret=None):
         """
         For the process_args argument, see the init method of Worker
         to get the list of needed parameters.
+
+        uri is the endpoint the manager binds. With a tcp endpoint, workers started
+        on other hosts can join the conversion (see register_client).
+        By default, an ipc endpoint only used by this manager is created.
+
+        With a secret, only the workers knowing it can connect, and the messages are encrypted
+        (see curve_key_pairs).
         """
+        self._init_jobs(number_of_jobs, process_args)
         self.context = zmq.Context()
+        self.secret = secret
 
-        self.number_of_jobs = number_of_jobs
+        self.ipc_folder = None
+        if uri is None:
+            self.ipc_folder = tempfile.mkdtemp(prefix='py3dtiles-')
+            uri = f'ipc://{self.ipc_folder}/manager'
 
         self.socket = self.context.socket(zmq.ROUTER)
-        self.socket.bind(IPC_URI)
+        self.authenticator = None
+        if secret is not None:
+            (public_key, secret_key), (worker_public_key, _) = curve_key_pairs(secret)
+            self.authenticator = ThreadAuthenticator(self.context)
+            self.authenticator.start()
+            self.authenticator.configure_curve_callback(credentials_provider=_WorkerKeys(worker_public_key))
+            self.socket.curve_server = True
+            self.socket.curve_publickey = public_key
+            self.socket.curve_secretkey = secret_key
+        self.socket.bind(uri)
+        # the endpoint really bound, with the port resolved if a wildcard was used
+        self.uri = self.socket.getsockopt_string(zmq.LAST_ENDPOINT)
+        self.local_uri = self.uri.replace('0.0.0.0', '127.0.0.1')
+
+        # the cpus not used by the workers decompress the LAZ files
+        self.laz_threads = max(1, multiprocessing.cpu_count() // max(number_of_jobs, 1))
+        self.processes = [self._start_process() for _ in range(number_of_jobs)]
+        self.activities = [p.pid for p in self.processes]
 
-        self.processes = [
-            multiprocessing.Process(target=zmq_process, args=process_args)
-            for _ in range(number_of_jobs)
-        ]
-        [p.start() for p in self.processes]
+    def _start_process(self):
+        process = multiprocessing.Process(target=zmq_process, args=(self.local_uri,) + self.process_args,
+                                          kwargs={'laz_threads': self.laz_threads, 'secret': self.secret})
+        process.start()
+        return process
 
-        self.activities = [p.pid for p in self.processes]
+    def _init_jobs(self, number_of_jobs, process_args):
+        self.number_of_jobs = number_of_jobs
+        self.process_args = process_args
+        # the maximum number of local processes working at the same time, None for no limit
+        self.local_jobs_budget = None
+
+        self.processes = []
+        self.activities = []
         self.idle_clients = []
+        # the workers which joined the conversion with the worker command
+        self.remote_clients = set()
+        # the job sent to each busy client: (command, point count, time)
+        self.running_jobs = {}
+        # the inputs of the job of each busy client whose results aren't received yet, to send them again
+        # if the job fails (see send_to_process)
+        self.job_inputs = {}
+        # the last time a message was received from each remote client
+        self.last_seen = {}
+        # the remote clients which stopped after a shutdown, and the clients which stopped unexpectedly
+        self.halted_clients = set()
+        self.removed_clients = set()
+        self._last_health_check = time.time()
 
         self.killing_processes = False
         self.number_processes_killed = 0
         self.time_waiting_an_idle_process = 0
 
-    def send_to_process(self, message):
+    def send_to_process(self, message, point_count=0, inputs=None):
+        """
+        Send the job message to an idle client.
+
+        inputs are the inputs of the job (see State.requeue_job), queued again if the job fails.
+        """
         if not self.idle_clients:
             raise ValueError("idle_clients is empty")
-        self.socket.send_multipart([self.idle_clients.pop(), pickle.dumps(time.time())] + message)
+        client = self.idle_clients.pop()
+        now = time.time()
+        self.running_jobs[client] = (message[0], point_count, now)
+        self.job_inputs[client] = inputs
+        self._send(client, message, now)
 
     def send_to_all_process(self, message):
         if not self.idle_clients:
             raise ValueError("idle_clients is empty")
         for client in self.idle_clients:
-            self.socket.send_multipart([client, pickle.dumps(time.time())] + message)
+            self._send(client, message, time.time())
         self.idle_clients.clear()
 
+    def _send(self, client, message, now):
+        self.socket.send_multipart([client, pickle.dumps(now)] + message)
+
     def can_queue_more_jobs(self):
-        return len(self.idle_clients) != 0
+        if not self.idle_clients:
+            return False
+        if self.local_jobs_budget is None:
+            return True
+        remote_jobs = len(self.remote_clients)
+        return self.number_of_jobs - len(self.idle_clients) < self.local_jobs_budget + remote_jobs
+
+    def register_client(self, client_id):
+        """
+        Send the conversion parameters to a worker which joined the conversion.
+        """
+        if self.killing_processes:
+            self.shutdown_client(client_id)
+            return
+
+        self.number_of_jobs += 1
+        self.remote_clients.add(client_id)
+        self.last_seen[client_id] = time.time()
+        self._send(client_id, [CommandType.CONFIGURE.value, pickle.dumps(self.process_args)], time.time())
+
+    def shutdown_client(self, client_id):
+        self._send(client_id, [CommandType.SHUTDOWN.value], time.time())
+
+    def is_next_client_remote(self):
+        """
+        Returns True if the next job will be sent to a worker started on another host.
+        """
+        return self.idle_clients[-1] in self.remote_clients
 
     def add_idle_client(self, client_id):
+        """
+        Returns the job finished by the client as (command, point count, time it was sent),
+        or None if the client was idle.
+        """
         if client_id in self.idle_clients:
             raise ValueError(f"The client id {client_id} is already in idle_clients")
         self.idle_clients.append(client_id)
+        self.job_inputs.pop(client_id, None)
+        return self.running_jobs.pop(client_id, None)
+
+    def seen(self, client_id):
+        if client_id in self.remote_clients:
+            self.last_seen[client_id] = time.time()
+
+    def job_failed(self, client_id):
+        """
+        Returns the failed job of the client as (command, inputs not processed yet), or None if it had no job.
+        """
+        job = self.running_jobs.pop(client_id, None)
+        if job is None:
+            return None
+        return job[0], self.job_inputs.pop(client_id, None)
+
+    def dead_clients(self):
+        """
+        Returns the clients which stopped unexpectedly: the local processes which exited without being
+        shut down, and the remote clients without heartbeat. They are checked at most once per second.
+        """
+        now = time.time()
+        if now - self._last_health_check < 1:
+            return []
+        self._last_health_check = now
+
+        # the local processes only exit with 0 after a shutdown
+        dead = [local_worker_id(p.pid) for p in self.processes if p.exitcode not in (None, 0)]
+        dead += [
+            client_id for client_id in self.remote_clients
+            if client_id not in self.halted_clients and now - self.last_seen[client_id] > HEARTBEAT_TIMEOUT
+        ]
+        return dead
+
+    def remove_client(self, client_id):
+        """
+        Remove a client which stopped unexpectedly, and start a new process to replace it if it was a local one.
+
+        Returns its failed job, see job_failed.
+        """
+        job = self.job_failed(client_id)
+        self.removed_clients.add(client_id)
+        if client_id in self.idle_clients:
+            self.idle_clients.remove(client_id)
+
+        if client_id in self.remote_clients:
+            self.remote_clients.discard(client_id)
+            self.number_of_jobs -= 1
+            return job
+
+        index = next(i for i, p in enumerate(self.processes) if local_worker_id(p.pid) == client_id)
+        if self.killing_processes:
+            del self.processes[index]
+            self.number_of_jobs -= 1
+        else:
+            self.processes[index] = self._start_process()
+        self.activities = [p.pid for p in self.processes]
+        return job
+
+    def set_halted(self, client_id):
+        self.halted_clients.add(client_id)
+        self.number_processes_killed += 1
 
     def are_all_processes_idle(self):
         return len(self.idle_clients) == self.number_of_jobs
@@ -269,6 +746,64 @@ class ZmqManager:
     def terminate_all_processes(self):
         for p in self.processes:
             p.terminate()
+        for p in self.processes:
+            p.join()
+
+    def destroy(self):
+        if self.authenticator is not None:
+            self.authenticator.stop()
+        self.context.destroy()
+        if self.ipc_folder is not None:
+            shutil.rmtree(self.ipc_folder, ignore_errors=True)
+
+
+class _InProcessSocket:
+    """
+    The messages sent by the in-process worker to the manager, with the interface of the zmq sockets.
+    """
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.messages = deque()
+
+    def send_multipart(self, frames, **kwargs):
+        self.messages.append([self.client_id] + frames)
+
+    def poll(self, timeout=None, flags=zmq.POLLIN):
+        return zmq.POLLIN if self.messages else 0
+
+    def recv_multipart(self):
+        return self.messages.popleft()
+
+
+class InProcessManager(ZmqManager):
+    """
+    Run the jobs in the process of the manager, with a single worker called directly.
+
+    Starting the worker processes (and importing numba, pyproj... in each of them) takes longer than
+    converting a small pointcloud: the jobs are then run with function calls instead of messages,
+    and the points are passed in memory instead of in spool files.
+    """
+    CLIENT_ID = b'in-process'
+
+    def __init__(self, process_args: tuple):
+        self._init_jobs(1, process_args)
+        self.uri = None
+        self.socket = _InProcessSocket(self.CLIENT_ID)
+
+        self.worker = Worker(None, *process_args)
+        self.worker.skt = self.socket
+        self.worker.spool = Spool()
+        if self.worker.trace:
+            self.worker.tracer = Tracer('worker')
+        self.socket.send_multipart([ResponseType.IDLE.value])
+
+    def _send(self, client, message, now):
+        # the responses of the job are queued in the socket
+        if not self.worker.execute(message):
+            self.socket.send_multipart([ResponseType.HALTED.value])
+
+    def destroy(self):
+        pass
 
 
 def is_ancestor(node_name, ancestor):
@@ -280,10 +815,10 @@ def is_ancestor(node_name, ancestor):
 
 
 def is_ancestor_in_list(node_name, ancestors):
-    for ancestor in ancestors:
-        if not ancestor or is_ancestor(node_name, ancestor):
-            return True
-    return False
+    """
+    ancestors is a container of node names (a set or a dict), each ancestor of node_name is looked up in it.
+    """
+    return any(node_name[:i] in ancestors for i in range(len(node_name) + 1))
 
 
 def can_pnts_be_written(node_name, finished_node, input_nodes, active_nodes):
@@ -293,15 +828,69 @@ def can_pnts_be_written(node_name, finished_node, input_nodes, active_nodes):
         and not is_ancestor_in_list(node_name, input_nodes))
 
 
+def add_tasks_to_process(state, spool_files, tasks):
+    for node_name, task in tasks:
+        state.add_tasks_to_process(node_name, task, task_point_count(task))
+        spool_files.add(task)
+
+
+def requeue_failed_job(state, spool_files, job):
+    """
+    Queue again the inputs of a failed job (see ZmqManager.job_failed).
+
+    :raises JobFailedException: if these inputs failed more than MAX_JOB_RETRIES times
+    """
+    if job is None or job[1] is None:
+        # the results of the job were all received
+        return
+    command, inputs = job
+    if command == CommandType.PROCESS_JOBS.value:
+        for name in inputs:
+            spool_files.cancel(name)
+    if state.requeue_job(command, inputs) > MAX_JOB_RETRIES:
+        raise JobFailedException(f'The {JOB_STAGES[command]} job of {inputs} failed {MAX_JOB_RETRIES + 1} times')
+
+
+def update_metrics(metrics, state, node_store, zmq_manager, job_sizing):
+    """
+    Update the metrics with the current state of the conversion.
+    """
+    for queue, size in [
+        ('portions', len(state.point_cloud_file_parts)),
+        ('node_to_process', len(state.node_to_process)),
+        ('processing_nodes', len(state.processing_nodes)),
+        ('waiting_writing_nodes', len(state.waiting_writing_nodes)),
+        ('pnts_to_writing', len(state.pnts_to_writing)),
+    ]:
+        metrics.set_gauge('queue_size', size, queue=queue)
+
+    metrics.set_gauge('points', state.points_in_progress, state='in_progress')
+    metrics.set_counter('points_total', state.processed_points, state='processed')
+    metrics.set_counter('points_total', state.points_in_pnts, state='written')
+
+    for stat in ['hit', 'miss', 'new']:
+        metrics.set_counter('node_store_requests_total', node_store.stats[stat], result=stat)
+    metrics.set_counter('node_store_spilled_bytes_total', node_store.stats['spilled_bytes'])
+
+    metrics.set_gauge('workers', zmq_manager.number_of_jobs - len(zmq_manager.idle_clients), state='busy')
+    metrics.set_gauge('workers', len(zmq_manager.idle_clients), state='idle')
+    metrics.set_counter('idle_process_wait_seconds_total', zmq_manager.time_waiting_an_idle_process)
+    metrics.set_gauge('memory_bytes', job_sizing.memory)
+
+
 class State:
-    def __init__(self, pointcloud_file_portions, max_reading_jobs: int):
+    def __init__(self, pointcloud_file_portions, max_reading_jobs: int, laz_chunks=None):
         self.processed_points = 0
         self.max_point_in_progress = 60_000_000
         self.points_in_progress = 0
         self.points_in_pnts = 0
+        # the points kept by the readers (all of them, unless they are decimated)
+        self.read_points = 0
 
         # pointcloud_file_portions is a list of tuple (filename, (start offset, end offset))
         self.point_cloud_file_parts = pointcloud_file_portions
+        # the chunks of the LAZ files, see las_reader.init
+        self.laz_chunks = laz_chunks or {}
         self.max_reading_jobs = max_reading_jobs
         self.number_of_reading_jobs = 0
         self.number_of_writing_jobs = 0
@@ -312,6 +901,10 @@ class State:
         # a task is a tuple (list of points, point_count)
         # points is a dictionary {xyz: list of coordinates, color: the associated color}
         self.node_to_process = {}
+        # the nodes of node_to_process ordered by depth, then by decreasing point count.
+        # Each entry is (depth, -point_count, name), the entries whose point count is outdated
+        # (because tasks were added to the node afterwards) are skipped when they are popped
+        self.node_queue = []
         # when a node is sent to a process, the item moves to processing_nodes
         # the structure is different. The key remains the node name. But the value is : (len(tasks), point_count, now)
         # these values is for loging
@@ -319,15 +912,38 @@ class State:
         # when processing is finished, move the tile name in processed_nodes
         # since the content is at this stage, stored in the node_store,
         # just keep the name of the node.
-        # This list will be filled until the writing could be started.
-        self.waiting_writing_nodes = []
+        # This set will be filled until the writing could be started.
+        self.waiting_writing_nodes = NodeNameSet()
         # when the node is writing, its name is moved from waiting_writing_nodes to pnts_to_writing
         # the data to write are stored in a node object.
         self.pnts_to_writing = []
+        # the number of points of the written nodes, by name
+        # (in an incremental conversion, the nodes are written several times)
+        self.pnts_point_counts = {}
+        # the number of failed jobs, by input (see requeue_job)
+        self.job_failures = {}
 
     def is_reading_finish(self):
         return not self.point_cloud_file_parts and self.number_of_reading_jobs == 0
 
+    def pop_portion(self, max_point_count):
+        """
+        Remove the next portion to read from point_cloud_file_parts and return it as (filename, portion).
+        The portion is split if it contains more than max_point_count points.
+        """
+        filename, portion = self.point_cloud_file_parts.pop()
+        # the portions of xyz files start at an offset in the file known only for the initial portions
+        if len(portion) == 2 and portion[1] - portion[0] > max_point_count:
+            split = portion[0] + max_point_count
+            if filename in self.laz_chunks:
+                # the LAZ portions start at the beginning of a chunk, so it's decompressed only once
+                start, end = las_reader.laz_chunk_bounds(self.laz_chunks[filename], split)
+                split = start if start > portion[0] else (end or portion[1])
+            if split < portion[1]:
+                self.point_cloud_file_parts.append((filename, (split, portion[1])))
+                portion = (portion[0], split)
+        return filename, portion
+
     def add_tasks_to_process(self, node_name, task, point_count):
         if point_count <= 0:
             raise ValueError("point_count should be strictly positive, currently", point_count)
@@ -337,7 +953,80 @@ class State:
         else:
             tasks, count = self.node_to_process[node_name]
             tasks.append(task)
-            self.node_to_process[node_name] = (tasks, count + point_count)
+            point_count += count
+            self.node_to_process[node_name] = (tasks, point_count)
+
+        # a node being processed is queued again when its processing is finished
+        if node_name not in self.processing_nodes:
+            self._queue_node(node_name, point_count)
+
+    def _queue_node(self, node_name, point_count):
+        # drop the outdated entries when they are the majority of the queue
+        if len(self.node_queue) > 2 * len(self.node_to_process) + 1024:
+            self.node_queue = [
+                (len(name), -count, name)
+                for name, (_, count) in self.node_to_process.items()
+                if name not in self.processing_nodes
+            ]
+            heapq.heapify(self.node_queue)
+        else:
+            heapq.heappush(self.node_queue, (len(node_name), -point_count, node_name))
+
+    def pop_node_to_process(self):
+        """
+        Remove the next node to process from node_to_process and return (name, tasks, point_count),
+        or None if there isn't any node which can be processed now.
+
+        The shallowest nodes are processed first (their points are then sent to their children),
+        and the nodes with the most points first at the same depth.
+        """
+        while self.node_queue:
+            _, negative_count, name = heapq.heappop(self.node_queue)
+            # a key (=task) can be in node_to_process and processing_nodes if the node isn't completely processed
+            if name in self.processing_nodes or name not in self.node_to_process:
+                continue
+            tasks, point_count = self.node_to_process[name]
+            if point_count != -negative_count:
+                continue
+            del self.node_to_process[name]
+            return name, tasks, point_count
+        return None
+
+    def set_node_processed(self, node_name):
+        del self.processing_nodes[node_name]
+        if node_name in self.node_to_process:
+            self._queue_node(node_name, self.node_to_process[node_name][1])
+
+    def requeue_job(self, command, inputs):
+        """
+        Queue again the inputs of a job which failed. The inputs are:
+        - for READ_FILE, the (filename, portion) read
+        - for PROCESS_JOBS, the tasks of the nodes not processed yet, by node name
+        - for WRITE_PNTS, the name of the node written
+
+        Returns the highest number of failures of these inputs.
+        """
+        if command == CommandType.READ_FILE.value:
+            keys = [inputs]
+            self.point_cloud_file_parts.append(inputs)
+            self.number_of_reading_jobs -= 1
+            self.points_in_progress -= inputs[1][1] - inputs[1][0]
+        elif command == CommandType.PROCESS_JOBS.value:
+            keys = list(inputs)
+            for name, tasks in inputs.items():
+                del self.processing_nodes[name]
+                for task in tasks:
+                    self.add_tasks_to_process(name, task, task_point_count(task))
+        else:
+            keys = [inputs]
+            self.pnts_to_writing.append(inputs)
+            self.number_of_writing_jobs -= 1
+
+        failures = 0
+        for key in keys:
+            self.job_failures[command, key] = self.job_failures.get((command, key), 0) + 1
+            failures = max(failures, self.job_failures[command, key])
+        return failures
 
     def can_add_reading_jobs(self):
         return (
@@ -365,19 +1054,43 @@ class State:
             ''))
 
 
+def files_extension(files):
+    """
+    Returns the extension of the input files, which must all have the same.
+    """
+    extensions = set()
+    for file in files:
+        extensions.add(PurePath(file).suffix)
+    if len(extensions) != 1:
+        raise ValueError("All files should have the same extension, currently there are", extensions)
+    return extensions.pop()
+
+
 def convert(files,
             outfolder='./3dtiles',
             overwrite=False,
-            jobs=multiprocessing.cpu_count(),
+            jobs=None,
             cache_size=int(TOTAL_MEMORY_MB / 10),
             srs_out=None,
             srs_in=None,
             fraction=100,
+            decimation='random',
             benchmark=None,
             rgb=True,
-            graph=False,
+            metrics_file=None,
+            trace_file=None,
+            progress_callback=None,
             color_scale=None,
-            verbose=False):
+            verbose=False,
+            max_memory=None,
+            bind_uri=None,
+            secret=None,
+            checkpoint_interval=600,
+            resume=False,
+            incremental=False,
+            header_cache_file=None,
+            header_sidecar=False,
+            reprojection_max_error=None):
     """convert
 
     Convert pointclouds (xyz, las or laz) to 3dtiles tileset containing pnts node
@@ -388,7 +1101,9 @@ def convert(files,
     :type outfolder: path-like object
     :param overwrite: Overwrite the ouput folder if it already exists.
     :type overwrite: bool
-    :param jobs: The number of parallel jobs to start. Default to the number of cpu.
+    :param jobs: The number of parallel jobs to start. Default to the number of cpu, shared
+        between the conversions running at the same time on the host. With 0 (the default for the pointclouds
+        of less than IN_PROCESS_MAX_POINT_COUNT points), the jobs are run in the current process.
     :type jobs: int
     :param cache_size: Cache size in MB. Default to available memory / 10.
     :type cache_size: int
@@ -398,14 +1113,58 @@ def convert(files,
     :type srs_in: int or str
     :param fraction: Percentage of the pointcloud to process, between 0 and 100.
     :type fraction: int
+    :param decimation: How the points are chosen when fraction is below 100: 'random', 'stride' (a point
+        every 100 / fraction points) or 'voxel' (spread evenly in space), see py3dtiles.points.decimation.
+    :type decimation: str
     :param benchmark: Print summary at the end of the process
     :type benchmark: str
     :param rgb: Export rgb attributes.
     :type rgb: bool
-    :param graph: Produce debug graphes (requires pygal).
-    :type graph: bool
+    :param metrics_file: Export the metrics of the conversion (queue sizes, job durations...) in this file
+        while it runs, in the Prometheus text format if the filename ends with .prom, as JSON lines otherwise.
+    :type metrics_file: str
+    :param trace_file: Write the timeline of the jobs run by the workers in this file, in the Chrome trace
+        event format (to open in Perfetto or chrome://tracing).
+    :type trace_file: str
+    :param progress_callback: Called with the progress events of the conversion (see py3dtiles.points.progress)
+        while it runs, in the thread running the conversion.
+    :type progress_callback: callable
     :param color_scale: Force color scale
     :type color_scale: float
+    :param max_memory: The memory in MB the manager and its local workers can use. The jobs are throttled
+        to stay below this limit. Default to the memory of the host, or of the container if it's limited.
+    :type max_memory: int
+    :param bind_uri: The zmq endpoint the workers connect to. Default to an ipc endpoint dedicated to this run.
+        Use a tcp endpoint (e.g. tcp://*:5555) to let workers started on other hosts with the worker command
+        join the conversion. The outfolder and the files must then be available on these hosts with the same
+        paths. The endpoint must only be reachable from trusted hosts.
+    :type bind_uri: str
+    :param secret: The secret shared with the workers, required if bind_uri isn't an ipc endpoint. Only the
+        workers knowing it can join the conversion, and the messages are encrypted (with ZMQ CURVE).
+    :type secret: str or bytes
+    :param checkpoint_interval: Save the progress of the conversion every checkpoint_interval seconds, None or 0 to disable.
+    :type checkpoint_interval: float
+    :param resume: Continue the conversion from the last checkpoint saved in outfolder, if any.
+        The other parameters must be the ones of the interrupted conversion.
+    :type resume: bool
+    :param incremental: Keep the octree in outfolder to be able to add points to the tileset later.
+        If outfolder already contains such a tileset, the points of files are added to it and only the
+        modified tiles are written again. The points must be inside the bounding box of the tileset,
+        and its srs and rgb parameters are used.
+    :type incremental: bool
+    :param header_cache_file: The file caching the headers read from the input files (keyed by their path,
+        size and modification time), so that the next conversions of the same files don't read them again,
+        e.g. py3dtiles.points.header_cache.default_header_cache_path() (the default of the command line).
+        None to disable it. The entries are also read from the sidecars of the input files
+        (<file>.py3dtiles.json) if there are some.
+    :type header_cache_file: str
+    :param header_sidecar: Also write the headers read in the sidecar of each input file, so that the
+        conversions on other hosts or with another header cache don't read them again.
+    :type header_sidecar: bool
+    :param reprojection_max_error: If set, the points are reprojected to srs_out by interpolating the exact
+        transformation of the nodes of a grid, when the error of the grid is below this distance (in the
+        units of srs_out). None to transform each point exactly.
+    :type reprojection_max_error: float
 
     :raises SrsInMissingException: if py3dtiles couldn't find srs informations in input files and srs_in is not specified
     """
@@ -414,95 +1173,93 @@ def convert(files,
     files = [files] if isinstance(files, str) else files
 
     # read all input files headers and determine the aabb/spacing
-    extensions = set()
-    for file in files:
-        extensions.add(PurePath(file).suffix)
-    if len(extensions) != 1:
-        raise ValueError("All files should have the same extension, currently there are", extensions)
-    extension = extensions.pop()
-
-    init_reader_fn = las_reader.init if extension in ('.las', '.laz') else xyz_reader.init
-    infos = init_reader_fn(files, color_scale=color_scale, srs_in=srs_in, srs_out=srs_out)
-
-    avg_min = infos['avg_min']
-    rotation_matrix = None
-    # srs stuff
-    transformer = None
-    if srs_out:
-        crs_out = CRS('epsg:{}'.format(srs_out))
-        if srs_in:
-            crs_in = CRS('epsg:{}'.format(srs_in))
-        elif not infos['srs_in']:
-            raise SrsInMissingException('No SRS information in the provided files')
-        else:
-            crs_in = CRS(infos['srs_in'])
-
-        transformer = Transformer.from_crs(crs_in, crs_out)
-
-        bl = np.array(list(transformer.transform(
-            infos['aabb'][0][0], infos['aabb'][0][1], infos['aabb'][0][2])))
-        tr = np.array(list(transformer.transform(
-            infos['aabb'][1][0], infos['aabb'][1][1], infos['aabb'][1][2])))
-        br = np.array(list(transformer.transform(
-            infos['aabb'][1][0], infos['aabb'][0][1], infos['aabb'][0][2])))
-
-        avg_min = np.array(list(transformer.transform(
-            avg_min[0], avg_min[1], avg_min[2])))
-
-        x_axis = br - bl
-
-        bl = bl - avg_min
-        tr = tr - avg_min
-
-        if srs_out == '4978':
-            # Transform geocentric normal => (0, 0, 1)
-            # and 4978-bbox x axis => (1, 0, 0),
-            # to have a bbox in local coordinates that's nicely aligned with the data
-            rotation_matrix = make_rotation_matrix(avg_min, np.array([0, 0, 1]))
-            rotation_matrix = np.dot(
-                make_rotation_matrix(x_axis, np.array([1, 0, 0])),
-                rotation_matrix)
-
-            bl = np.dot(bl, rotation_matrix[:3, :3].T)
-            tr = np.dot(tr, rotation_matrix[:3, :3].T)
-
-        root_aabb = np.array([
-            np.minimum(bl, tr),
-            np.maximum(bl, tr)
-        ])
-    else:
-        # offset
-        root_aabb = infos['aabb'] - avg_min
-
-    original_aabb = root_aabb
+    extension = files_extension(files)
+
+    if not 0 < fraction <= 100:
+        raise ValueError(f'fraction should be between 0 and 100, currently {fraction}')
+    if decimation not in DECIMATION_MODES:
+        raise ValueError(f'Unknown decimation mode {decimation}, it should be one of {DECIMATION_MODES}')
+    if reprojection_max_error is not None and reprojection_max_error <= 0:
+        raise ValueError(f'reprojection_max_error should be positive, currently {reprojection_max_error}')
+    if bind_uri is not None and not bind_uri.startswith('ipc://') and not secret:
+        # the workers run the jobs they receive, anyone able to connect could run code on them
+        raise ValueError(f'A secret is required to authenticate the workers connecting to {bind_uri}')
+
+    # the parameters which must not change when a conversion is resumed
+    parameters = {
+        'files': files,
+        'srs_out': srs_out,
+        'srs_in': srs_in,
+        'fraction': fraction,
+        'decimation': decimation,
+        'reprojection_max_error': reprojection_max_error,
+        'rgb': rgb,
+        'color_scale': color_scale,
+        'incremental': incremental,
+    }
 
-    base_spacing = compute_spacing(root_aabb)
-    if base_spacing > 10:
-        root_scale = np.array([0.01, 0.01, 0.01])
-    elif base_spacing > 1:
-        root_scale = np.array([0.1, 0.1, 0.1])
+    checkpoint = load_checkpoint(outfolder) if resume else None
+    if checkpoint is not None:
+        if checkpoint['parameters'] != parameters:
+            raise ValueError('The parameters differ from the ones of the conversion to resume: '
+                             f"{checkpoint['parameters']}")
+        # the input files don't need to be read again
+        infos = checkpoint['infos']
     else:
-        root_scale = np.array([1, 1, 1])
-
-    root_aabb = root_aabb * root_scale
-    root_spacing = compute_spacing(root_aabb)
-
-    octree_metadata = OctreeMetadata(aabb=root_aabb, spacing=root_spacing, scale=root_scale[0])
+        init_reader_fn = las_reader.init if extension in ('.las', '.laz') else xyz_reader.init
+        infos = init_reader_fn(files, color_scale=color_scale, srs_in=srs_in, srs_out=srs_out, fraction=fraction,
+                               header_cache=HeaderCache(header_cache_file or None, sidecar=header_sidecar))
+
+    transformer, avg_min, rotation_matrix, root_scale, original_aabb, octree_metadata = init_octree(
+        infos, srs_in, srs_out)
+    root_aabb = octree_metadata.aabb
+    root_spacing = octree_metadata.spacing
+
+    octree = load_octree(outfolder) if incremental else None
+    if octree is not None:
+        # the points are inserted in the octree of the existing tileset
+        octree_metadata = octree['octree_metadata']
+        avg_min = octree['offset']
+        root_scale = octree['scale']
+        rotation_matrix = octree['rotation_matrix']
+        transformer = octree['transformer']
+        rgb = octree['rgb']
+
+        aabb = aabb_in_octree(infos['aabb'], transformer, avg_min, rotation_matrix, root_scale)
+        tolerance = MIN_POINT_SIZE + 1e-6 * np.linalg.norm(octree_metadata.aabb[1] - octree_metadata.aabb[0])
+        if np.any(aabb[0] < octree_metadata.aabb[0] - tolerance) or np.any(aabb[1] > octree_metadata.aabb[1] + tolerance):
+            raise ValueError('The points are outside of the bounding box of the tileset, '
+                             'it must be converted again with all the files.')
+        root_aabb = octree_metadata.aabb
+        root_spacing = octree_metadata.spacing
 
     # create folder
     out_folder_path = Path(outfolder)
-    if out_folder_path.is_dir():
-        if overwrite:
-            shutil.rmtree(out_folder_path, ignore_errors=True)
-        else:
-            print(f"Error, folder '{outfolder}' already exists")
-            sys.exit(1)
+    working_dir = out_folder_path / WORKING_FOLDER
+    if checkpoint is not None:
+        restore_checkpoint(out_folder_path, working_dir, checkpoint)
+    elif octree is not None:
+        shutil.rmtree(working_dir, ignore_errors=True)
+        working_dir.mkdir()
+    else:
+        if out_folder_path.is_dir():
+            if overwrite:
+                shutil.rmtree(out_folder_path, ignore_errors=True)
+            elif resume:
+                print(f"Error, no checkpoint was found in the folder '{outfolder}' to resume the conversion, "
+                      "use --overwrite to start it again")
+                sys.exit(1)
+            else:
+                print(f"Error, folder '{outfolder}' already exists")
+                sys.exit(1)
 
-    out_folder_path.mkdir()
-    working_dir = out_folder_path / "tmp"
-    working_dir.mkdir(parents=True)
+        out_folder_path.mkdir()
+        working_dir.mkdir(parents=True)
 
-    node_store = SharedNodeStore(str(working_dir))
+    # the nodes of an existing tileset are read from its octree
+    node_store = SharedNodeStore(str(working_dir), str(out_folder_path / OCTREE_FOLDER) if octree is not None else None)
+    # the nodes written by this conversion, moved to the octree at the end
+    octree_staging_dir = working_dir / OCTREE_FOLDER
 
     if verbose >= 1:
         print('Summary:')
@@ -517,260 +1274,410 @@ def convert(files,
 
     initial_portion_count = len(infos['portions'])
 
-    if graph:
-        progression_log = open('progression.csv', 'w')
-
-    state = State(infos['portions'], max(1, jobs // 2))
+    metrics = Metrics(metrics_file)
+    tracer = Tracer('manager') if trace_file is not None else None
+
+    # the small pointclouds are converted faster without starting the worker processes
+    in_process = jobs == 0 or (
+        jobs is None and bind_uri is None and infos['point_count'] <= IN_PROCESS_MAX_POINT_COUNT)
+    # a run without worker processes doesn't take a share of the cpus of the host
+    cpu_budget = HostCpuBudget() if not in_process else None
+    share_cpus = jobs is None and not in_process
+    if in_process:
+        jobs = 1
+    elif share_cpus:
+        jobs = cpu_budget.share()
+    # the cpus not used by the workers decompress the LAZ files
+    laz_threads = max(1, multiprocessing.cpu_count() // jobs)
+
+    if checkpoint is not None:
+        state = checkpoint['state']
+        state.max_reading_jobs = max(1, jobs // 2)
+    else:
+        state = State(infos['portions'], max(1, jobs // 2), infos.get('laz_chunks'))
+        if octree is not None:
+            state.pnts_point_counts = octree['pnts_point_counts']
+    # the points read and not processed yet, in the spool files of the workers
+    spool = Spool(str(working_dir / SPOOL_FOLDER))
+    spool_files = SpoolFiles(spool.folder)
+    if checkpoint is not None:
+        spool_files.restore(state.node_to_process)
+    # the tasks sent by each busy client, added when its job succeeds
+    pending_tasks = {}
+    # the jobs in progress must be finished before saving a checkpoint
+    draining = False
+    last_checkpoint = time.time()
 
     # zmq setup
-    zmq_manager = ZmqManager(jobs, (graph, transformer, octree_metadata, outfolder, rgb, verbose))
-
-    while not zmq_manager.are_all_processes_killed():
-        now = time.time() - startup
-        at_least_one_job_ended = False
-
-        all_processes_busy = not zmq_manager.can_queue_more_jobs()
-        while all_processes_busy or zmq_manager.socket.poll(timeout=0, flags=zmq.POLLIN):
-            # Blocking read but it's fine because either all our child processes are busy
-            # or we know that there's something to read (zmq.POLLIN)
-            start = time.time()
-            message = zmq_manager.socket.recv_multipart()
-
-            client_id = message[0]
-            result = message[1:]
-            return_type = result[0]
-
-            if return_type == ResponseType.IDLE.value:
-                zmq_manager.add_idle_client(client_id)
-
-                if all_processes_busy:
+    reader_transformer = transformer
+    if transformer is not None and reprojection_max_error is not None:
+        reader_transformer = GridTransformer(transformer, reprojection_max_error)
+    process_args = (reader_transformer, octree_metadata, outfolder, rgb, verbose, octree is not None, trace_file is not None)
+    if in_process:
+        zmq_manager = InProcessManager(process_args)
+    else:
+        zmq_manager = ZmqManager(jobs, process_args, bind_uri, secret)
+    try:
+        if max_memory is not None:
+            # the cache of the nodes must fit in the memory budget too
+            cache_size = min(cache_size, max_memory // 4)
+        job_sizing = JobSizing(
+            jobs, infos['point_count'], memory_limit() if max_memory is None else max_memory * 1024 * 1024)
+
+        while not zmq_manager.are_all_processes_killed():
+            now = time.time() - startup
+            if share_cpus:
+                # other conversions may have started or ended on this host since the last iteration
+                zmq_manager.local_jobs_budget = cpu_budget.share()
+            if checkpoint_interval and time.time() - last_checkpoint > checkpoint_interval:
+                draining = True
+            at_least_one_job_ended = False
+
+            if (job_sizing.sample_memory([os.getpid()] + zmq_manager.activities, state.points_in_progress)
+                    and job_sizing.is_memory_exhausted()):
+                # release the memory used by the cache of the nodes, they are read from the disk when needed
+                node_store.remove_oldest_nodes(1)
+            state.max_point_in_progress = job_sizing.max_point_in_progress
+
+            all_processes_busy = not zmq_manager.can_queue_more_jobs()
+            while all_processes_busy or zmq_manager.socket.poll(timeout=0, flags=zmq.POLLIN):
+                # Blocking read but it's fine because either all our child processes are busy
+                # or we know that there's something to read (zmq.POLLIN).
+                # The wait is limited to check that the busy processes are still alive.
+                start = time.time()
+                if all_processes_busy and not zmq_manager.socket.poll(timeout=1000, flags=zmq.POLLIN):
                     zmq_manager.time_waiting_an_idle_process += time.time() - start
-                all_processes_busy = False
-
-            elif return_type == ResponseType.HALTED.value:
-                zmq_manager.number_processes_killed += 1
-                all_processes_busy = False
-
-            elif return_type == ResponseType.READ.value:
-                state.number_of_reading_jobs -= 1
-                at_least_one_job_ended = True
-
-            elif return_type == ResponseType.PROCESSED.value:
-                content = pickle.loads(result[-1])
-                state.processed_points += content['total']
-                state.points_in_progress -= content['total']
-
-                del state.processing_nodes[content['name']]
-
-                if content['name']:
-                    node_store.put(content['name'], content['save'])
-                    state.waiting_writing_nodes.append(content['name'])
-
-                    if state.is_reading_finish():
-                        # if all nodes aren't processed yet,
-                        # we should check if linked ancestors are processed
-                        if state.processing_nodes or state.node_to_process:
-                            finished_node = content['name']
-                            if can_pnts_be_written(
-                                finished_node, finished_node,
-                                state.node_to_process, state.processing_nodes
-                            ):
-                                state.waiting_writing_nodes.pop(-1)
-                                state.pnts_to_writing.append(finished_node)
-
-                                for i in range(len(state.waiting_writing_nodes) - 1, -1, -1):
-                                    candidate = state.waiting_writing_nodes[i]
-
-                                    if can_pnts_be_written(
-                                        candidate, finished_node,
-                                        state.node_to_process, state.processing_nodes
-                                    ):
-                                        state.waiting_writing_nodes.pop(i)
+                    break
+                message = zmq_manager.socket.recv_multipart()
+
+                client_id = message[0]
+                result = message[1:]
+                return_type = result[0]
+
+                if client_id in zmq_manager.removed_clients:
+                    # the job of this client was sent to another one
+                    if return_type == ResponseType.IDLE.value:
+                        zmq_manager.shutdown_client(client_id)
+                    continue
+                zmq_manager.seen(client_id)
+
+                if return_type == ResponseType.REGISTER.value:
+                    zmq_manager.register_client(client_id)
+
+                elif return_type == ResponseType.IDLE.value:
+                    job = zmq_manager.add_idle_client(client_id)
+                    if len(result) > 1:
+                        spool_files.close(result[1].decode('ascii'))
+                    if job is not None:
+                        command, point_count, sent_time = job
+                        job_sizing.job_finished(command, point_count, time.time() - sent_time)
+                        metrics.observe('job_duration_seconds', time.time() - sent_time, stage=JOB_STAGES[command])
+
+                    if all_processes_busy:
+                        zmq_manager.time_waiting_an_idle_process += time.time() - start
+                    all_processes_busy = False
+
+                elif return_type == ResponseType.TRACE.value:
+                    tracer.add_events(result[1])
+
+                elif return_type == ResponseType.HEARTBEAT.value:
+                    zmq_manager.seen(result[1])
+
+                elif return_type == ResponseType.ERROR.value:
+                    print(f'Job failed on {client_id.decode()}: {result[1].decode()}', file=sys.stderr)
+                    pending_tasks.pop(client_id, None)
+                    requeue_failed_job(state, spool_files, zmq_manager.job_failed(client_id))
+
+                elif return_type == ResponseType.HALTED.value:
+                    zmq_manager.set_halted(client_id)
+                    all_processes_busy = False
+
+                elif return_type == ResponseType.READ.value:
+                    tasks = pending_tasks.pop(client_id, ())
+                    add_tasks_to_process(state, spool_files, tasks)
+                    # the points dropped by the decimation of the reader
+                    _, portion = zmq_manager.job_inputs[client_id]
+                    read_points = sum(task_point_count(task) for _, task in tasks)
+                    state.read_points += read_points
+                    state.points_in_progress -= portion[1] - portion[0] - read_points
+                    if progress_callback is not None:
+                        # the points kept by the decimation of the reader
+                        progress_callback(PortionRead(read_points, len(state.point_cloud_file_parts)))
+                    zmq_manager.job_inputs[client_id] = None
+                    state.number_of_reading_jobs -= 1
+                    at_least_one_job_ended = True
+
+                elif return_type == ResponseType.PROCESSED.value:
+                    name, total, save = result[1], struct.unpack('>I', result[2])[0], result[3]
+                    # the points sent to the children of the node
+                    add_tasks_to_process(state, spool_files, pending_tasks.pop(client_id, ()))
+                    del zmq_manager.job_inputs[client_id][name]
+                    state.processed_points += total
+                    state.points_in_progress -= total
+
+                    state.set_node_processed(name)
+                    spool_files.processed(name)
+                    if progress_callback is not None:
+                        progress_callback(NodeProcessed(name.decode('ascii'), total))
+
+                    if name:
+                        node_store.put(name, save)
+                        state.waiting_writing_nodes.add(name)
+
+                        if state.is_reading_finish():
+                            # if all nodes aren't processed yet,
+                            # we should check if linked ancestors are processed
+                            if state.processing_nodes or state.node_to_process:
+                                finished_node = name
+                                if can_pnts_be_written(
+                                    finished_node, finished_node,
+                                    state.node_to_process, state.processing_nodes
+                                ):
+                                    # the nodes of its subtree can be written too,
+                                    # except the branches starting at a node which isn't processed yet
+                                    candidates = list(state.waiting_writing_nodes.subtree(
+                                        finished_node, (state.node_to_process, state.processing_nodes)))
+                                    for candidate in candidates:
+                                        state.waiting_writing_nodes.discard(candidate)
                                         state.pnts_to_writing.append(candidate)
 
-                        else:
-                            for c in state.waiting_writing_nodes:
-                                state.pnts_to_writing.append(c)
-                            state.waiting_writing_nodes.clear()
-
-                at_least_one_job_ended = True
-
-            elif return_type == ResponseType.PNTS_WRITTEN.value:
-                state.points_in_pnts += struct.unpack('>I', result[1])[0]
-                state.number_of_writing_jobs -= 1
-
-            elif return_type == ResponseType.NEW_TASK.value:
-                count = struct.unpack('>I', result[3])[0]
-                state.add_tasks_to_process(result[1], result[2], count)
-
-            else:
-                raise NotImplementedError(f"The command {return_type} is not implemented")
-
-        while state.pnts_to_writing and zmq_manager.can_queue_more_jobs():
-            node_name = state.pnts_to_writing.pop()
-            data = node_store.get(node_name)
-            if not data:
-                raise ValueError(f'{node_name} has no data')
-
-            zmq_manager.send_to_process([CommandType.WRITE_PNTS.value, node_name, data])
-            node_store.remove(node_name)
-            state.number_of_writing_jobs += 1
-
-        if zmq_manager.can_queue_more_jobs():
-            potentials = sorted(
-                # a key (=task) can be in node_to_process and processing_nodes if the node isn't completely processed
-                [(k, v) for k, v in state.node_to_process.items() if k not in state.processing_nodes],
-                key=lambda f: -len(f[0]))
-
-            while zmq_manager.can_queue_more_jobs() and potentials:
-                target_count = 100_000
+                            else:
+                                state.pnts_to_writing.extend(state.waiting_writing_nodes)
+                                state.waiting_writing_nodes.clear()
+
+                    at_least_one_job_ended = True
+
+                elif return_type == ResponseType.PNTS_WRITTEN.value:
+                    count = struct.unpack('>I', result[1])[0]
+                    # the points of a node updated by an incremental conversion were already counted
+                    state.points_in_pnts += count - state.pnts_point_counts.get(result[2], 0)
+                    state.pnts_point_counts[result[2]] = count
+                    state.number_of_writing_jobs -= 1
+                    node_store.remove(result[2])
+                    zmq_manager.job_inputs[client_id] = None
+                    if progress_callback is not None:
+                        progress_callback(PntsWritten(result[2].decode('ascii'), count))
+
+                elif return_type == ResponseType.NEW_TASK.value:
+                    # the tasks are added when the job reading them or processing their parent succeeds
+                    pending_tasks.setdefault(client_id, []).append((result[1], result[2:]))
+
+                else:
+                    raise NotImplementedError(f"The command {return_type} is not implemented")
+
+            for client_id in zmq_manager.dead_clients():
+                print(f'The worker {client_id.decode()} stopped unexpectedly', file=sys.stderr)
+                pending_tasks.pop(client_id, None)
+                requeue_failed_job(state, spool_files, zmq_manager.remove_client(client_id))
+
+            # no new job is started until the checkpoint is saved
+            if draining and zmq_manager.are_all_processes_idle():
+                save_checkpoint(out_folder_path, node_store, {
+                    'parameters': parameters,
+                    'infos': infos,
+                    'state': state,
+                })
+                draining = False
+                last_checkpoint = time.time()
+
+            while not draining and state.pnts_to_writing and zmq_manager.can_queue_more_jobs():
+                node_name = state.pnts_to_writing.pop()
+                data = node_store.get(node_name)
+                if not data:
+                    raise ValueError(f'{node_name} has no data')
+
+                message = [CommandType.WRITE_PNTS.value, node_name, data]
+                if state.job_failures.get((CommandType.WRITE_PNTS.value, node_name)):
+                    # the failed attempts may have written some of the .pnts files of the job
+                    message.append(OVERWRITE_FRAME)
+                zmq_manager.send_to_process(message, inputs=node_name)
+                if incremental:
+                    with open(name_to_filename(str(octree_staging_dir), node_name), 'wb') as f:
+                        f.write(data)
+                state.number_of_writing_jobs += 1
+
+            # when the memory is exhausted, the jobs adding points in memory are sent one by one
+            while (not draining and zmq_manager.can_queue_more_jobs() and state.node_queue
+                   and (not job_sizing.is_memory_exhausted() or zmq_manager.are_all_processes_idle())):
+                target_count = job_sizing.batch_size(state.points_in_progress)
                 job_list = []
                 count = 0
-                idx = len(potentials) - 1
-                while count < target_count and idx >= 0:
-                    name, (tasks, point_count) = potentials[idx]
+                remote = zmq_manager.is_next_client_remote()
+                inputs = {}
+                while count < target_count:
+                    node = state.pop_node_to_process()
+                    if node is None:
+                        break
+                    name, tasks, point_count = node
                     count += point_count
+                    spool_files.process(name, tasks)
+                    inputs[name] = tasks
                     job_list += [
                         name,
                         node_store.get(name),
                         struct.pack('>I', len(tasks)),
-                    ] + tasks
-                    del potentials[idx]
+                    ] + [frame for task in tasks for frame in (spool.inline(task) if remote else task)]
 
-                    del state.node_to_process[name]
                     state.processing_nodes[name] = (len(tasks), point_count, now)
+                    state.waiting_writing_nodes.discard(name)
+
+                if not job_list:
+                    break
+                zmq_manager.send_to_process([CommandType.PROCESS_JOBS.value] + job_list, count, inputs)
+
+            while (not draining and state.can_add_reading_jobs() and zmq_manager.can_queue_more_jobs()
+                   and (not job_sizing.is_memory_exhausted() or zmq_manager.are_all_processes_idle())):
+                file, portion = state.pop_portion(job_sizing.portion_size)
+                if verbose >= 1:
+                    print(f'Submit next portion {(file, portion)}')
+                state.points_in_progress += portion[1] - portion[0]
+
+                zmq_manager.send_to_process([CommandType.READ_FILE.value, pickle.dumps({
+                    'filename': file,
+                    'offset_scale': (
+                        -avg_min,
+                        root_scale,
+                        rotation_matrix[:3, :3].T if rotation_matrix is not None else None,
+                        infos['color_scale'].get(file) if infos['color_scale'] is not None else None,
+                    ),
+                    'portion': portion,
+                    'decimation': (decimation, fraction) if fraction < 100 else None,
+                    'laz_threads': laz_threads,
+                })], portion[1] - portion[0], (file, portion))
+
+                state.number_of_reading_jobs += 1
+
+            # if at this point we have no work in progress => we're done
+            if zmq_manager.are_all_processes_idle() and not zmq_manager.killing_processes and not draining:
+                zmq_manager.kill_all_processes()
+
+            if at_least_one_job_ended:
+                if verbose >= 3:
+                    print('{:^16}|{:^8}|{:^8}'.format('Name', 'Points', 'Seconds'))
+                    for name, v in state.processing_nodes.items():
+                        print('{:^16}|{:^8}|{:^8}'.format(
+                            '{} ({})'.format(name.decode('ascii'), v[0]),
+                            v[1],
+                            round(now - v[2], 1)))
+                    print('')
+                    print('Pending:')
+                    print('  - root: {} / {}'.format(
+                        len(state.point_cloud_file_parts),
+                        initial_portion_count))
+                    print('  - other: {} files for {} nodes'.format(
+                        sum([len(f[0]) for f in state.node_to_process.values()]),
+                        len(state.node_to_process)))
+                    print('')
+                elif verbose >= 2:
+                    state.print_debug()
+                if verbose >= 1:
+                    print('{} % points in {} sec [{} tasks, {} nodes, {} wip]'.format(
+                        round(100 * state.processed_points / infos['point_count'], 2),
+                        round(now, 1),
+                        zmq_manager.number_of_jobs - len(zmq_manager.idle_clients),
+                        len(state.processing_nodes),
+                        state.points_in_progress))
+                elif verbose >= 0:
+                    percent = round(100 * state.processed_points / infos['point_count'], 2)
+                    time_left = (100 - percent) * now / (percent + 0.001)
+                    print('\r{:>6} % in {} sec [est. time left: {} sec]'.format(percent, round(now), round(time_left)), end='', flush=True)
+                if progress_callback is not None:
+                    percent = 100 * state.processed_points / infos['point_count']
+                    progress_callback(Progress(
+                        percent,
+                        now,
+                        (100 - percent) * now / (percent + 0.001),
+                        state.processed_points / now if now > 0 else 0,
+                        job_sizing.memory))
+
+            node_store.control_memory_usage(cache_size, verbose)
+
+            if metrics.should_export():
+                update_metrics(metrics, state, node_store, zmq_manager, job_sizing)
+                metrics.export()
+
+        if state.points_in_pnts != state.read_points:
+            raise ValueError("!!! Invalid point count in the written .pnts"
+                             + f"(expected: {state.read_points}, was: {state.points_in_pnts})")
+        if verbose >= 1:
+            print('Job sizes: {}'.format(', '.join(f'{k}: {v}' for k, v in job_sizing.summary().items())))
+            print('Writing 3dtiles {}'.format(infos['avg_min']))
+
+        previous_tiles = None
+        if incremental:
+            written_nodes = list_nodes(octree_staging_dir)
+            if octree is not None:
+                # the .pnts merged in a rewritten parent must be written again
+                for name in nodes_to_rewrite(outfolder, written_nodes):
+                    with open(name_to_filename(str(out_folder_path / OCTREE_FOLDER), name), 'rb') as f:
+                        pnts_writer.write(f.read(), outfolder, rgb, overwrite=True)
+                    written_nodes.add(name)
+                previous_tiles = reusable_tiles(outfolder, written_nodes)
+
+            save_octree(outfolder, octree_staging_dir, {
+                'octree_metadata': octree_metadata,
+                'offset': avg_min,
+                'scale': root_scale,
+                'rotation_matrix': rotation_matrix,
+                'transformer': transformer,
+                'rgb': rgb,
+                'pnts_point_counts': state.pnts_point_counts,
+            })
+
+        with tracer.span('write_tileset', 'tileset') if tracer is not None else contextlib.nullcontext():
+            write_tileset(outfolder, octree_metadata, avg_min, root_scale, rotation_matrix, rgb, previous_tiles)
+        shutil.rmtree(working_dir)
+        remove_checkpoints(out_folder_path)
+
+        if verbose >= 1:
+            print('Done')
+
+        if benchmark:
+            print('{},{},{},{}'.format(
+                benchmark,
+                ','.join([os.path.basename(f) for f in files]),
+                state.points_in_pnts,
+                round(time.time() - startup, 1)))
+
+        if verbose >= 1:
+            print('destroy', round(zmq_manager.time_waiting_an_idle_process, 2))
+
+        update_metrics(metrics, state, node_store, zmq_manager, job_sizing)
+        metrics.export()
+        if tracer is not None:
+            tracer.write(trace_file)
+    finally:
+        # the workers are stopped and the run is unregistered even if the conversion failed
+        zmq_manager.terminate_all_processes()
+        if cpu_budget is not None:
+            cpu_budget.release()
+        zmq_manager.destroy()
+
+
+async def convert_async(*args, **kwargs):
+    """
+    Run convert in a thread and yield its progress events (see py3dtiles.points.progress), to follow
+    conversions from an asyncio application without blocking its event loop.
 
-                    if name in state.waiting_writing_nodes:
-                        state.waiting_writing_nodes.pop(state.waiting_writing_nodes.index(name))
-                    idx -= 1
-
-                if job_list:
-                    zmq_manager.send_to_process([CommandType.PROCESS_JOBS.value] + job_list)
-
-        while state.can_add_reading_jobs() and zmq_manager.can_queue_more_jobs():
-            if verbose >= 1:
-                print(f'Submit next portion {state.point_cloud_file_parts[-1]}')
-            file, portion = state.point_cloud_file_parts.pop()
-            state.points_in_progress += portion[1] - portion[0]
-
-            zmq_manager.send_to_process([CommandType.READ_FILE.value, pickle.dumps({
-                'filename': file,
-                'offset_scale': (
-                    -avg_min,
-                    root_scale,
-                    rotation_matrix[:3, :3].T if rotation_matrix is not None else None,
-                    infos['color_scale'].get(file) if infos['color_scale'] is not None else None,
-                ),
-                'portion': portion,
-            })])
-
-            state.number_of_reading_jobs += 1
-
-        # if at this point we have no work in progress => we're done
-        if zmq_manager.are_all_processes_idle() and not zmq_manager.killing_processes:
-            zmq_manager.kill_all_processes()
-
-        if at_least_one_job_ended:
-            if verbose >= 3:
-                print('{:^16}|{:^8}|{:^8}'.format('Name', 'Points', 'Seconds'))
-                for name, v in state.processing_nodes.items():
-                    print('{:^16}|{:^8}|{:^8}'.format(
-                        '{} ({})'.format(name.decode('ascii'), v[0]),
-                        v[1],
-                        round(now - v[2], 1)))
-                print('')
-                print('Pending:')
-                print('  - root: {} / {}'.format(
-                    len(state.point_cloud_file_parts),
-                    initial_portion_count))
-                print('  - other: {} files for {} nodes'.format(
-                    sum([len(f[0]) for f in state.node_to_process.values()]),
-                    len(state.node_to_process)))
-                print('')
-            elif verbose >= 2:
-                state.print_debug()
-            if verbose >= 1:
-                print('{} % points in {} sec [{} tasks, {} nodes, {} wip]'.format(
-                    round(100 * state.processed_points / infos['point_count'], 2),
-                    round(now, 1),
-                    jobs - len(zmq_manager.idle_clients),
-                    len(state.processing_nodes),
-                    state.points_in_progress))
-            elif verbose >= 0:
-                percent = round(100 * state.processed_points / infos['point_count'], 2)
-                time_left = (100 - percent) * now / (percent + 0.001)
-                print('\r{:>6} % in {} sec [est. time left: {} sec]'.format(percent, round(now), round(time_left)), end='', flush=True)
-
-            if graph:
-                percent = round(100 * state.processed_points / infos['point_count'], 3)
-                print('{}, {}'.format(time.time() - startup, percent), file=progression_log)
-
-        node_store.control_memory_usage(cache_size, verbose)
-
-    if state.points_in_pnts != infos['point_count']:
-        raise ValueError("!!! Invalid point count in the written .pnts"
-                         + f"(expected: {infos['point_count']}, was: {state.points_in_pnts})")
-    if verbose >= 1:
-        print('Writing 3dtiles {}'.format(infos['avg_min']))
-
-    write_tileset(outfolder, octree_metadata, avg_min, root_scale, rotation_matrix, rgb)
-    shutil.rmtree(working_dir)
-
-    if verbose >= 1:
-        print('Done')
+    The arguments are the ones of convert, except progress_callback. The exceptions of the conversion
+    are raised once the events are consumed.
+    """
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
 
-    if benchmark:
-        print('{},{},{},{}'.format(
-            benchmark,
-            ','.join([os.path.basename(f) for f in files]),
-            state.points_in_pnts,
-            round(time.time() - startup, 1)))
+    def progress_callback(event):
+        loop.call_soon_threadsafe(events.put_nowait, event)
 
-    zmq_manager.terminate_all_processes()
+    future = loop.run_in_executor(None, functools.partial(convert, *args, progress_callback=progress_callback, **kwargs))
+    # the events of the conversion are all queued before the future is done
+    future.add_done_callback(lambda _: events.put_nowait(None))
 
-    if verbose >= 1:
-        print('destroy', round(zmq_manager.time_waiting_an_idle_process, 2))
-
-    if graph:
-        progression_log.close()
-
-    # pygal chart
-    if graph:
-        import pygal
-
-        dateline = pygal.XY(x_label_rotation=25, secondary_range=(0, 100))
-        for pid in zmq_manager.activities:
-            activity = []
-            filename = 'activity.{}.csv'.format(pid)
-            i = len(zmq_manager.activities) - zmq_manager.activities.index(pid) - 1
-            # activities.index(pid) =
-            with open(filename, 'r') as f:
-                content = f.read().split('\n')
-                for line in content[1:]:
-                    line = line.split(',')
-                    if line[0]:
-                        ts = float(line[0])
-                        value = int(line[1]) / 3.0
-                        activity.append((ts, i + value * 0.9))
-
-            os.remove(filename)
-            if activity:
-                activity.append((activity[-1][0], activity[0][1]))
-                activity.append(activity[0])
-                dateline.add(str(pid), activity, show_dots=False, fill=True)
-
-        with open('progression.csv', 'r') as f:
-            values = []
-            for line in f.read().split('\n'):
-                if line:
-                    line = line.split(',')
-                    values += [(float(line[0]), float(line[1]))]
-        os.remove('progression.csv')
-        dateline.add('progression', values, show_dots=False, secondary=True, stroke_style={'width': 2, 'color': 'black'})
-
-        dateline.render_to_file('activity.svg')
-
-    zmq_manager.context.destroy()
+    while True:
+        event = await events.get()
+        if event is None:
+            break
+        yield event
+    await future
 
 
 def init_parser(subparser, str2bool):
@@ -782,7 +1689,7 @@ def init_parser(subparser, str2bool):
     parser.add_argument(
         'files',
         nargs='+',
-        help='Filenames to process. The file must use the .las, .laz (lastools must be installed) or .xyz format.')
+        help='Filenames to process. The file must use the .las, .laz (lazrs must be installed) or .xyz format.')
     parser.add_argument(
         '--out',
         type=str,
@@ -795,14 +1702,20 @@ def init_parser(subparser, str2bool):
         type=str2bool)
     parser.add_argument(
         '--jobs',
-        help='The number of parallel jobs to start. Default to the number of cpu.',
-        default=multiprocessing.cpu_count(),
+        help='The number of parallel jobs to start. Default to the number of cpu, '
+             'shared between the conversions running at the same time on the host. With 0 (the default for '
+             'the small pointclouds), the jobs are run in the current process.',
         type=int)
     parser.add_argument(
         '--cache_size',
         help='Cache size in MB. Default to available memory / 10.',
         default=int(TOTAL_MEMORY_MB / 10),
         type=int)
+    parser.add_argument(
+        '--max_memory',
+        help='The memory in MB the conversion can use, the jobs are throttled to stay below it. '
+             'Default to the memory of the host, or of the container if it is limited.',
+        type=int)
     parser.add_argument(
         '--srs_out', help='SRS to convert the output with (numeric part of the EPSG code)', type=str)
     parser.add_argument(
@@ -811,6 +1724,12 @@ def init_parser(subparser, str2bool):
         '--fraction',
         help='Percentage of the pointcloud to process.',
         default=100, type=int)
+    parser.add_argument(
+        '--decimation',
+        help='How the points are chosen when --fraction is below 100: random, stride (a point every 100 / fraction '
+             'points) or voxel (spread evenly in space).',
+        choices=DECIMATION_MODES,
+        default='random')
     parser.add_argument(
         '--benchmark',
         help='Print summary at the end of the process', type=str)
@@ -818,11 +1737,61 @@ def init_parser(subparser, str2bool):
         '--rgb',
         help='Export rgb attributes', type=str2bool, default=True)
     parser.add_argument(
-        '--graph',
-        help='Produce debug graphes (requires pygal)', type=str2bool, default=False)
+        '--metrics',
+        help='Export the metrics of the conversion in this file while it runs: in the Prometheus text format '
+             'if the filename ends with .prom, as JSON lines otherwise.')
+    parser.add_argument(
+        '--trace',
+        help='Write the timeline of the jobs run by the workers in this file, in the Chrome trace event format '
+             '(to open in Perfetto or chrome://tracing).')
     parser.add_argument(
         '--color_scale',
         help='Force color scale', type=float)
+    parser.add_argument(
+        '--bind',
+        help='The zmq endpoint the workers connect to. Default to an ipc endpoint dedicated to this run. '
+             'Use a tcp endpoint (e.g. tcp://*:5555) to let workers started on other hosts '
+             'with "py3dtiles worker" join the conversion (see --secret_file). The output folder must be shared '
+             'with these hosts and the input files must have the same paths on them. The endpoint must only be '
+             'reachable from trusted hosts.')
+    parser.add_argument(
+        '--secret_file',
+        help='The file containing the secret shared with the workers, required with a tcp endpoint (see --bind). '
+             'Only the workers started with the same secret can join the conversion, and the messages are '
+             'encrypted.')
+    parser.add_argument(
+        '--checkpoint_interval',
+        help='Save the progress of the conversion every N seconds, 0 to disable.',
+        default=600, type=float)
+    parser.add_argument(
+        '--incremental',
+        help='Keep the octree in the output folder to be able to add points later. If the output folder '
+             'already contains such a tileset, the points of the files are added to it.',
+        default=False,
+        type=str2bool)
+    parser.add_argument(
+        '--resume',
+        help='Continue an interrupted conversion from its last checkpoint. '
+             'The other arguments must be the ones of the interrupted conversion.',
+        default=False,
+        type=str2bool)
+    parser.add_argument(
+        '--header_cache',
+        help='The file caching the headers read from the input files, so that the next conversions of the same '
+             'files start without reading them again. Default to $XDG_CACHE_HOME/py3dtiles/headers.json '
+             '(~/.cache/py3dtiles/headers.json), an empty string to disable it.')
+    parser.add_argument(
+        '--reprojection_max_error',
+        help='Reproject the points to srs_out by interpolating the exact transformation of the nodes of a grid '
+             'covering them, when its error is below this distance (in the units of srs_out, e.g. 0.001). '
+             'Each point is transformed exactly by default.',
+        type=float)
+    parser.add_argument(
+        '--header_sidecar',
+        help='Also write the headers read from each input file in a <file>.py3dtiles.json file next to it, '
+             'read by the next conversions and plans whatever their host and header cache.',
+        default=False,
+        type=str2bool)
 
 
 def main(args):
@@ -832,14 +1801,26 @@ def main(args):
                        overwrite=args.overwrite,
                        jobs=args.jobs,
                        cache_size=args.cache_size,
+                       max_memory=args.max_memory,
                        srs_out=args.srs_out,
                        srs_in=args.srs_in,
                        fraction=args.fraction,
+                       decimation=args.decimation,
                        benchmark=args.benchmark,
                        rgb=args.rgb,
-                       graph=args.graph,
+                       metrics_file=args.metrics,
+                       trace_file=args.trace,
                        color_scale=args.color_scale,
-                       verbose=args.verbose)
+                       verbose=args.verbose,
+                       bind_uri=args.bind,
+                       secret=read_secret(args.secret_file) if args.secret_file is not None else None,
+                       checkpoint_interval=args.checkpoint_interval,
+                       resume=args.resume,
+                       incremental=args.incremental,
+                       header_cache_file=(args.header_cache if args.header_cache is not None
+                                          else default_header_cache_path()),
+                       header_sidecar=args.header_sidecar,
+                       reprojection_max_error=args.reprojection_max_error)
     except SrsInMissingException:
         print('No SRS information in input files, you should specify it with --srs_in')
         sys.exit(1)
@@ -0,0 +1,326 @@
+import argparse
+import math
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from pathlib import PurePath
+
+import laspy
+import numpy as np
+import psutil
+
+from py3dtiles.constants import MAX_LEAF_POINT_COUNT
+from py3dtiles.convert import IN_PROCESS_MAX_POINT_COUNT, TOTAL_MEMORY_MB, convert, files_extension, init_octree
+from py3dtiles.points.header_cache import HeaderCache, default_header_cache_path
+from py3dtiles.points.job_sizing import JobSizing
+from py3dtiles.points.spool import Spool
+from py3dtiles.points.task import las_reader, xyz_reader
+from py3dtiles.points.utils import ResponseType, SubdivisionType, aabb_size_to_subdivision_type
+
+# the number of points read from the input files to estimate the octree and to calibrate the conversion speed
+SAMPLE_SIZE = 100_000
+# the number of places in the files where the sample is read
+SAMPLE_PORTION_COUNT = 20
+# the size of the output, measured on typical conversions
+PNTS_HEADER_BYTES = 320
+TILESET_BYTES_PER_TILE = 260
+# the size of a point in the node store (compressed numpy arrays)
+NODE_STORE_BYTES_PER_POINT = 16
+# the nodes keep about this number of points per cell of their spacing
+# (the points are kept in a random order, at a distance of at least the spacing of the others)
+SPACING_FILL_RATIO = 0.6
+# the speedup of a job on a worker isn't linear (the manager, the disk and the memory bandwidth are shared)
+PARALLEL_EFFICIENCY = 0.8
+MAX_DEPTH = 32
+
+
+class _SampleQueue:
+    """
+    Collect the points sent by a reader, instead of sending them to the manager.
+    """
+    def __init__(self):
+        self.spool = Spool()
+        self.xyz = []
+        self.rgb = []
+
+    def send_multipart(self, frames, **kwargs):
+        if frames[0] == ResponseType.NEW_TASK.value:
+            xyz, rgb = self.spool.loads(frames[2:])
+            self.xyz.append(xyz)
+            self.rgb.append(rgb)
+
+
+def read_sample(infos, offset_scale, transformer, sample_size=SAMPLE_SIZE):
+    """
+    Read about sample_size points spread in the portions of infos (see las_reader.init),
+    with the coordinates they have in the octree. Returns the (xyz, rgb) arrays.
+    """
+    portions = infos['portions']
+    if not portions:
+        raise ValueError('No points to sample, none of the files could be read')
+    step = max(1, len(portions) // SAMPLE_PORTION_COUNT)
+    sampled_portions = portions[::step]
+    points_per_portion = max(1, sample_size // len(sampled_portions))
+
+    queue = _SampleQueue()
+    for filename, portion in sampled_portions:
+        reader = las_reader if PurePath(filename).suffix in ('.las', '.laz') else xyz_reader
+        # the portions of xyz files also contain their offset in the file
+        sample_portion = (portion[0], min(portion[1], portion[0] + points_per_portion)) + tuple(portion[2:])
+        reader.run(filename, offset_scale, sample_portion, queue, queue.spool, transformer, 0)
+
+    return np.concatenate(queue.xyz), np.concatenate(queue.rgb)
+
+
+def _distinct_cells(xyz, cell_size):
+    return len(np.unique(np.floor(xyz / cell_size).astype(np.int64), axis=0))
+
+
+def occupied_cells(xyz, cell_size, point_count):
+    """
+    Estimate the number of cells of cell_size containing at least one of the point_count points
+    of the pointcloud, xyz being a sample of it. Returns None if the sample is too small to know it.
+    """
+    sample_count = len(xyz)
+    distinct = _distinct_cells(xyz, cell_size)
+    if sample_count >= point_count:
+        return distinct
+    if distinct >= 0.9 * sample_count:
+        # almost each sampled point is in its own cell
+        return None
+
+    # with C cells of the same density, sampling n points finds C * (1 - exp(-n / C)) cells
+    low, high = float(distinct), float(point_count)
+    for _ in range(100):
+        cells = math.sqrt(low * high)
+        if cells * (1 - math.exp(-sample_count / cells)) < distinct:
+            low = cells
+        else:
+            high = cells
+    return min(int(high), point_count)
+
+
+def estimate_octree(xyz, point_count, octree_metadata):
+    """
+    Estimate the octree built from point_count points, xyz being a sample of them.
+
+    The root sends all its points to its children. The other nodes keep SPACING_FILL_RATIO point per cell
+    of their spacing, the spacing being halved at each level, and send the other points to their children
+    until they have less than MAX_LEAF_POINT_COUNT points.
+    Returns a list of (node count, point count) by depth.
+    """
+    aabb = octree_metadata.aabb
+    aabb_size = np.maximum(aabb[1] - aabb[0], 1e-6)
+    quadtree = aabb_size_to_subdivision_type(aabb_size) == SubdivisionType.QUADTREE
+    child_count = 4 if quadtree else 8
+    xyz = xyz - aabb[0]
+
+    levels = [(1, 0)]
+    remaining = point_count
+    node_count = 1
+    capacity = None
+    capacity_growth = child_count
+    for depth in range(1, MAX_DEPTH):
+        node_size = aabb_size / (1 << depth)
+        if quadtree:
+            node_size[2] = aabb_size[2]
+        estimated_node_count = occupied_cells(xyz, node_size, point_count)
+        if estimated_node_count is None:
+            node_count = min(node_count * child_count, remaining)
+        else:
+            node_count = max(min(estimated_node_count, node_count * child_count), node_count)
+
+        spacing = octree_metadata.spacing / (1 << depth)
+        if remaining / node_count < MAX_LEAF_POINT_COUNT or spacing <= 0.001 * octree_metadata.scale:
+            # leaves, with all their points
+            levels.append((node_count, remaining))
+            break
+
+        previous_capacity = capacity
+        capacity = occupied_cells(xyz, spacing, point_count)
+        if capacity is None:
+            # too few sampled points by cell: extrapolate the number of cells, which are not all occupied
+            cells = (previous_capacity or 1) * capacity_growth
+            capacity = cells * (1 - math.exp(-point_count / cells))
+        elif previous_capacity:
+            capacity_growth = max(capacity / previous_capacity, 1)
+        kept = min(remaining, int(capacity * SPACING_FILL_RATIO))
+        levels.append((node_count, kept))
+        remaining -= kept
+        if remaining <= 0:
+            break
+    return levels
+
+
+def _average_depth(levels):
+    point_count = sum(count for _, count in levels)
+    return sum(depth * count for depth, (_, count) in enumerate(levels)) / max(point_count, 1)
+
+
+def _write_las(filename, xyz, rgb):
+    header = laspy.LasHeader(point_format=2)
+    header.offsets = np.min(xyz, axis=0)
+    header.scales = np.array([0.001, 0.001, 0.001])
+    las = laspy.LasData(header)
+    las.x, las.y, las.z = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+    las.red, las.green, las.blue = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    las.write(filename)
+
+
+def calibrate(xyz, rgb):
+    """
+    Convert the sample xyz, rgb in the current process, and returns the duration of the conversion
+    and the memory used by a worker: (seconds, memory used before, peak memory) with the memory in bytes.
+    """
+    process = psutil.Process()
+    with tempfile.TemporaryDirectory(prefix='py3dtiles-plan-') as folder:
+        filename = os.path.join(folder, 'sample.las')
+        _write_las(filename, xyz, rgb)
+        # the first conversion compiles the numba functions
+        warmup_filename = os.path.join(folder, 'warmup.las')
+        _write_las(warmup_filename, xyz[::10], rgb[::10])
+        convert(warmup_filename, outfolder=os.path.join(folder, 'warmup'), jobs=0, verbose=-1, header_cache_file=None)
+
+        base_memory = process.memory_info().rss
+        peak_memory = [base_memory]
+
+        def sample_memory(event):
+            peak_memory[0] = max(peak_memory[0], process.memory_info().rss)
+
+        start = time.time()
+        convert(filename, outfolder=os.path.join(folder, 'out'), jobs=0, verbose=-1, progress_callback=sample_memory,
+                header_cache_file=None)
+        return time.time() - start, base_memory, peak_memory[0]
+
+
+def plan(files, jobs=None, cache_size=int(TOTAL_MEMORY_MB / 10), srs_in=None, srs_out=None, rgb=True,
+         sample_size=SAMPLE_SIZE, header_cache_file=None):
+    """plan
+
+    Estimate the tileset converted from pointclouds, and the resources the conversion needs, without converting them.
+
+    Only the headers of the las files (all the xyz files) and a sample of the points are read. The speed of the
+    conversion is measured on this machine by converting the sample.
+
+    :param files: Filenames to convert, see py3dtiles.convert.convert.
+    :param jobs: The number of parallel jobs of the conversion. Default to the number of cpu.
+    :param cache_size: The cache size of the conversion in MB.
+    :param srs_in: Override input SRS (numeric part of the EPSG code)
+    :param srs_out: SRS to convert the output with (numeric part of the EPSG code)
+    :param rgb: Export rgb attributes.
+    :param sample_size: The number of points read to estimate the octree.
+    :param header_cache_file: The file caching the headers read from the input files, see
+        py3dtiles.convert.convert. None to disable it.
+
+    :return: a dict with the estimations
+    """
+    files = [files] if isinstance(files, str) else files
+    extension = files_extension(files)
+    init_reader_fn = las_reader.init if extension in ('.las', '.laz') else xyz_reader.init
+    infos = init_reader_fn(files, srs_in=srs_in, srs_out=srs_out, header_cache=HeaderCache(header_cache_file or None))
+    if not infos['portions']:
+        raise ValueError('None of the files could be read')
+    point_count = int(infos['point_count'])
+
+    transformer, offset, rotation_matrix, scale, _, octree_metadata = init_octree(infos, srs_in, srs_out)
+    in_process = jobs is None and point_count <= IN_PROCESS_MAX_POINT_COUNT
+    if in_process:
+        jobs = 1
+    elif jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    # the sample is read with the color scale of its first file
+    color_scale = next(iter(infos['color_scale'].values()), None) if infos['color_scale'] else None
+    offset_scale = (-offset, scale, rotation_matrix[:3, :3].T if rotation_matrix is not None else None, color_scale)
+    xyz, rgb_sample = read_sample(infos, offset_scale, transformer, sample_size)
+
+    levels = estimate_octree(xyz, point_count, octree_metadata)
+    tile_count = sum(node_count for node_count, _ in levels)
+
+    duration, base_memory, peak_memory = calibrate(xyz, rgb_sample)
+    sample_levels = estimate_octree(xyz, len(xyz), octree_metadata)
+    # the points are inserted in each level of the octree until the one keeping them
+    seconds_per_point = duration / (len(xyz) * (1 + _average_depth(sample_levels)))
+    cpu_time = seconds_per_point * point_count * (1 + _average_depth(levels))
+    wall_time = cpu_time if in_process else cpu_time / (jobs * PARALLEL_EFFICIENCY)
+
+    # the biggest jobs sent to a worker, see JobSizing
+    job_point_count = min(max(JobSizing.MAX_PORTION_SIZE, JobSizing.MAX_BATCH_SIZE), max(point_count // jobs, 1))
+    bytes_per_point = max(peak_memory - base_memory, 0) / len(xyz)
+    point_size = 12 + (3 if rgb else 0)
+    node_store_size = point_count * NODE_STORE_BYTES_PER_POINT
+
+    return {
+        'point_count': point_count,
+        'jobs': 0 if in_process else jobs,
+        'octree_depth': len(levels) - 1,
+        'tile_count': tile_count,
+        'points_by_depth': [count for _, count in levels],
+        'output_size_MB': round(
+            (point_count * point_size + tile_count * (PNTS_HEADER_BYTES + TILESET_BYTES_PER_TILE)) / (1024 * 1024)),
+        'node_store_size_MB': round(node_store_size / (1024 * 1024)),
+        'node_store_spilled_MB': round(max(0, node_store_size / (1024 * 1024) - cache_size)),
+        'peak_memory_per_worker_MB': round((base_memory + bytes_per_point * job_point_count) / (1024 * 1024)),
+        'calibration_points_per_second': round(len(xyz) / duration),
+        'wall_time_seconds': round(wall_time),
+    }
+
+
+def init_parser(subparser, str2bool):
+
+    parser = subparser.add_parser(
+        'plan',
+        help='Estimate the tileset and the resources of a conversion, by reading only the headers '
+             'and a sample of the points of the files.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'files',
+        nargs='+',
+        help='Filenames to convert. The file must use the .las, .laz or .xyz format.')
+    parser.add_argument(
+        '--jobs',
+        help='The number of parallel jobs of the conversion. Default to the number of cpu.',
+        type=int)
+    parser.add_argument(
+        '--cache_size',
+        help='The cache size of the conversion in MB.',
+        default=int(TOTAL_MEMORY_MB / 10),
+        type=int)
+    parser.add_argument(
+        '--srs_out',
+        help='SRS to convert the output with (numeric part of the EPSG code)',
+        type=str)
+    parser.add_argument(
+        '--srs_in',
+        help='Override input SRS (numeric part of the EPSG code)',
+        type=str)
+    parser.add_argument(
+        '--rgb',
+        help='Export rgb attributes',
+        type=str2bool,
+        default=True)
+    parser.add_argument(
+        '--sample_size',
+        help='The number of points read to estimate the octree and the speed of the conversion.',
+        default=SAMPLE_SIZE,
+        type=int)
+    parser.add_argument(
+        '--header_cache',
+        help='The file caching the headers read from the input files, shared with the convert command. '
+             'Default to $XDG_CACHE_HOME/py3dtiles/headers.json (~/.cache/py3dtiles/headers.json), '
+             'an empty string to disable it.')
+
+
+def main(args):
+    header_cache_file = args.header_cache if args.header_cache is not None else default_header_cache_path()
+    try:
+        estimations = plan(args.files, jobs=args.jobs, cache_size=args.cache_size, srs_in=args.srs_in,
+                           srs_out=args.srs_out, rgb=args.rgb, sample_size=args.sample_size,
+                           header_cache_file=header_cache_file)
+    except ValueError as e:
+        print(f'Unable to plan the conversion: {e}')
+        sys.exit(1)
+    for key, value in estimations.items():
+        print(f'{key}: {value}')
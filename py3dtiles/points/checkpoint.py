@@ -0,0 +1,97 @@
+import os
+import pickle
+import shutil
+from pathlib import Path
+
+from py3dtiles.points.utils import link_or_copy
+
+CHECKPOINTS_FOLDER = 'checkpoints'
+WORKING_FOLDER = 'tmp'
+
+
+def _list_pnts(out_folder):
+    pnts = []
+    for root, dirs, files in os.walk(out_folder):
+        if root == str(out_folder):
+            dirs[:] = [d for d in dirs if d not in (CHECKPOINTS_FOLDER, WORKING_FOLDER)]
+        pnts += [os.path.relpath(os.path.join(root, f), out_folder) for f in files if f.endswith('.pnts')]
+    return pnts
+
+
+def _list_checkpoints(out_folder):
+    """
+    Returns the complete checkpoints folders, the latest one last.
+    """
+    checkpoints_folder = Path(out_folder) / CHECKPOINTS_FOLDER
+    if not checkpoints_folder.is_dir():
+        return []
+
+    return sorted(
+        [f for f in checkpoints_folder.iterdir() if f.name.isdigit() and (f / 'state.pickle').exists()],
+        key=lambda f: int(f.name))
+
+
+def save_checkpoint(out_folder, node_store, content):
+    """
+    Save a consistent state of the conversion in out_folder.
+
+    This function must be called when no job is running. content is a dict of the
+    manager data (state, input infos...) needed to resume the conversion.
+    The written .pnts files and the content of the node store are saved alongside.
+    """
+    checkpoints_folder = Path(out_folder) / CHECKPOINTS_FOLDER
+    checkpoints_folder.mkdir(exist_ok=True)
+
+    previous = [f for f in checkpoints_folder.iterdir()]
+    index = max([int(f.name) for f in previous if f.name.isdigit()], default=-1) + 1
+    folder = checkpoints_folder / str(index)
+    folder.mkdir()
+
+    node_store.checkpoint(folder / 'nodes')
+
+    content = dict(content, pnts=_list_pnts(out_folder))
+    # state.pickle is written last, its presence means the checkpoint is complete
+    with (folder / 'state.pickle.tmp').open('wb') as f:
+        pickle.dump(content, f)
+    os.replace(folder / 'state.pickle.tmp', folder / 'state.pickle')
+
+    for f in previous:
+        shutil.rmtree(f, ignore_errors=True)
+
+
+def load_checkpoint(out_folder):
+    """
+    Returns the content saved by the latest complete checkpoint of out_folder, or None.
+    """
+    checkpoints = _list_checkpoints(out_folder)
+    if not checkpoints:
+        return None
+
+    with (checkpoints[-1] / 'state.pickle').open('rb') as f:
+        return pickle.load(f)
+
+
+def restore_checkpoint(out_folder, working_dir, content):
+    """
+    Restore the node store of the latest checkpoint in working_dir and
+    remove the .pnts files written after it.
+
+    content is the value returned by load_checkpoint.
+    """
+    folder = _list_checkpoints(out_folder)[-1]
+
+    shutil.rmtree(working_dir, ignore_errors=True)
+    if (folder / 'nodes').is_dir():
+        # the checkpointed nodes are never modified in place, so they can be linked
+        shutil.copytree(folder / 'nodes', working_dir, copy_function=link_or_copy)
+    else:
+        Path(working_dir).mkdir(parents=True)
+
+    checkpointed_pnts = set(content['pnts'])
+    for pnts in _list_pnts(out_folder):
+        if pnts not in checkpointed_pnts:
+            os.remove(Path(out_folder) / pnts)
+
+
+def remove_checkpoints(out_folder):
+    shutil.rmtree(Path(out_folder) / CHECKPOINTS_FOLDER, ignore_errors=True)
@@ -0,0 +1,38 @@
+from numba import njit
+import numpy as np
+
+_IDENTITY = np.identity(3)
+
+
+@njit(cache=True, nogil=True)
+def _to_octree_coordinates(x, y, z, offset, scale, rotation, rotate, out):
+    for i in range(len(x)):
+        c0 = (x[i] + offset[0]) * scale[0]
+        c1 = (y[i] + offset[1]) * scale[1]
+        c2 = (z[i] + offset[2]) * scale[2]
+        if rotate:
+            out[i, 0] = c0 * rotation[0, 0] + c1 * rotation[1, 0] + c2 * rotation[2, 0]
+            out[i, 1] = c0 * rotation[0, 1] + c1 * rotation[1, 1] + c2 * rotation[2, 1]
+            out[i, 2] = c0 * rotation[0, 2] + c1 * rotation[1, 2] + c2 * rotation[2, 2]
+        else:
+            out[i, 0] = c0
+            out[i, 1] = c1
+            out[i, 2] = c2
+
+
+def to_octree_coordinates(x, y, z, offset_scale):
+    """
+    Returns the coordinates of the points in the octree, ((x, y, z) + offset) * scale multiplied by the
+    rotation matrix if any (offset_scale being the one of the READ_FILE jobs), as a contiguous n x 3
+    float32 array.
+
+    The coordinates of each point are computed and written in a single pass, without the temporary
+    arrays of each numpy operation.
+    """
+    offset, scale, rotation = offset_scale[0], offset_scale[1], offset_scale[2]
+    out = np.empty((len(x), 3), dtype=np.float32)
+    _to_octree_coordinates(
+        np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64), np.asarray(z, dtype=np.float64),
+        np.asarray(offset, dtype=np.float64), np.asarray(scale, dtype=np.float64),
+        _IDENTITY if rotation is None else np.asarray(rotation, dtype=np.float64), rotation is not None, out)
+    return out
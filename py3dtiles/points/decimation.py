@@ -0,0 +1,82 @@
+import numpy as np
+
+# The ways of keeping a fraction of the points of the input files when they are read:
+# - random: each point is kept with a probability of fraction %
+# - stride: a point every 100 / fraction points, in the order of the file
+# - voxel: a point by cell of a grid, the cell size being chosen to keep about fraction % of the points
+#   of each chunk read. The kept points are spread evenly in space, unlike the other modes which keep
+#   more points where the pointcloud is denser.
+DECIMATION_MODES = ('random', 'stride', 'voxel')
+
+# the voxel mode stops refining the cell size when the kept point count is this close to the target
+VOXEL_TOLERANCE = 0.05
+VOXEL_MAX_ITERATIONS = 8
+# the number of cells by axis is limited so that the cell keys fit in an int64
+VOXEL_MAX_CELLS_PER_AXIS = 1 << 20
+
+
+def _uniform(indices):
+    """
+    Returns a number in [0, 1) for each point index (the splitmix64 hash of the index), so the same points
+    are kept whatever the size of the chunks and the portions of the file, e.g. when a job is sent again.
+    """
+    with np.errstate(over='ignore'):
+        z = indices.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) / (1 << 53)
+
+
+def _first_point_by_cell(xyz, mins, cell_size):
+    cells = np.minimum(((xyz - mins) / cell_size).astype(np.int64), VOXEL_MAX_CELLS_PER_AXIS - 1)
+    keys = (cells[:, 0] << 40) | (cells[:, 1] << 20) | cells[:, 2]
+    return np.unique(keys, return_index=True)[1]
+
+
+def _voxel(xyz, target):
+    mins = np.min(xyz, axis=0)
+    extent = np.maximum(np.max(xyz, axis=0) - mins, 1e-9)
+    min_cell_size = np.max(extent) / (VOXEL_MAX_CELLS_PER_AXIS - 1)
+    # the first guess fills the bounding box with target cells
+    cell_size = max(float(np.prod(extent) / target) ** (1 / 3), min_cell_size)
+
+    best = None
+    previous = None
+    for _ in range(VOXEL_MAX_ITERATIONS):
+        indices = _first_point_by_cell(xyz, mins, cell_size)
+        if best is None or abs(len(indices) - target) < abs(len(best) - target):
+            best = indices
+        if abs(len(indices) - target) <= VOXEL_TOLERANCE * target:
+            break
+
+        # the kept point count is about proportional to cell_size ** -dimension, the dimension (2 for
+        # a surface, 3 for a volume) being estimated from the previous iteration
+        dimension = 3
+        if previous is not None and previous[0] != cell_size and previous[1] != len(indices):
+            dimension = np.log(len(indices) / previous[1]) / np.log(previous[0] / cell_size)
+            dimension = min(max(dimension, 1), 3)
+        previous = (cell_size, len(indices))
+        cell_size = max(cell_size * (len(indices) / target) ** (1 / dimension), min_cell_size)
+
+    return np.sort(best)
+
+
+def decimate(xyz, fraction, mode='random', start=0):
+    """
+    Returns the indices of the points of xyz (a n x 3 array) to keep, to keep about fraction percent of them
+    (see DECIMATION_MODES for the modes). start is the index of the first point of xyz in its file.
+    """
+    if fraction >= 100 or len(xyz) == 0:
+        return np.arange(len(xyz))
+
+    if mode == 'random':
+        return np.flatnonzero(_uniform(np.arange(start, start + len(xyz))) < fraction / 100)
+    elif mode == 'stride':
+        # the point i is kept when floor(i * fraction / 100) increases
+        kept = np.floor(np.arange(start - 1, start + len(xyz)) * (fraction / 100))
+        return np.flatnonzero(np.diff(kept) > 0)
+    elif mode == 'voxel':
+        return _voxel(xyz, max(len(xyz) * fraction / 100, 1))
+    else:
+        raise ValueError(f'Unknown decimation mode {mode}, it should be one of {DECIMATION_MODES}')
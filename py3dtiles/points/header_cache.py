@@ -0,0 +1,157 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# bump it when the content of the entries changes
+CACHE_VERSION = 4
+# the entries of a file can also be stored next to it, in a file named after it with this suffix
+SIDECAR_SUFFIX = '.py3dtiles.json'
+
+
+def default_header_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'py3dtiles', 'headers.json')
+
+
+def sidecar_path(filename):
+    return f'{filename}{SIDECAR_SUFFIX}'
+
+
+def _write_json(filename, content):
+    # the file is replaced, so the conversions running at the same time never read a partial file
+    tmp_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmp_filename, filename)
+
+
+class HeaderCache:
+    """
+    The informations read from the headers of the input files by the readers (bounding box, point count...).
+
+    The entries are keyed by the absolute path of the file, and are valid as long as its size and its
+    modification time don't change. They are stored in a JSON file shared by the conversions of the host,
+    and a conversion of files already converted starts without reading them again.
+
+    The entries missing from this file are also read from the sidecar of the input file (see sidecar_path)
+    if there is one, e.g. delivered with the files or written by a conversion on another host. With sidecar,
+    the new entries are written in the sidecars too.
+    """
+    def __init__(self, filename=None, sidecar=False):
+        self.filename = filename
+        self.sidecar = sidecar
+        self.entries = {}
+        self.modified = False
+        # the keys of the entries to write in the sidecars
+        self.sidecar_keys = set()
+        if filename is None:
+            return
+        try:
+            with open(filename) as f:
+                content = json.load(f)
+            if content.get('version') == CACHE_VERSION:
+                self.entries = content['entries']
+        except (OSError, ValueError, KeyError):
+            # a missing or corrupted cache is read again from the files
+            pass
+
+    @staticmethod
+    def _key(filename, kind):
+        return f'{kind}:{os.path.abspath(filename)}'
+
+    @staticmethod
+    def _version(filename):
+        stat = os.stat(filename)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    @staticmethod
+    def _read_sidecar(filename):
+        try:
+            with open(sidecar_path(filename)) as f:
+                content = json.load(f)
+            if content.get('version') == CACHE_VERSION:
+                return content['entries']
+        except (OSError, ValueError, KeyError):
+            pass
+        return {}
+
+    def get(self, filename, kind):
+        key = self._key(filename, kind)
+        version = self._version(filename)
+        cached = self.entries.get(key)
+        if cached is None or cached['version'] != version:
+            cached = self._read_sidecar(filename).get(kind)
+            if cached is None or cached['version'] != version:
+                return None
+            self.entries[key] = {'path': os.path.abspath(filename), **cached}
+            self.modified = True
+        elif self.sidecar and not os.path.exists(sidecar_path(filename)):
+            self.sidecar_keys.add(key)
+        return cached['entry']
+
+    def set(self, filename, kind, entry):
+        key = self._key(filename, kind)
+        self.entries[key] = {
+            'path': os.path.abspath(filename),
+            'version': self._version(filename),
+            'entry': entry,
+        }
+        self.modified = True
+        if self.sidecar:
+            self.sidecar_keys.add(key)
+
+    def _save_sidecars(self):
+        for key in self.sidecar_keys:
+            kind = key.split(':', 1)[0]
+            cached = self.entries[key]
+            filename = cached['path']
+            # the entries of the other kinds are kept
+            entries = self._read_sidecar(filename)
+            entries[kind] = {'version': cached['version'], 'entry': cached['entry']}
+            try:
+                _write_json(sidecar_path(filename), {'version': CACHE_VERSION, 'entries': entries})
+            except OSError as e:
+                # e.g. a read-only folder
+                print(f'Unable to save the sidecar of {filename}: {e}')
+        self.sidecar_keys = set()
+
+    def save(self):
+        self._save_sidecars()
+        if self.filename is None or not self.modified:
+            return
+        try:
+            Path(self.filename).parent.mkdir(parents=True, exist_ok=True)
+            # forget the deleted files
+            self.entries = {key: cached for key, cached in self.entries.items() if os.path.exists(cached['path'])}
+            _write_json(self.filename, {'version': CACHE_VERSION, 'entries': self.entries})
+            self.modified = False
+        except OSError as e:
+            # the cache only speeds up the next conversions
+            print(f'Unable to save the header cache {self.filename}: {e}')
+
+
+def scan_files(files, kind, scan_fn, header_cache=None):
+    """
+    Returns the result of scan_fn(filename) for each file, in the order of files, or the exception
+    raised by scan_fn for this file.
+
+    The files are scanned concurrently in a thread pool (reading the headers mostly waits for the disk),
+    and the results are read from and stored in header_cache.
+    """
+    header_cache = header_cache if header_cache is not None else HeaderCache()
+
+    def scan(filename):
+        try:
+            entry = header_cache.get(filename, kind)
+            if entry is None:
+                entry = scan_fn(filename)
+                header_cache.set(filename, kind, entry)
+            return entry
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor() as executor:
+        results = list(executor.map(scan, files))
+    header_cache.save()
+    return results
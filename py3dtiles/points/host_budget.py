@@ -0,0 +1,110 @@
+import multiprocessing
+import os
+import tempfile
+import time
+import uuid
+import weakref
+from pathlib import Path
+from stat import S_ISDIR
+
+import psutil
+
+# the difference allowed between the create time of a process written in its registration and the one
+# read again, the registration being of another process using the same pid otherwise
+CREATE_TIME_TOLERANCE = 0.01
+
+
+def _default_folder():
+    name = 'py3dtiles-runs'
+    if hasattr(os, 'getuid'):
+        # the folder of each user, the conversions of the other users can't register in it
+        name += f'-{os.getuid()}'
+    return Path(tempfile.gettempdir()) / name
+
+
+def _check_folder(folder):
+    stat = os.lstat(folder)
+    if not S_ISDIR(stat.st_mode):
+        raise PermissionError(f'{folder} is not a directory')
+    if hasattr(os, 'getuid') and (stat.st_uid != os.getuid() or stat.st_mode & 0o077):
+        raise PermissionError(f'{folder} should be owned by the current user and only be accessible by them')
+
+
+def _is_alive(pid, create_time):
+    try:
+        alive_create_time = psutil.Process(pid).create_time()
+    except psutil.NoSuchProcess:
+        return False
+    except psutil.AccessDenied:
+        return True
+    return create_time is None or abs(alive_create_time - create_time) <= CREATE_TIME_TOLERANCE
+
+
+def _unregister(filename):
+    try:
+        filename.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class HostCpuBudget:
+    """
+    Share the cpus of the host between the conversions running at the same time.
+
+    Each conversion registers itself with a file in a folder shared by all the conversions
+    of the user on the host. The share of a conversion is the cpu count divided by the number of
+    conversions alive.
+
+    The folder must be owned by the current user and only be accessible by them, a PermissionError
+    is raised otherwise.
+    """
+
+    def __init__(self, folder=None, refresh_interval=1.0):
+        self.folder = Path(folder) if folder is not None else _default_folder()
+        self.folder.mkdir(mode=0o700, parents=True, exist_ok=True)
+        _check_folder(self.folder)
+        self.refresh_interval = refresh_interval
+
+        self.filename = self.folder / '{}-{}'.format(os.getpid(), uuid.uuid4().hex)
+        self.filename.write_text(repr(psutil.Process().create_time()))
+        # the registration is also removed if the conversion fails
+        self._finalizer = weakref.finalize(self, _unregister, self.filename)
+
+        self._share = None
+        self._share_time = 0
+
+    def count_runs(self):
+        count = 0
+        for filename in self.folder.iterdir():
+            try:
+                pid = int(filename.name.split('-')[0])
+            except ValueError:
+                continue
+            try:
+                create_time = float(filename.read_text())
+            except FileNotFoundError:
+                continue
+            except ValueError:
+                # the registration is being written
+                create_time = None
+            if _is_alive(pid, create_time):
+                count += 1
+            else:
+                # the conversion was killed without unregistering, its pid may be used by another process
+                _unregister(filename)
+        return max(count, 1)
+
+    def share(self):
+        """
+        Returns the number of cpus this conversion can use.
+
+        The folder is read at most once per refresh_interval seconds.
+        """
+        now = time.time()
+        if self._share is None or now - self._share_time > self.refresh_interval:
+            self._share = max(1, multiprocessing.cpu_count() // self.count_runs())
+            self._share_time = now
+        return self._share
+
+    def release(self):
+        self._finalizer()
@@ -0,0 +1,109 @@
+import json
+import os
+import pickle
+from pathlib import Path
+
+from py3dtiles.points.utils import filename_to_name, name_to_filename
+
+OCTREE_FOLDER = 'octree'
+
+
+def list_nodes(folder):
+    """
+    Returns the names of the nodes stored in folder (see SharedNodeStore)
+    """
+    names = set()
+    for root, _, files in os.walk(folder):
+        for filename in files:
+            if filename.startswith('r') and not filename.endswith('.tmp'):
+                names.add(filename_to_name(os.path.relpath(os.path.join(root, filename), folder)))
+    return names
+
+
+def load_octree(out_folder):
+    """
+    Returns the metadata of the octree saved in out_folder, or None if there is no octree.
+    """
+    filename = Path(out_folder) / OCTREE_FOLDER / 'metadata.pickle'
+    if not filename.exists():
+        return None
+
+    with filename.open('rb') as f:
+        return pickle.load(f)
+
+
+def save_octree(out_folder, staging_folder, metadata):
+    """
+    Move the nodes written during the conversion from staging_folder to the octree of out_folder,
+    and save the metadata needed to insert new points in it.
+    """
+    octree_folder = Path(out_folder) / OCTREE_FOLDER
+    octree_folder.mkdir(exist_ok=True)
+
+    for root, _, files in os.walk(staging_folder):
+        for filename in files:
+            src = os.path.join(root, filename)
+            dst = octree_folder / os.path.relpath(src, staging_folder)
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(src, dst)
+
+    with (octree_folder / 'metadata.pickle.tmp').open('wb') as f:
+        pickle.dump(metadata, f)
+    os.replace(octree_folder / 'metadata.pickle.tmp', octree_folder / 'metadata.pickle')
+
+
+def nodes_to_rewrite(out_folder, written_nodes):
+    """
+    Returns the nodes of the octree of out_folder whose .pnts must be written again,
+    after the update of the written_nodes.
+
+    When the tileset is built, the small .pnts are merged in the .pnts of their parent
+    (see Node.to_tileset). If the parent has been written again, it doesn't contain
+    these points anymore.
+    """
+    stored = list_nodes(Path(out_folder) / OCTREE_FOLDER)
+    nodes = stored | written_nodes
+
+    result = []
+    for name in stored - written_nodes:
+        if os.path.exists(name_to_filename(out_folder, name, '.pnts')):
+            continue
+        # the node containing the parent, the root node is always written again
+        parent = name[:-1]
+        owner = next((parent[:i] for i in range(len(parent), 0, -1) if parent[:i] in nodes), b'')
+        if owner == b'' or owner in written_nodes:
+            result.append(name)
+
+    return result
+
+
+def _collect_tiles(folder, tile, tiles):
+    uri = tile.get('content', {}).get('uri')
+    if uri is not None:
+        if uri.endswith('.pnts'):
+            tiles.setdefault(filename_to_name(uri, '.pnts'), tile)
+        elif uri.startswith('tileset.'):
+            # keep the reference to the external tileset, not its root
+            tiles.setdefault(uri[len('tileset.'):-len('.json')].encode('ascii'), tile)
+            with open(os.path.join(folder, uri)) as f:
+                _collect_tiles(folder, json.load(f)['root'], tiles)
+
+    for child in tile.get('children', []):
+        _collect_tiles(folder, child, tiles)
+
+
+def reusable_tiles(out_folder, written_nodes):
+    """
+    Returns the tiles of the tileset of out_folder, by node name, which
+    are unchanged by the update of the written_nodes.
+    """
+    tiles = {}
+    with (Path(out_folder) / 'tileset.json').open() as f:
+        _collect_tiles(out_folder, json.load(f)['root'], tiles)
+
+    # the root .pnts is always built again
+    ancestors = {b''} | {name[:i] for name in written_nodes for i in range(len(name))}
+    return {
+        name: tile for name, tile in tiles.items()
+        if name not in ancestors and not any(name[:i] in written_nodes for i in range(len(name) + 1))
+    }
@@ -0,0 +1,157 @@
+import time
+
+import psutil
+
+from py3dtiles.points.utils import CommandType
+
+# the files giving the memory limit of the container (cgroup v2, then v1), if any
+CGROUP_MEMORY_LIMIT_FILES = ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']
+
+
+def memory_limit():
+    """
+    Returns the memory (in bytes) the conversion can use: the memory of the host,
+    or the limit of the container if it's lower.
+    """
+    limit = psutil.virtual_memory().total
+    for filename in CGROUP_MEMORY_LIMIT_FILES:
+        try:
+            with open(filename) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            limit = min(limit, int(value))
+    return limit
+
+
+def _clamp(value, min_value, max_value):
+    return int(min(max(value, min_value), max_value))
+
+
+class JobSizing:
+    """
+    Adapt the size of the jobs sent to the workers while the conversion runs.
+
+    - the number of points of a PROCESS_JOBS batch and of a READ_FILE portion are computed from
+      the throughput measured on the previous jobs, to get jobs lasting about target_latency seconds.
+      They are also limited so that every worker gets a share of the pending points.
+    - the number of points in progress (read but not processed yet) is limited by the memory
+      used by the workers, measured with their RSS.
+
+    memory_limit is a hard limit: when the memory used is close to it, is_memory_exhausted
+    tells the manager to wait for the running jobs before sending new ones.
+    """
+    MIN_BATCH_SIZE = 10_000
+    MAX_BATCH_SIZE = 2_000_000
+    MIN_PORTION_SIZE = 100_000
+    MAX_PORTION_SIZE = 1_000_000
+    MIN_POINT_IN_PROGRESS = 1_000_000
+    MAX_POINT_IN_PROGRESS = 500_000_000
+
+    def __init__(self, number_of_jobs, point_count, memory_limit, target_latency=1.0, memory_sample_interval=0.5):
+        self.number_of_jobs = max(number_of_jobs, 1)
+        self.memory_limit = memory_limit
+        self.target_latency = target_latency
+        self.memory_sample_interval = memory_sample_interval
+
+        self.process_batch_size = 100_000
+        # the portions are split so that each worker reads a part of the files
+        self.portion_size = _clamp(point_count / self.number_of_jobs, self.MIN_PORTION_SIZE, self.MAX_PORTION_SIZE)
+        self.max_point_in_progress = 60_000_000
+
+        # the throughputs in points per second of a job, and the memory used by a point in progress
+        self.process_rate = None
+        self.read_rate = None
+        self.bytes_per_point = None
+
+        # the memory used by the processes without any point in progress
+        self.base_memory = None
+        self.memory = 0
+        self.peak_memory = 0
+        self._memory_sample_time = 0
+
+    @staticmethod
+    def _average(previous, value):
+        # exponential moving average, to smooth the variations between jobs
+        return value if previous is None else 0.8 * previous + 0.2 * value
+
+    def job_finished(self, command, point_count, latency):
+        """
+        Update the job sizes with the duration of a job.
+        """
+        if point_count <= 0 or latency <= 0:
+            return
+
+        rate = point_count / latency
+        if command == CommandType.PROCESS_JOBS.value:
+            self.process_rate = self._average(self.process_rate, rate)
+            self.process_batch_size = _clamp(
+                self.process_rate * self.target_latency, self.MIN_BATCH_SIZE, self.MAX_BATCH_SIZE)
+        elif command == CommandType.READ_FILE.value:
+            # a portion is read and sent in several tasks, it can last longer than a batch
+            self.read_rate = self._average(self.read_rate, rate)
+            self.portion_size = _clamp(
+                min(self.read_rate * 5 * self.target_latency, self.portion_size * 2),
+                self.MIN_PORTION_SIZE, self.MAX_PORTION_SIZE)
+
+    def batch_size(self, points_in_progress):
+        """
+        The number of points to send in the next PROCESS_JOBS batch.
+        """
+        return _clamp(
+            min(self.process_batch_size, points_in_progress / self.number_of_jobs),
+            self.MIN_BATCH_SIZE, self.MAX_BATCH_SIZE)
+
+    def sample_memory(self, pids, points_in_progress):
+        """
+        Measure the memory used by the processes pids and update the limit of points in progress.
+
+        The processes are measured at most once every memory_sample_interval seconds,
+        returns True if they were measured.
+        """
+        now = time.time()
+        if now - self._memory_sample_time < self.memory_sample_interval:
+            return False
+        self._memory_sample_time = now
+
+        memory = 0
+        for pid in pids:
+            try:
+                memory += psutil.Process(pid).memory_info().rss
+            except psutil.Error:
+                # the process has ended
+                continue
+        self.update_memory(memory, points_in_progress)
+        return True
+
+    def update_memory(self, memory, points_in_progress):
+        self.memory = memory
+        self.peak_memory = max(self.peak_memory, memory)
+        if self.base_memory is None or points_in_progress == 0:
+            self.base_memory = memory if self.base_memory is None else min(self.base_memory, memory)
+            return
+
+        if points_in_progress >= self.MIN_POINT_IN_PROGRESS:
+            self.bytes_per_point = self._average(
+                self.bytes_per_point, max(memory - self.base_memory, 0) / points_in_progress)
+        if self.bytes_per_point:
+            # keep a margin for the memory freed later by the workers
+            available = 0.8 * self.memory_limit - self.base_memory
+            self.max_point_in_progress = _clamp(
+                available / self.bytes_per_point, self.MIN_POINT_IN_PROGRESS, self.MAX_POINT_IN_PROGRESS)
+        if self.is_memory_exhausted():
+            # the estimation is late, don't read more points until the memory is released
+            self.max_point_in_progress = min(self.max_point_in_progress, max(points_in_progress // 2, 1))
+
+    def is_memory_exhausted(self):
+        # the running jobs can still allocate memory, so some margin is kept
+        return self.memory > 0.9 * self.memory_limit
+
+    def summary(self):
+        return {
+            'process_batch_size': self.process_batch_size,
+            'portion_size': self.portion_size,
+            'max_point_in_progress': self.max_point_in_progress,
+            'peak_memory_MB': round(self.peak_memory / (1024 * 1024)),
+        }
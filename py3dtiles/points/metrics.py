@@ -0,0 +1,127 @@
+import bisect
+import json
+import math
+import os
+import time
+
+# the upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf]
+
+
+def _labels_to_str(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        result = []
+        total = 0
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+class Metrics:
+    """
+    The metrics of a conversion: counters, gauges and histograms, identified by a name and labels.
+
+    They are exported to filename at most every interval seconds while the conversion runs:
+    - in the Prometheus text format if filename ends with .prom (e.g. for the textfile collector
+      of the node exporter). The file is replaced at each export.
+    - otherwise as a stream of JSON lines, a line being appended with all the metrics at each export.
+    """
+    PREFIX = 'py3dtiles_'
+
+    def __init__(self, filename=None, interval=5.0):
+        self.filename = filename
+        self.interval = interval
+        self.start = time.time()
+        self._last_export = 0
+        # name: 'counter', 'gauge' or 'histogram'
+        self.types = {}
+        # (name, labels): value or Histogram
+        self.values = {}
+
+    def _key(self, name, kind, labels):
+        self.types[name] = kind
+        return name, tuple(sorted(labels.items()))
+
+    def set_counter(self, name, value, **labels):
+        """
+        Set the value of a counter (a value which only increases, e.g. a number of hits).
+        """
+        self.values[self._key(name, 'counter', labels)] = value
+
+    def set_gauge(self, name, value, **labels):
+        self.values[self._key(name, 'gauge', labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, 'histogram', labels)
+        if key not in self.values:
+            self.values[key] = Histogram()
+        self.values[key].observe(value)
+
+    def should_export(self):
+        return self.filename is not None and time.time() - self._last_export >= self.interval
+
+    def export(self):
+        if self.filename is None:
+            return
+        now = time.time()
+        self._last_export = now
+
+        if self.filename.endswith('.prom'):
+            # the file is replaced, so the readers never see a partial export
+            with open(self.filename + '.tmp', 'w') as f:
+                f.write(self.to_prometheus())
+            os.replace(self.filename + '.tmp', self.filename)
+        else:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(self.to_dict(now)) + '\n')
+
+    def to_prometheus(self):
+        lines = []
+        for name, kind in self.types.items():
+            full_name = self.PREFIX + name
+            lines.append(f'# TYPE {full_name} {kind}')
+            for (key_name, labels), value in self.values.items():
+                if key_name != name:
+                    continue
+                if kind != 'histogram':
+                    lines.append(f'{full_name}{_labels_to_str(labels)} {value}')
+                    continue
+                for bound, count in zip(value.buckets, value.cumulative_counts()):
+                    le = '+Inf' if bound == math.inf else bound
+                    lines.append(f'{full_name}_bucket{_labels_to_str(labels + (("le", le),))} {count}')
+                lines.append(f'{full_name}_sum{_labels_to_str(labels)} {value.sum}')
+                lines.append(f'{full_name}_count{_labels_to_str(labels)} {value.count}')
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self, now=None):
+        result = {'time': round((now or time.time()) - self.start, 3)}
+        for (name, labels), value in self.values.items():
+            key = name + _labels_to_str(labels)
+            if isinstance(value, Histogram):
+                result[key] = {
+                    'buckets': [str(b) for b in value.buckets],
+                    'counts': value.cumulative_counts(),
+                    'sum': value.sum,
+                    'count': value.count,
+                }
+            else:
+                result[key] = value
+        return result
@@ -5,7 +5,7 @@ import pickle
 import numpy as np
 
 from py3dtiles import TileContentReader
-from py3dtiles.constants import MIN_POINT_SIZE
+from py3dtiles.constants import MAX_LEAF_POINT_COUNT, MIN_POINT_SIZE
 from py3dtiles.feature_table import SemanticPoint
 from py3dtiles.points.distance import xyz_to_child_index
 from py3dtiles.points.points_grid import Grid
@@ -14,7 +14,7 @@ from py3dtiles.points.utils import name_to_filename, node_from_name, Subdivision
 
 
 def node_to_tileset(args):
-    return Node.to_tileset(None, args[0], args[1], args[2], args[3], args[4])
+    return Node.to_tileset(None, args[0], args[1], args[2], args[3], args[4], args[5])
 
 
 class Node(object):
@@ -71,7 +71,7 @@ class Node(object):
             self.points.append((xyz, rgb))
             count = sum([xyz.shape[0] for xyz, rgb in self.points])
             # stop subdividing if spacing is 1mm
-            if count >= 20000 and self.spacing > 0.001 * scale:
+            if count >= MAX_LEAF_POINT_COUNT and self.spacing > 0.001 * scale:
                 self._split(node_catalog, scale)
             self.dirty = True
 
@@ -104,8 +104,9 @@ class Node(object):
 
     def dump_pending_points(self):
         result = [
-            (name, pickle.dumps({'xyz': xyz, 'rgb': rgb}), len(xyz))
+            (name, xyz, rgb)
             for name, xyz, rgb in self._get_pending_points()
+            if len(xyz) > 0
         ]
 
         self.pending_xyz = []
@@ -186,7 +187,16 @@ class Node(object):
             return data.grid.get_points(include_rgb)
 
     @staticmethod
-    def to_tileset(executor, name, parent_aabb, parent_spacing, folder, scale):
+    def to_tileset(executor, name, parent_aabb, parent_spacing, folder, scale, previous_tiles=None):
+        """
+        Returns the tileset of the node and its children.
+
+        previous_tiles is a dict of the tiles (by node name) of a previous tileset which
+        can be reused as is, because their .pnts and the .pnts of their children are unchanged.
+        """
+        if previous_tiles is not None and name in previous_tiles:
+            return previous_tiles[name]
+
         node = node_from_name(name, parent_aabb, parent_spacing)
         aabb = node.aabb
         ondisk_tile = name_to_filename(folder, name, '.pnts')
@@ -253,9 +263,9 @@ class Node(object):
 
                 # Add child to the to-be-processed list if it hasn't been merged
                 if executor is not None:
-                    children += [(child_name, node.aabb, node.spacing, folder, scale)]
+                    children += [(child_name, node.aabb, node.spacing, folder, scale, previous_tiles)]
                 else:
-                    children += [Node.to_tileset(None, child_name, node.aabb, node.spacing, folder, scale)]
+                    children += [Node.to_tileset(None, child_name, node.aabb, node.spacing, folder, scale, previous_tiles)]
 
         # If we merged at least one child tile in the current tile
         # the pnts file needs to be rewritten.
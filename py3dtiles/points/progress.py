@@ -0,0 +1,14 @@
+from collections import namedtuple
+
+# The events sent to the progress_callback of convert while the conversion runs.
+
+# a READ_FILE job has finished: point_count points were read (the points kept when --fraction is used),
+# and remaining_portions portions are still to be read
+PortionRead = namedtuple('PortionRead', ['point_count', 'remaining_portions'])
+# the points of a PROCESS_JOBS job were inserted in the node name
+NodeProcessed = namedtuple('NodeProcessed', ['name', 'point_count'])
+# the .pnts file of the node name was written with point_count points
+PntsWritten = namedtuple('PntsWritten', ['name', 'point_count'])
+# the overall progress: percent of the points processed, elapsed and estimated remaining time in seconds,
+# throughput in points processed per second and memory used by the workers in bytes
+Progress = namedtuple('Progress', ['percent', 'elapsed', 'eta', 'points_per_second', 'memory'])
@@ -0,0 +1,118 @@
+from numba import njit
+import numpy as np
+
+# the chunks of fewer points are transformed exactly, building a grid wouldn't be faster
+MIN_POINT_COUNT = 10_000
+# the number of cells by axis of the horizontal grids tried, until one is precise enough
+GRID_RESOLUTIONS = (8, 16, 32, 64)
+# the bounding box of a chunk is enlarged by this ratio, so that the next chunks of the portion
+# are likely to be inside the same grid
+GRID_MARGIN = 0.1
+# the number of points of each chunk transformed exactly to check the error of the grid
+SAMPLE_POINT_COUNT = 64
+
+
+@njit(cache=True, nogil=True)
+def _interpolate(x, y, z, origin, inv_step, cell_count, grid, out):
+    for i in range(len(x)):
+        fx = (x[i] - origin[0]) * inv_step[0]
+        fy = (y[i] - origin[1]) * inv_step[1]
+        tz = (z[i] - origin[2]) * inv_step[2]
+        ix = min(max(int(np.floor(fx)), 0), cell_count - 1)
+        iy = min(max(int(np.floor(fy)), 0), cell_count - 1)
+        tx = fx - ix
+        ty = fy - iy
+        for c in range(3):
+            # bilinear interpolation at the bottom and the top of the grid, linear between them
+            bottom = ((grid[ix, iy, 0, c] * (1 - tx) + grid[ix + 1, iy, 0, c] * tx) * (1 - ty)
+                      + (grid[ix, iy + 1, 0, c] * (1 - tx) + grid[ix + 1, iy + 1, 0, c] * tx) * ty)
+            top = ((grid[ix, iy, 1, c] * (1 - tx) + grid[ix + 1, iy, 1, c] * tx) * (1 - ty)
+                   + (grid[ix, iy + 1, 1, c] * (1 - tx) + grid[ix + 1, iy + 1, 1, c] * tx) * ty)
+            out[c, i] = bottom * (1 - tz) + top * tz
+
+
+class _Grid:
+    """
+    The exact transformation of the nodes of a cell_count x cell_count x 1 grid covering mins, maxs.
+    """
+    def __init__(self, transformer, mins, maxs, cell_count):
+        self.mins = mins
+        self.cell_count = cell_count
+        self.step = (maxs - mins) / np.array([cell_count, cell_count, 1])
+        self.inv_step = 1 / self.step
+        nx, ny, nz = np.meshgrid(
+            np.linspace(mins[0], maxs[0], cell_count + 1),
+            np.linspace(mins[1], maxs[1], cell_count + 1),
+            [mins[2], maxs[2]],
+            indexing='ij')
+        values = transformer.transform(nx.ravel(), ny.ravel(), nz.ravel())
+        self.values = np.ascontiguousarray(np.stack(values, axis=-1).reshape(nx.shape + (3,)))
+
+    def interpolate(self, x, y, z):
+        out = np.empty((3, len(x)))
+        _interpolate(x, y, z, self.mins, self.inv_step, self.cell_count, self.values, out)
+        return out
+
+
+def _max_error(transformer, grid, x, y, z):
+    exact = np.array(transformer.transform(x, y, z))
+    return np.max(np.linalg.norm(grid.interpolate(x, y, z) - exact, axis=0))
+
+
+class GridTransformer:
+    """
+    Transforms the points like transformer (a pyproj Transformer), interpolating the exact transformation
+    of the nodes of a grid covering the bounding box of the points instead of transforming each point.
+
+    A grid is used only if its error, checked at the centers of its cells and for a sample of the points
+    of each chunk, is below max_error (in the units of the output srs). The points are transformed exactly
+    otherwise.
+    """
+    def __init__(self, transformer, max_error):
+        self.transformer = transformer
+        self.max_error = max_error
+        # the bounds covered by the last grid built, and this grid or None if none is precise enough
+        self._bounds = None
+        self._grid = None
+
+    def __getstate__(self):
+        # the grids are built again by each worker
+        return {'transformer': self.transformer, 'max_error': self.max_error}
+
+    def __setstate__(self, state):
+        self.__init__(state['transformer'], state['max_error'])
+
+    def _build_grid(self, mins, maxs):
+        for cell_count in GRID_RESOLUTIONS:
+            grid = _Grid(self.transformer, mins, maxs, cell_count)
+            # the interpolation error is the largest far from the nodes, at the center of the cells
+            cx, cy, cz = np.meshgrid(
+                mins[0] + (np.arange(cell_count) + 0.5) * grid.step[0],
+                mins[1] + (np.arange(cell_count) + 0.5) * grid.step[1],
+                [(mins[2] + maxs[2]) / 2],
+                indexing='ij')
+            if _max_error(self.transformer, grid, cx.ravel(), cy.ravel(), cz.ravel()) <= self.max_error:
+                return grid
+        return None
+
+    def transform(self, x, y, z):
+        x, y, z = (np.ascontiguousarray(c, dtype=np.float64) for c in (x, y, z))
+        if len(x) < MIN_POINT_COUNT:
+            return self.transformer.transform(x, y, z)
+
+        mins = np.array([np.min(x), np.min(y), np.min(z)])
+        maxs = np.array([np.max(x), np.max(y), np.max(z)])
+        if self._bounds is None or np.any(mins < self._bounds[0]) or np.any(maxs > self._bounds[1]):
+            margin = (maxs - mins) * GRID_MARGIN
+            # a flat pointcloud still needs 2 different heights
+            margin[2] = max(margin[2], 1)
+            self._bounds = (mins - margin, maxs + margin)
+            self._grid = self._build_grid(*self._bounds)
+        if self._grid is None:
+            return self.transformer.transform(x, y, z)
+
+        sample = np.linspace(0, len(x) - 1, SAMPLE_POINT_COUNT).astype(np.int64)
+        if _max_error(self.transformer, self._grid, x[sample], y[sample], z[sample]) > self.max_error:
+            return self.transformer.transform(x, y, z)
+
+        return tuple(self._grid.interpolate(x, y, z))
@@ -3,18 +3,25 @@ import time
 import gc
 import lz4.frame as gzip
 from sys import getsizeof
-from py3dtiles.points.utils import name_to_filename
+from py3dtiles.points.utils import link_or_copy, name_to_filename
 
 
 class SharedNodeStore:
-    def __init__(self, folder):
+    def __init__(self, folder, base_folder=None):
+        """
+        base_folder is an optional read only folder, where the nodes
+        not found in this store are looked for (see incremental conversions).
+        """
         self.metadata = {}
         self.data = []
         self.folder = folder
+        self.base_folder = base_folder
         self.stats = {
             'hit': 0,
             'miss': 0,
             'new': 0,
+            # the size of the nodes written to the disk to free memory
+            'spilled_bytes': 0,
         }
         self.memory_size = {
             'content': 0,
@@ -51,6 +58,8 @@ class SharedNodeStore:
             self.stats['hit'] += stat_inc
         else:
             filename = name_to_filename(self.folder, name)
+            if not os.path.exists(filename) and self.base_folder is not None:
+                filename = name_to_filename(self.base_folder, name)
             if os.path.exists(filename):
                 self.stats['miss'] += stat_inc
                 with open(filename, 'rb') as f:
@@ -91,6 +100,27 @@ class SharedNodeStore:
         self.memory_size['content'] += len(compressed_data) + getsizeof((name, metadata))
         self.memory_size['container'] = getsizeof(self.data) + getsizeof(self.metadata)
 
+    def checkpoint(self, folder):
+        """
+        Copy the content of the store in folder. The store remains usable.
+        """
+        in_memory = set(name_to_filename(self.folder, name) for name in self.metadata)
+
+        for root, _, files in os.walk(self.folder):
+            for filename in files:
+                path = os.path.join(root, filename)
+                # the in memory version of a node is more recent than the one on disk
+                if path in in_memory:
+                    continue
+                target = os.path.join(folder, os.path.relpath(path, self.folder))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # nodes are never modified in place (see _remove_all), so a link is enough
+                link_or_copy(path, target)
+
+        for name, meta in self.metadata.items():
+            with open(name_to_filename(folder, name), 'wb') as f:
+                f.write(self.data[meta[1]])
+
     def remove_oldest_nodes(self, percent):
         count = _remove_all(self)
 
@@ -115,10 +145,13 @@ def _remove_all(store):
     for name, meta in store.metadata.items():
         data = store.data[meta[1]]
         filename = name_to_filename(store.folder, name)
-        with open(filename, 'wb') as f:
+        # write a new file instead of overwriting the previous one, which can be linked by a checkpoint
+        with open(filename + '.tmp', 'wb') as f:
             bytes_written += f.write(data)
+        os.replace(filename + '.tmp', filename)
 
     store.metadata = {}
     store.data = []
+    store.stats['spilled_bytes'] += bytes_written
 
     return (count, bytes_written)
@@ -0,0 +1,208 @@
+import mmap
+import os
+import struct
+import uuid
+
+import numpy as np
+
+SPOOL_FOLDER = 'spool'
+
+# A task is a batch of points to insert in a node. It's sent in the messages as a list of frames, either:
+# - inline: the header frame followed by the xyz and rgb frames, with the raw arrays
+# - spooled: the header frame, followed by the name of the spool file containing the arrays at the header offset
+TASK_FORMAT_VERSION = 1
+_INLINE = 0
+_SPOOLED = 1
+# the attributes of the points: xyz as float32 then rgb as uint8
+_XYZ_RGB = 1
+# format version, kind, attribute layout, point count, offset in the spool file
+_TASK_HEADER = struct.Struct('>BBBIQ')
+# the xyz arrays are aligned in the spool files
+_ALIGNMENT = 16
+
+
+def _arrays(buffer, offset, point_count):
+    xyz = np.frombuffer(buffer, dtype=np.float32, count=point_count * 3, offset=offset).reshape((point_count, 3))
+    rgb = np.frombuffer(buffer, dtype=np.uint8, count=point_count * 3, offset=offset + xyz.nbytes).reshape((point_count, 3))
+    return xyz, rgb
+
+
+def _header(kind, point_count, offset=0):
+    return _TASK_HEADER.pack(TASK_FORMAT_VERSION, kind, _XYZ_RGB, point_count, offset)
+
+
+def _parse_header(header):
+    version, kind, layout, point_count, offset = _TASK_HEADER.unpack_from(header)
+    if version != TASK_FORMAT_VERSION or layout != _XYZ_RGB:
+        raise ValueError(f'Unsupported task format (version {version}, layout {layout}), '
+                         'the workers must use the same py3dtiles version as the conversion')
+    return kind, point_count, offset
+
+
+def task_point_count(task):
+    return _parse_header(task[0])[1]
+
+
+def task_frame_count(header):
+    """
+    Returns the number of frames of the task starting with the frame header.
+    """
+    return 3 if _parse_header(header)[0] == _INLINE else 1
+
+
+def split_tasks(frames, count):
+    """
+    Returns the count tasks at the start of frames, and the remaining frames.
+    """
+    tasks = []
+    i = 0
+    for _ in range(count):
+        frame_count = task_frame_count(frames[i])
+        tasks.append(frames[i:i + frame_count])
+        i += frame_count
+    return tasks, frames[i:]
+
+
+def spool_filename(task):
+    """
+    Returns the name of the spool file containing the points of task, or None if the task is inline.
+    """
+    if _parse_header(task[0])[0] != _SPOOLED:
+        return None
+    return bytes(task[0][_TASK_HEADER.size:]).decode('ascii')
+
+
+class Spool:
+    """
+    The point batches sent between the workers.
+
+    Instead of being sent in the messages, the points are written by the worker in a spool file of
+    folder (in the working directory of the conversion), and the messages only contain a handle to them.
+    The worker reading them maps the file in memory, without copy. Each job writes in its own file,
+    closed at the end of the job.
+
+    A Spool without folder (e.g. in a worker started on another host) sends the points inline.
+    """
+    def __init__(self, folder=None):
+        self.folder = folder
+        self.file = None
+        self.filename = None
+
+    def dumps(self, xyz, rgb):
+        """
+        Returns the frames of the task inserting the points xyz and rgb, to send with copy=False.
+        """
+        xyz = np.ascontiguousarray(xyz, dtype=np.float32)
+        rgb = np.ascontiguousarray(rgb, dtype=np.uint8)
+
+        if self.folder is None:
+            return [_header(_INLINE, len(xyz)), xyz, rgb]
+
+        if self.file is None:
+            os.makedirs(self.folder, exist_ok=True)
+            self.filename = uuid.uuid4().hex
+            # unbuffered, the points must be readable when the handle is sent
+            self.file = open(os.path.join(self.folder, self.filename), 'wb', buffering=0)
+
+        offset = self.file.tell()
+        padding = -offset % _ALIGNMENT
+        offset += padding
+        self.file.write(b'\0' * padding + xyz.tobytes() + rgb.tobytes())
+        return [_header(_SPOOLED, len(xyz), offset) + self.filename.encode('ascii')]
+
+    def loads(self, task):
+        """
+        Returns the (xyz, rgb) arrays of a task. The arrays are copy-on-write mappings of the spool file.
+        """
+        kind, point_count, offset = _parse_header(task[0])
+        if kind == _INLINE:
+            # the arrays must be writable to be used by the numba functions, so the frames are copied
+            return (
+                np.frombuffer(bytearray(task[1]), dtype=np.float32).reshape((point_count, 3)),
+                np.frombuffer(bytearray(task[2]), dtype=np.uint8).reshape((point_count, 3)),
+            )
+
+        with open(os.path.join(self.folder, spool_filename(task)), 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        return _arrays(buffer, offset, point_count)
+
+    def inline(self, task):
+        """
+        Returns the inline version of a task, to send it to a worker without access to the spool.
+        """
+        if spool_filename(task) is None:
+            return task
+        xyz, rgb = self.loads(task)
+        return [_header(_INLINE, len(xyz)), xyz.tobytes(), rgb.tobytes()]
+
+    def close(self):
+        """
+        Close the file of the current job. Returns its name, or None if no points were spooled.
+        """
+        if self.file is None:
+            return None
+        self.file.close()
+        filename = self.filename
+        self.file = None
+        self.filename = None
+        return filename
+
+
+class SpoolFiles:
+    """
+    Track the tasks of the spool files on the manager side, to remove the files when
+    their job is finished and all their tasks are processed.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        # the number of tasks not processed yet, by spool file
+        self.references = {}
+        # the spool files still written by a job
+        self.open_files = set()
+        # the tasks being processed, by node name
+        self.processing = {}
+
+    def add(self, task):
+        filename = spool_filename(task)
+        if filename is not None:
+            self.references[filename] = self.references.get(filename, 0) + 1
+            self.open_files.add(filename)
+
+    def restore(self, node_to_process):
+        """
+        Count the references of the tasks of node_to_process, saved in a checkpoint.
+        """
+        for tasks, _ in node_to_process.values():
+            for task in tasks:
+                filename = spool_filename(task)
+                if filename is not None:
+                    self.references[filename] = self.references.get(filename, 0) + 1
+
+    def process(self, node_name, tasks):
+        self.processing[node_name] = tasks
+
+    def cancel(self, node_name):
+        """
+        Forget the tasks of node_name being processed, they are queued again.
+        """
+        self.processing.pop(node_name, None)
+
+    def processed(self, node_name):
+        for task in self.processing.pop(node_name, ()):
+            filename = spool_filename(task)
+            if filename is not None:
+                self.references[filename] -= 1
+                self._remove_if_unused(filename)
+
+    def close(self, filename):
+        self.open_files.discard(filename)
+        self.references.setdefault(filename, 0)
+        self._remove_if_unused(filename)
+
+    def _remove_if_unused(self, filename):
+        if filename not in self.open_files and self.references[filename] == 0:
+            del self.references[filename]
+            try:
+                os.remove(os.path.join(self.folder, filename))
+            except FileNotFoundError:
+                pass
@@ -1,152 +1,295 @@
+import bisect
 import json
-import math
-import pickle
 import struct
 import subprocess
-import traceback
 
 import laspy
 import numpy as np
+from laspy import LazBackend
 
+try:
+    import lazrs
+except ImportError:
+    lazrs = None
+
+from py3dtiles.points.coordinates import to_octree_coordinates
+from py3dtiles.points.decimation import decimate
+from py3dtiles.points.header_cache import scan_files
 from py3dtiles.points.utils import ResponseType
 from py3dtiles.utils import SrsInMissingException
 
+# the number of points of the portions of the files read by a job
+PORTION_POINT_COUNT = 1_000_000
+# the chunk size of the LAZ files whose chunks have a variable number of points
+LAZ_VARIABLE_CHUNK_SIZE = 0xFFFFFFFF
+
+
+def _scan_header(filename):
+    with laspy.open(filename) as f:
+        # the LasZip VLR is removed from the header when the points are read
+        laz_chunks = _read_laz_chunks(filename, f.header)
+
+        # read the first points red channel
+        color_scale = None
+        if 'red' in f.header.point_format.dimension_names:
+            points = next(f.chunk_iterator(10_000))['red']
+            if np.max(points) > 255:
+                color_scale = 1.0 / 255
+        else:
+            # the intensity is then used as color
+            color_scale = 1.0 / 255
+
+        return {
+            'mins': list(f.header.mins),
+            'maxs': list(f.header.maxs),
+            'point_count': int(f.header.point_count),
+            'color_scale': color_scale,
+            'srs': _parse_srs(f.header),
+            'laz_chunks': laz_chunks,
+        }
+
+
+def _read_laz_chunks(filename, header):
+    """
+    Returns the chunks of a LAZ file: their point count if they all have the same, the start index of
+    each chunk if their point count is variable, or None for the las files (or if lazrs is needed to read
+    the chunk table and isn't installed).
+    """
+    if not header.are_points_compressed:
+        return None
+    laszip_vlr = next(vlr for vlr in header.vlrs if vlr.record_id == 22204)
+    # compressor, coder, version major, minor and revision, options, then the chunk size
+    chunk_size = struct.unpack_from('<I', laszip_vlr.record_data, 12)[0]
+    if chunk_size != LAZ_VARIABLE_CHUNK_SIZE:
+        return chunk_size
+    if lazrs is None:
+        return None
+
+    with open(filename, 'rb') as f:
+        f.seek(header.offset_to_point_data)
+        chunk_table = lazrs.read_chunk_table(f, lazrs.LazVlr(laszip_vlr.record_data))
+    return [0] + list(np.cumsum([point_count for point_count, _ in chunk_table[:-1]]).tolist())
+
 
-def init(files, color_scale=None, srs_in=None, srs_out=None, fraction=100):
+def laz_chunk_bounds(laz_chunks, index):
+    """
+    Returns the start of the LAZ chunk containing the point index (see _read_laz_chunks),
+    and the start of the next chunk (None for the last chunk of a file with chunks of variable size).
+    """
+    if isinstance(laz_chunks, int):
+        start = index - index % laz_chunks
+        return start, start + laz_chunks
+    i = bisect.bisect_right(laz_chunks, index) - 1
+    return laz_chunks[i], laz_chunks[i + 1] if i + 1 < len(laz_chunks) else None
+
+
+def _portions(point_count, laz_chunks):
+    """
+    Returns the portions of about PORTION_POINT_COUNT points of a file. The portions of a LAZ file
+    start at the beginning of a chunk, so that their readers don't decompress a chunk partially.
+    """
+    starts = list(range(0, point_count, PORTION_POINT_COUNT))
+    if laz_chunks is not None:
+        starts = sorted({laz_chunk_bounds(laz_chunks, start)[0] for start in starts})
+    return [(start, end) for start, end in zip(starts, starts[1:] + [point_count])]
+
+
+def _parse_srs(header):
+    """
+    Returns the srs declared in the OGC WKT or GeoTIFF keys (VLR or EVLR) of the header as WKT, or None.
+    """
+    try:
+        crs = header.parse_crs()
+    except Exception:
+        # e.g. GeoTIFF keys unknown to pyproj, pdal may still read them
+        return None
+    return crs.to_wkt() if crs is not None else None
+
+
+def _pdal_srs(filename):
+    output = subprocess.check_output(['pdal', 'info', '--summary', filename])
+    summary = json.loads(output)['summary']
+    if 'srs' not in summary or not summary['srs'].get('proj4'):
+        raise SrsInMissingException(f"'{filename}' file doesn't contain srs information."
+                                    "Please use the --srs_in option to declare it.")
+    return summary['srs']['proj4']
+
+
+def _read_pdal_srs(filename, header_cache):
+    srs = scan_files([filename], 'pdal_srs', _pdal_srs, header_cache)[0]
+    if isinstance(srs, Exception):
+        print(f'Error reading the srs of {filename}.')
+        print(srs)
+        return None
+    return srs
+
+
+def init(files, color_scale=None, srs_in=None, srs_out=None, fraction=100, header_cache=None):
     aabb = None
     total_point_count = 0
     pointcloud_file_portions = []
     avg_min = np.array([0., 0., 0.])
     color_scale_by_file = {}
+    laz_chunks_by_file = {}
 
-    for filename in files:
-        try:
-            with laspy.open(filename) as f:
-                avg_min += (np.array(f.header.mins) / len(files))
-
-                if aabb is None:
-                    aabb = np.array([f.header.mins, f.header.maxs])
-                else:
-                    bb = np.array([f.header.mins, f.header.maxs])
-                    aabb[0] = np.minimum(aabb[0], bb[0])
-                    aabb[1] = np.maximum(aabb[1], bb[1])
-
-                count = f.header.point_count * fraction // 100
-                total_point_count += count
-
-                # read the first points red channel
-                if color_scale:
-                    color_scale_by_file[filename] = color_scale
-                elif 'red' in f.header.point_format.dimension_names:
-                    points = next(f.chunk_iterator(10_000))['red']
-                    if np.max(points) > 255:
-                        color_scale_by_file[filename] = 1.0 / 255
-                else:
-                    # the intensity is then used as color
-                    color_scale_by_file[filename] = 1.0 / 255
-
-                _1M = min(count, 1_000_000)
-                steps = math.ceil(count / _1M)
-                portions = [(i * _1M, min(count, (i + 1) * _1M)) for i in range(steps)]
-                for p in portions:
-                    pointcloud_file_portions += [(filename, p)]
-
-                if srs_out and not srs_in:
-                    output = subprocess.check_output(['pdal', 'info', '--summary', filename])
-                    summary = json.loads(output)['summary']
-                    if 'srs' not in summary or not summary['srs'].get('proj4'):
-                        raise SrsInMissingException(f"'{filename}' file doesn't contain srs information."
-                                                    "Please use the --srs_in option to declare it.")
-                    srs_in = summary['srs']['proj4']
-        except Exception as e:
+    headers = scan_files(files, 'las', _scan_header, header_cache)
+    for filename, header in zip(files, headers):
+        if isinstance(header, Exception):
             print(f'Error opening {filename}. Skipping.')
-            print(e)
+            print(header)
             continue
 
+        mins, maxs = np.array(header['mins']), np.array(header['maxs'])
+        avg_min += (mins / len(files))
+
+        if aabb is None:
+            aabb = np.array([mins, maxs])
+        else:
+            aabb[0] = np.minimum(aabb[0], mins)
+            aabb[1] = np.maximum(aabb[1], maxs)
+
+        count = header['point_count']
+        # the points are decimated when they are read
+        total_point_count += count * fraction // 100
+
+        if color_scale:
+            color_scale_by_file[filename] = color_scale
+        elif header['color_scale']:
+            color_scale_by_file[filename] = header['color_scale']
+
+        if header['laz_chunks'] is not None:
+            laz_chunks_by_file[filename] = header['laz_chunks']
+        for p in _portions(count, header['laz_chunks']):
+            pointcloud_file_portions += [(filename, p)]
+
+    if srs_out and not srs_in:
+        # the srs of the first file is used for all of them
+        readable_files = [(filename, header) for filename, header in zip(files, headers)
+                          if not isinstance(header, Exception)]
+        if readable_files:
+            filename, header = readable_files[0]
+            # pdal is used when the srs of the header can't be parsed
+            srs_in = header['srs'] or _read_pdal_srs(filename, header_cache)
+
     return {
         'portions': pointcloud_file_portions,
         'aabb': aabb,
         'color_scale': color_scale_by_file,
+        'laz_chunks': laz_chunks_by_file,
         'srs_in': srs_in,
         'point_count': total_point_count,
         'avg_min': avg_min
     }
 
 
-def run(filename, offset_scale, portion, queue, transformer, verbose):
+def _color_dimensions(point_format):
+    if 'red' in point_format.dimension_names:
+        return 'red', 'green', 'blue'
+    # the intensity is then used as color
+    return 'intensity', 'intensity', 'intensity'
+
+
+def _read_laspy(f, portion, step):
     """
-    Reads points from a las file
+    Yields (x, y, z, red, green, blue) for each step points of the portion, decoded by laspy.
     """
-    try:
-        with laspy.open(filename) as f:
+    color_dimensions = _color_dimensions(f.header.point_format)
+    # the portion is read sequentially, a LAZ file is decompressed from the start of the chunk of a seek
+    f.seek(portion[0])
+    for start in range(portion[0], portion[1], step):
+        points = f.read_points(min(step, portion[1] - start))
+        yield (np.asarray(points.x), np.asarray(points.y), np.asarray(points.z),
+               *(np.asarray(points[dimension]) for dimension in color_dimensions))
 
-            point_count = portion[1] - portion[0]
 
-            step = min(point_count, max(point_count // 10, 100_000))
+def _read_mapped(filename, header, portion, step):
+    """
+    Yields (x, y, z, red, green, blue) for each step points of the portion of an uncompressed file.
 
-            indices = [i for i in range(math.ceil(point_count / step))]
+    The point records are memory mapped with a dtype containing only these dimensions, so they are
+    read from the page cache without decoding the other dimensions of the records.
+    """
+    color_dimensions = _color_dimensions(header.point_format)
+    names = ['X', 'Y', 'Z'] + sorted(set(color_dimensions))
+    record_dtype = header.point_format.dtype()
+    dtype = np.dtype({
+        'names': names,
+        'formats': [record_dtype.fields[name][0] for name in names],
+        'offsets': [record_dtype.fields[name][1] for name in names],
+        # the point data record length, with the extra bytes
+        'itemsize': header.point_format.size,
+    })
+    records = np.memmap(filename, dtype=dtype, mode='r', offset=header.offset_to_point_data,
+                        shape=(header.point_count,))
+    scales, offsets = header.scales, header.offsets
+    for start in range(portion[0], portion[1], step):
+        chunk = records[start:min(start + step, portion[1])]
+        yield (chunk['X'] * scales[0] + offsets[0], chunk['Y'] * scales[1] + offsets[1], chunk['Z'] * scales[2] + offsets[2],
+               *(np.asarray(chunk[dimension]) for dimension in color_dimensions))
 
-            color_scale = offset_scale[3]
 
-            for index in indices:
-                start_offset = portion[0] + index * step
-                num = min(step, portion[1] - start_offset)
+def run(filename, offset_scale, portion, queue, spool, transformer, verbose, decimation=None, laz_threads=1):
+    """
+    Reads points from a las file
 
-                # read scaled values and apply offset
-                f.seek(start_offset)
-                points = next(f.chunk_iterator(num))
+    decimation is None to read all the points, or (mode, fraction) to keep only fraction % of them
+    (see py3dtiles.points.decimation).
+    laz_threads is the number of cpus available to decompress the LAZ chunks: they are decompressed in parallel
+    if it's more than 1 and lazrs is installed.
+    """
+    laz_backend = LazBackend.Lazrs
+    if laz_threads > 1 and LazBackend.LazrsParallel.is_available():
+        # the size of the thread pool of lazrs is set by the worker processes, see zmq_process
+        laz_backend = LazBackend.LazrsParallel
+    if not laz_backend.is_available():
+        laz_backend = None
 
-                x, y, z = points.x, points.y, points.z
-                if transformer:
-                    x, y, z = transformer.transform(x, y, z)
+    with laspy.open(filename, laz_backend=laz_backend) as f:
 
-                x = (x + offset_scale[0][0]) * offset_scale[1][0]
-                y = (y + offset_scale[0][1]) * offset_scale[1][1]
-                z = (z + offset_scale[0][2]) * offset_scale[1][2]
+        point_count = portion[1] - portion[0]
 
-                coords = np.vstack((x, y, z)).transpose()
+        step = min(point_count, max(point_count // 10, 100_000))
+        if not f.header.are_points_compressed:
+            chunks = _read_mapped(filename, f.header, portion, step)
+        else:
+            if laz_backend == LazBackend.LazrsParallel:
+                # the chunks of a read are decompressed in parallel
+                step = point_count
+            chunks = _read_laspy(f, portion, step)
 
-                if offset_scale[2] is not None:
-                    # Apply transformation matrix (because the tile's transform will contain
-                    # the inverse of this matrix)
-                    coords = np.dot(coords, offset_scale[2])
+        color_scale = offset_scale[3]
 
-                coords = np.ascontiguousarray(coords.astype(np.float32))
+        for index, (x, y, z, red, green, blue) in enumerate(chunks):
+            if decimation is not None:
+                kept = decimate(np.vstack((x, y, z)).transpose(), decimation[1], decimation[0], portion[0] + index * step)
+                if len(kept) == 0:
+                    continue
+                x, y, z, red, green, blue = x[kept], y[kept], z[kept], red[kept], green[kept], blue[kept]
 
-                # Read colors
+            if transformer:
+                x, y, z = transformer.transform(x, y, z)
 
-                # todo: attributes
-                if 'red' in f.header.point_format.dimension_names:
-                    red = points['red']
-                    green = points['green']
-                    blue = points['blue']
-                else:
-                    red = points['intensity']
-                    green = points['intensity']
-                    blue = points['intensity']
+            # the rotation matrix is applied too, because the tile's transform will contain its inverse
+            coords = to_octree_coordinates(x, y, z, offset_scale)
 
-                if not color_scale:
-                    red = red.astype(np.uint8)
-                    green = green.astype(np.uint8)
-                    blue = blue.astype(np.uint8)
-                else:
-                    red = (red * color_scale).astype(np.uint8)
-                    green = (green * color_scale).astype(np.uint8)
-                    blue = (blue * color_scale).astype(np.uint8)
+            # Read colors
 
-                colors = np.vstack((red, green, blue)).transpose()
+            # todo: attributes
+            if not color_scale:
+                red = red.astype(np.uint8)
+                green = green.astype(np.uint8)
+                blue = blue.astype(np.uint8)
+            else:
+                red = (red * color_scale).astype(np.uint8)
+                green = (green * color_scale).astype(np.uint8)
+                blue = (blue * color_scale).astype(np.uint8)
 
-                queue.send_multipart(
-                    [
-                        ResponseType.NEW_TASK.value,
-                        ''.encode('ascii'),
-                        pickle.dumps({'xyz': coords, 'rgb': colors}),
-                        struct.pack('>I', len(coords))
-                    ], copy=False)
+            colors = np.vstack((red, green, blue)).transpose()
 
-            queue.send_multipart([ResponseType.READ.value])
+            queue.send_multipart(
+                [
+                    ResponseType.NEW_TASK.value,
+                    ''.encode('ascii'),
+                ] + spool.dumps(coords, colors), copy=False)
 
-    except Exception as e:
-        print('Exception while reading points from las file')
-        print(e)
-        traceback.print_exc()
+        queue.send_multipart([ResponseType.READ.value])
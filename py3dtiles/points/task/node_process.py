@@ -1,37 +1,34 @@
 import os
-import pickle
 import struct
 import time
-import traceback
 
 from py3dtiles.points.node_catalog import NodeCatalog
+from py3dtiles.points.spool import split_tasks, task_point_count
 from py3dtiles.points.utils import ResponseType
 
 
-def _forward_unassigned_points(node, queue, log_file):
+def _forward_unassigned_points(node, queue, spool, log_file):
     total = 0
 
     result = node.dump_pending_points()
 
-    for r in result:
-        if len(r) > 0:
-            if log_file is not None:
-                print('    -> put on queue ({},{})'.format(r[0], r[2]), file=log_file)
-            total += r[2]
-            queue.send_multipart([
-                ResponseType.NEW_TASK.value,
-                r[0],
-                r[1],
-                struct.pack('>I', r[2])], copy=False, block=False)
+    for name, xyz, rgb in result:
+        if log_file is not None:
+            print('    -> put on queue ({},{})'.format(name, len(xyz)), file=log_file)
+        total += len(xyz)
+        queue.send_multipart([
+            ResponseType.NEW_TASK.value,
+            name,
+        ] + spool.dumps(xyz, rgb), copy=False, block=False)
 
     return total
 
 
-def _flush(node_catalog, scale, node, queue, max_depth=1, force_forward=False, log_file=None, depth=0):
+def _flush(node_catalog, scale, node, queue, spool, max_depth=1, force_forward=False, log_file=None, depth=0):
     if depth >= max_depth:
         threshold = 0 if force_forward else 10_000
         if node.get_pending_points_count() > threshold:
-            return _forward_unassigned_points(node, queue, log_file)
+            return _forward_unassigned_points(node, queue, spool, log_file)
         else:
             return 0
 
@@ -44,7 +41,8 @@ def _flush(node_catalog, scale, node, queue, max_depth=1, force_forward=False, l
         # release node
         del node
         for name in children:
-            total += _flush(node_catalog, scale, node_catalog.get_node(name), queue, max_depth, force_forward, log_file, depth + 1)
+            total += _flush(
+                node_catalog, scale, node_catalog.get_node(name), queue, spool, max_depth, force_forward, log_file, depth + 1)
 
     return total
 
@@ -70,7 +68,7 @@ def _balance(node_catalog, node, max_depth=1, depth=0):
                 depth + 1)
 
 
-def _process(nodes, octree_metadata, name, raw_datas, queue, begin, log_file):
+def _process(nodes, octree_metadata, name, raw_datas, queue, spool, begin, log_file):
     node_catalog = NodeCatalog(nodes, name, octree_metadata)
 
     log_enabled = log_file is not None
@@ -99,9 +97,9 @@ def _process(nodes, octree_metadata, name, raw_datas, queue, begin, log_file):
         if log_enabled:
             print('  -> read source [{}]'.format(time.time() - begin), file=log_file, flush=True)
 
-        data = pickle.loads(raw_data)
+        xyz, rgb = spool.loads(raw_data)
 
-        point_count = len(data['xyz'])
+        point_count = len(xyz)
 
         if log_enabled:
             print('  -> insert {} [{} points]/ {} files [{}]'.format(
@@ -109,7 +107,7 @@ def _process(nodes, octree_metadata, name, raw_datas, queue, begin, log_file):
                 len(raw_datas), time.time() - begin), file=log_file, flush=True)
 
         # insert points in node (no children handling here)
-        node.insert(node_catalog, octree_metadata.scale, data['xyz'], data['rgb'], halt_at_depth == 0)
+        node.insert(node_catalog, octree_metadata.scale, xyz, rgb, halt_at_depth == 0)
 
         total += point_count
 
@@ -117,7 +115,8 @@ def _process(nodes, octree_metadata, name, raw_datas, queue, begin, log_file):
             print('  -> _flush [{}]'.format(time.time() - begin), file=log_file, flush=True)
         # _flush push pending points (= call insert) from level N to level N + 1
         # (_flush is recursive)
-        written = _flush(node_catalog, octree_metadata.scale, node, queue, halt_at_depth - 1, index == len(raw_datas) - 1, log_file)
+        written = _flush(
+            node_catalog, octree_metadata.scale, node, queue, spool, halt_at_depth - 1, index == len(raw_datas) - 1, log_file)
         total -= written
 
         index += 1
@@ -139,49 +138,41 @@ def _process(nodes, octree_metadata, name, raw_datas, queue, begin, log_file):
     return total, data
 
 
-def run(work, octree_metadata, queue, verbose):
-    try:
-        begin = time.time()
-        log_enabled = verbose >= 2
-        if log_enabled:
-            log_filename = 'py3dtiles-{}.log'.format(os.getpid())
-            log_file = open(log_filename, 'a')
+def run(work, octree_metadata, queue, spool, verbose, tracer=None):
+    begin = time.time()
+    log_enabled = verbose >= 2
+    if log_enabled:
+        log_filename = 'py3dtiles-{}.log'.format(os.getpid())
+        log_file = open(log_filename, 'a')
+    else:
+        log_file = None
+
+    total = 0
+
+    while work:
+        name = work[0]
+        node = work[1]
+        count = struct.unpack('>I', work[2])[0]
+        tasks, work = split_tasks(work[3:], count)
+        if tracer is None:
+            result, data = _process(node, octree_metadata, name, tasks, queue, spool, begin, log_file)
         else:
-            log_file = None
-
-        total = 0
-
-        i = 0
-        while i < len(work):
-            name = work[i]
-            node = work[i + 1]
-            count = struct.unpack('>I', work[i + 2])[0]
-            filenames = work[i + 3:i + 3 + count]
-            i += 3 + count
-            result, data = _process(node, octree_metadata, name, filenames, queue, begin, log_file)
-            total += result
-
-            queue.send_multipart([ResponseType.PROCESSED.value, pickle.dumps({
-                'name': name,
-                'total': result,
-                'save': data,
-            })], copy=False)
+            with tracer.span('r' + name.decode('ascii'), 'process',
+                             task_count=count, point_count=sum(task_point_count(task) for task in tasks)):
+                result, data = _process(node, octree_metadata, name, tasks, queue, spool, begin, log_file)
+        total += result
 
-        if log_enabled:
-            print('[<] return result [{} sec] [{}]'.format(
-                round(time.time() - begin, 2),
-                time.time() - begin), file=log_file, flush=True)
-            if log_file is not None:
-                log_file.close()
-
-        return total
-
-    except Exception as e:
-        if log_enabled or True:
-            print('OH NO. {}'.format(name))
-        if log_enabled or True:
-            print(e)
-        if log_enabled or True:
-            traceback.print_exc()
-
-    return 0
+        queue.send_multipart([
+            ResponseType.PROCESSED.value,
+            name,
+            struct.pack('>I', result),
+            data], copy=False)
+
+    if log_enabled:
+        print('[<] return result [{} sec] [{}]'.format(
+            round(time.time() - begin, 2),
+            time.time() - begin), file=log_file, flush=True)
+        if log_file is not None:
+            log_file.close()
+
+    return total
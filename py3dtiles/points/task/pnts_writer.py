@@ -1,3 +1,4 @@
+import os
 import pickle
 import struct
 from pathlib import Path
@@ -19,7 +20,7 @@ class _DummyNode:
             self.points = _bytes['points']
 
 
-def points_to_pnts(name, points, out_folder, include_rgb):
+def points_to_pnts(name, points, out_folder, include_rgb, overwrite=False):
     count = int(len(points) / (3 * 4 + (3 if include_rgb else 0)))
 
     if count == 0:
@@ -43,26 +44,40 @@ def points_to_pnts(name, points, out_folder, include_rgb):
     filename = name_to_filename(out_folder, name, '.pnts')
 
     if Path(filename).exists():
-        raise FileExistsError(f"{filename} already written")
+        if not overwrite:
+            raise FileExistsError(f"{filename} already written")
+        os.remove(filename)
 
     tile.save_as(filename)
 
     return count, filename
 
 
-def node_to_pnts(name, node, out_folder, include_rgb):
+def node_to_pnts(name, node, out_folder, include_rgb, overwrite=False):
     points = py3dtiles.points.node.Node.get_points(node, include_rgb)
-    return points_to_pnts(name, points, out_folder, include_rgb)
-
-
-def run(sender, data, node_name, folder, write_rgb):
+    return points_to_pnts(name, points, out_folder, include_rgb, overwrite)
+
+
+def write(data, folder, write_rgb, overwrite=False):
+    """
+    Write the .pnts files of the nodes stored in data (see SharedNodeStore)
+    and returns the number of points written.
+    """
+    root = pickle.loads(gzip.decompress(data))
+    total = 0
+    for name in root:
+        node = _DummyNode(pickle.loads(root[name]))
+        total += node_to_pnts(name, node, folder, write_rgb, overwrite)[0]
+    return total
+
+
+def run(sender, data, node_name, folder, write_rgb, overwrite=False):
+    """
+    Write the .pnts files of data and returns the number of points written.
+    """
     # we can safely write the .pnts file
-    if len(data):
-        root = pickle.loads(gzip.decompress(data))
-        # print('write ', node_name.decode('ascii'))
-        total = 0
-        for name in root:
-            node = _DummyNode(pickle.loads(root[name]))
-            total += node_to_pnts(name, node, folder, write_rgb)[0]
-
-        sender.send_multipart([ResponseType.PNTS_WRITTEN.value, struct.pack('>I', total), node_name])
+    if not len(data):
+        return 0
+    total = write(data, folder, write_rgb, overwrite)
+    sender.send_multipart([ResponseType.PNTS_WRITTEN.value, struct.pack('>I', total), node_name])
+    return total
@@ -1,70 +1,176 @@
+import functools
+import multiprocessing
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-import math
-import traceback
-import struct
-import pickle
 
+from py3dtiles.points.coordinates import to_octree_coordinates
+from py3dtiles.points.decimation import decimate
+from py3dtiles.points.header_cache import scan_files
 from py3dtiles.points.utils import ResponseType
 
 
-def init(files, color_scale=None, srs_in=None, srs_out=None, fraction=100):
-    aabb = None
-    total_point_count = 0
-    pointcloud_file_portions = []
+# the xyz files are read by blocks of about these sizes, ending at the end of a line: the blocks scanned
+# to find the bounding box of the files, and the blocks read and sent at once by the READ_FILE jobs
+SCAN_BLOCK_SIZE = 16 * 1024 * 1024
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+# the minimal number of points of the portions of the files read by a job
+PORTION_POINT_COUNT = 1_000_000
+# the number of values by line of the XYZIRGB format
+FEATURE_COUNT = 7
+
+
+def _block_bounds(filename, block_size):
+    """
+    Returns the (start, end) byte offsets of the blocks of about block_size bytes of the file,
+    each block ending at the end of a line.
+    """
+    bounds = []
+    with open(filename, 'rb') as f:
+        size = f.seek(0, 2)
+        start = 0
+        while start < size:
+            f.seek(min(start + block_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            bounds.append((start, end))
+            start = end
+    return bounds
+
+
+def _parse_lines(data):
+    points = []
+    for line in data.decode().splitlines():
+        line_features = [float(s) for s in line.split()]
+        if len(line_features) == 3:
+            line_features += [None] * 4  # Insert intensity and RGB
+        elif len(line_features) == 4:
+            line_features += [None] * 3  # Insert RGB
+        elif len(line_features) == 6:
+            line_features.insert(3, None)  # Insert intensity
+        points.append(line_features)
+    return np.array(points, dtype=np.float64).reshape((-1, FEATURE_COUNT))
+
+
+def _parse(data):
+    """
+    Returns the points of data, the bytes of whole lines of a xyz file, as a n x 7 XYZIRGB array
+    (see run), the missing values being nan.
 
-    for filename in files:
+    data doesn't end with a newline. The values are parsed at once by numpy if all the lines have
+    the same number of values, and line by line otherwise.
+    """
+    if not data:
+        return np.empty((0, FEATURE_COUNT))
+    lines = data.count(b'\n') + 1
+    column_count = len(data[:data.find(b'\n')].split())
+    if column_count in (3, 4, 6, 7):
         try:
-            f = open(filename)
-        except Exception as e:
-            print(f"Error opening {filename}. Skipping.")
-            print(e)
+            with warnings.catch_warnings():
+                # a value which isn't a number stops the parsing with a warning
+                warnings.simplefilter('ignore', DeprecationWarning)
+                values = np.fromstring(data, sep=' ')
+        except ValueError:
+            values = None
+        if values is not None and len(values) == lines * column_count:
+            values = values.reshape((lines, column_count))
+            if column_count == FEATURE_COUNT:
+                return values
+            points = np.full((lines, FEATURE_COUNT), np.nan)
+            points[:, :3] = values[:, :3]
+            if column_count == 4:
+                points[:, 3] = values[:, 3]
+            elif column_count == 6:
+                points[:, 4:] = values[:, 3:]
+            return points
+    return _parse_lines(data)
+
+
+def _read_block(f, start, end):
+    f.seek(start)
+    return f.read(end - start).rstrip()
+
+
+def _scan_block(filename, bounds):
+    with open(filename, 'rb') as f:
+        points = _parse(_read_block(f, *bounds))
+    if len(points) == 0:
+        return 0, None
+    return len(points), [np.min(points[:, :3], axis=0).tolist(), np.max(points[:, :3], axis=0).tolist()]
+
+
+def _scan_file(filename, executor=None):
+    """
+    Returns the bounding box, the point count and the portions of the file, scanning its blocks
+    in the process pool executor if there are several of them.
+    """
+    bounds = _block_bounds(filename, SCAN_BLOCK_SIZE)
+    if executor is not None and len(bounds) > 1:
+        blocks = executor.map(_scan_block, [filename] * len(bounds), bounds)
+    else:
+        blocks = map(_scan_block, [filename] * len(bounds), bounds)
+
+    aabb = None
+    count = 0
+    portions = []
+    for (block_start, _), (block_count, block_aabb) in zip(bounds, blocks):
+        if block_count == 0:
             continue
+        if not portions or portions[-1][1] - portions[-1][0] >= PORTION_POINT_COUNT:
+            portions.append([count, count, block_start])
+        count += block_count
+        portions[-1][1] = count
 
-        count = 0
-        seek_values = []
-        while True:
-            batch = 10_000
-            points = np.zeros((batch, 3))
-
-            offset = f.tell()
-            for i in range(batch):
-                line = f.readline()
-                if not line:
-                    points = np.resize(points, (i, 3))
-                    break
-                points[i] = [float(s) for s in line.split(" ")][:3]
-
-            if points.shape[0] == 0:
-                break
+        if aabb is None:
+            aabb = np.array(block_aabb)
+        else:
+            aabb[0] = np.minimum(aabb[0], block_aabb[0])
+            aabb[1] = np.maximum(aabb[1], block_aabb[1])
+
+    return {
+        "aabb": aabb.tolist() if aabb is not None else None,
+        "point_count": count,
+        "portions": portions,
+    }
 
-            if not count % 1_000_000:
-                seek_values += [offset]
 
-            count += points.shape[0]
-            batch_aabb = np.array([
-                np.min(points, axis=0), np.max(points, axis=0)
-            ])
+def init(files, color_scale=None, srs_in=None, srs_out=None, fraction=100, header_cache=None):
+    aabb = None
+    total_point_count = 0
+    pointcloud_file_portions = []
 
-            # Update aabb
+    # the xyz files have no header, they are read entirely to find their bounding box and point count,
+    # the blocks of the big files being parsed in parallel
+    executor = None
+    if multiprocessing.cpu_count() > 1 and any(os.path.getsize(f) > SCAN_BLOCK_SIZE for f in files if os.path.isfile(f)):
+        executor = ProcessPoolExecutor()
+    try:
+        scans = scan_files(files, "xyz", functools.partial(_scan_file, executor=executor), header_cache)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    for filename, scan in zip(files, scans):
+        if isinstance(scan, Exception):
+            print(f"Error opening {filename}. Skipping.")
+            print(scan)
+            continue
+
+        count = scan["point_count"]
+        if scan["aabb"] is not None:
+            file_aabb = np.array(scan["aabb"])
             if aabb is None:
-                aabb = batch_aabb
+                aabb = file_aabb
             else:
-                aabb[0] = np.minimum(aabb[0], batch_aabb[0])
-                aabb[1] = np.maximum(aabb[1], batch_aabb[1])
-
-        # We need an exact point count
-        total_point_count += count * fraction / 100
-
-        _1M = min(count, 1_000_000)
-        steps = math.ceil(count / _1M)
-        if steps != len(seek_values):
-            raise ValueError("the size of seek_values should be equal to steps,"
-                             f"currently steps = {steps} and len(seek_values) = {len(seek_values)}")
-        portions = [
-            (i * _1M, min(count, (i + 1) * _1M), seek_values[i]) for i in range(steps)
-        ]
-        for p in portions:
-            pointcloud_file_portions += [(filename, p)]
+                aabb[0] = np.minimum(aabb[0], file_aabb[0])
+                aabb[1] = np.maximum(aabb[1], file_aabb[1])
+
+        # We need an exact point count, the points are decimated when they are read
+        total_point_count += count * fraction // 100
+
+        for p in scan["portions"]:
+            pointcloud_file_portions += [(filename, tuple(p))]
 
         if srs_out and not srs_in:
             raise Exception(
@@ -82,7 +188,7 @@ def init(files, color_scale=None, srs_in=None, srs_out=None, fraction=100):
     }
 
 
-def run(filename, offset_scale, portion, queue, transformer, verbose):
+def run(filename, offset_scale, portion, queue, spool, transformer, verbose, decimation=None):
     """
     Reads points from a xyz file
 
@@ -94,52 +200,39 @@ def run(filename, offset_scale, portion, queue, transformer, verbose):
     - 6 features mean XYZRGB
 
     (*) See: https://docs.safe.com/fme/html/FME_Desktop_Documentation/FME_ReadersWriters/pointcloudxyz/pointcloudxyz.htm
-    """
-    try:
-        f = open(filename, "r")
 
-        point_count = portion[1] - portion[0]
+    decimation is None to read all the points, or (mode, fraction) to keep only fraction % of them
+    (see py3dtiles.points.decimation).
 
-        step = min(point_count, max((point_count) // 10, 100000))
+    The portion is (first point, end point, offset of the first point in the file), and its
+    points are parsed and sent by blocks of READ_BLOCK_SIZE bytes.
+    """
+    point_count = portion[1] - portion[0]
 
+    with open(filename, "rb") as f:
         f.seek(portion[2])
+        i = 0
+        while i < point_count:
+            # a block of whole lines
+            data = f.read(READ_BLOCK_SIZE) + f.readline()
+            if not data:
+                break
+            points = _parse(data.rstrip())[:point_count - i]
+            start = i
+            i += len(points)
 
-        feature_nb = 7
-
-        for i in range(0, point_count, step):
-            points = np.zeros((step, feature_nb), dtype=np.float32)
-
-            for j in range(0, step):
-                line = f.readline()
-                if not line:
-                    points = np.resize(points, (j, feature_nb))
-                    break
-                line_features = [float(s) for s in line.split(" ")]
-                if len(line_features) == 3:
-                    line_features += [None] * 4  # Insert intensity and RGB
-                elif len(line_features) == 4:
-                    line_features += [None] * 3  # Insert RGB
-                elif len(line_features) == 6:
-                    line_features.insert(3, None)  # Insert intensity
-                points[j] = line_features
+            if decimation is not None:
+                points = points[decimate(points[:, :3], decimation[1], decimation[0], portion[0] + start)]
+                if len(points) == 0:
+                    continue
 
             x, y, z = [points[:, c] for c in [0, 1, 2]]
 
             if transformer:
                 x, y, z = transformer.transform(x, y, z)
 
-            x = (x + offset_scale[0][0]) * offset_scale[1][0]
-            y = (y + offset_scale[0][1]) * offset_scale[1][1]
-            z = (z + offset_scale[0][2]) * offset_scale[1][2]
-
-            coords = np.vstack((x, y, z)).transpose()
-
-            if offset_scale[2] is not None:
-                # Apply transformation matrix (because the tile's transform will contain
-                # the inverse of this matrix)
-                coords = np.dot(coords, offset_scale[2])
-
-            coords = np.ascontiguousarray(coords.astype(np.float32))
+            # the rotation matrix is applied too, because the tile's transform will contain its inverse
+            coords = to_octree_coordinates(x, y, z, offset_scale)
 
             # Read colors: 3 last columns of the point cloud
             colors = points[:, -3:].astype(np.uint8)
@@ -148,16 +241,8 @@ def run(filename, offset_scale, portion, queue, transformer, verbose):
                 [
                     ResponseType.NEW_TASK.value,
                     "".encode("ascii"),
-                    pickle.dumps({"xyz": coords, "rgb": colors}),
-                    struct.pack(">I", len(coords)),
-                ],
+                ] + spool.dumps(coords, colors),
                 copy=False,
             )
 
-        queue.send_multipart([ResponseType.READ.value])
-
-        f.close()
-    except Exception as e:
-        print("Exception while reading points from xyz file")
-        print(e)
-        traceback.print_exc()
+    queue.send_multipart([ResponseType.READ.value])
@@ -0,0 +1,67 @@
+import json
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+
+def _microseconds(seconds):
+    return int(seconds * 1_000_000)
+
+
+class Tracer:
+    """
+    The timeline of the jobs of a conversion, in the Chrome trace event format.
+
+    Each worker records a span for each job it runs (a span for each node for the PROCESS_JOBS
+    jobs) and sends them to the manager, which merges them in a single file. This file can be opened
+    in Perfetto (https://ui.perfetto.dev) or chrome://tracing, with a track by worker process.
+    """
+    def __init__(self, process_name):
+        self.pid = os.getpid()
+        # the name of the track of the process
+        self.events = [{
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': self.pid,
+            'args': {'name': f'{process_name} {socket.gethostname()}:{self.pid}'},
+        }]
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """
+        Record a span named name lasting as long as the with block.
+
+        The with block gets the args of the span, to add its results to them.
+        """
+        start = time.time()
+        try:
+            yield args
+        finally:
+            self.events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': _microseconds(start),
+                'dur': _microseconds(time.time() - start),
+                'pid': self.pid,
+                'tid': self.pid,
+                'args': args,
+            })
+
+    def pop_events(self):
+        """
+        Returns the events recorded since the last call, encoded to be sent to the manager.
+        """
+        events, self.events = self.events, []
+        return json.dumps(events).encode('utf-8')
+
+    def add_events(self, data):
+        """
+        Add the events sent by a worker (see pop_events).
+        """
+        self.events += json.loads(data)
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
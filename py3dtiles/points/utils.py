@@ -1,5 +1,7 @@
 from enum import Enum
 from io import StringIO
+import os
+import shutil
 from pathlib import Path, PurePath
 
 import numpy as np
@@ -9,16 +11,21 @@ class CommandType(Enum):
     READ_FILE = b'read_file'
     WRITE_PNTS = b'write_pnts'
     PROCESS_JOBS = b'process_jobs'
+    CONFIGURE = b'configure'
     SHUTDOWN = b'shutdown'
 
 
 class ResponseType(Enum):
+    REGISTER = b'register'
     IDLE = b'idle'
     HALTED = b'halted'
     READ = b'read'
     PROCESSED = b'processed'
     PNTS_WRITTEN = b'pnts_written'
     NEW_TASK = b'new_task'
+    TRACE = b'trace'
+    ERROR = b'error'
+    HEARTBEAT = b'heartbeat'
 
 
 def profile(func):
@@ -61,6 +68,108 @@ def name_to_filename(working_dir: str, nameb: bytes, suffix: str = '', split_len
     return str(full_path)
 
 
+def filename_to_name(filename: str, suffix: str = '') -> bytes:
+    """
+    The reverse of name_to_filename, with a filename relative to the working directory.
+    If the filename is '22226217/r5.pnts' with the suffix '.pnts', the result is '222262175'
+    """
+    path = PurePath(filename)
+    return (''.join(path.parts[:-1]) + path.name[1:len(path.name) - len(suffix)]).encode('ascii')
+
+
+class NodeNameSet:
+    """
+    A set of node names stored in a prefix tree, to find the names of a subtree
+    without going through all the names.
+    """
+
+    def __init__(self, names=()):
+        # each level is a dict {next char of the name: sub level}, the None key marks the names of the set
+        self.root = {}
+        self.size = 0
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, name):
+        level = self._find(name)
+        return level is not None and None in level
+
+    def __iter__(self):
+        return self.subtree(b'')
+
+    def _find(self, name):
+        level = self.root
+        for c in name:
+            level = level.get(c)
+            if level is None:
+                return None
+        return level
+
+    def add(self, name: bytes):
+        level = self.root
+        for c in name:
+            level = level.setdefault(c, {})
+        if None not in level:
+            level[None] = True
+            self.size += 1
+
+    def discard(self, name: bytes):
+        levels = [self.root]
+        for c in name:
+            level = levels[-1].get(c)
+            if level is None:
+                return
+            levels.append(level)
+        if None not in levels[-1]:
+            return
+
+        del levels[-1][None]
+        self.size -= 1
+        # remove the branch if it's empty now
+        for i in range(len(name) - 1, -1, -1):
+            if levels[i + 1]:
+                break
+            del levels[i][name[i]]
+
+    def clear(self):
+        self.root = {}
+        self.size = 0
+
+    def subtree(self, prefix: bytes, excluded=()):
+        """
+        Yield the names starting with prefix (prefix included).
+        The branches starting at a name present in one of the containers of excluded are skipped.
+
+        The set must not be modified during the iteration.
+        """
+        level = self._find(prefix)
+        if level is None:
+            return
+        stack = [(prefix, level)]
+        while stack:
+            name, level = stack.pop()
+            if any(name in e for e in excluded):
+                continue
+            for c, sub_level in level.items():
+                if c is None:
+                    yield name
+                else:
+                    stack.append((name + bytes((c,)), sub_level))
+
+
+def link_or_copy(src, dst):
+    """
+    Hard link src to dst, or copy it if the filesystem doesn't support links.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
 def compute_spacing(aabb):
     return float(np.linalg.norm(aabb[1] - aabb[0]) / 125)
 
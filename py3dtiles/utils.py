@@ -10,6 +10,10 @@ class SrsInMissingException(Exception):
     pass
 
 
+class JobFailedException(Exception):
+    pass
+
+
 def convert_to_ecef(x, y, z, epsg_input):
     inp = CRS('epsg:{0}'.format(epsg_input))
     outp = CRS('epsg:4978')  # ECEF
@@ -0,0 +1,24 @@
+import argparse
+
+from py3dtiles.convert import Worker, read_secret
+
+
+def init_parser(subparser, str2bool):
+
+    parser = subparser.add_parser(
+        'worker',
+        help='Start a worker joining a conversion started with "py3dtiles convert --bind tcp://...".',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--connect',
+        required=True,
+        help='The zmq endpoint of the conversion manager, e.g. tcp://192.168.1.10:5555')
+    parser.add_argument(
+        '--secret_file',
+        help='The file containing the secret of the conversion (see the --secret_file option of convert).')
+
+
+def main(args):
+    # the conversion parameters are sent by the manager once connected
+    secret = read_secret(args.secret_file) if args.secret_file is not None else None
+    Worker(args.connect, verbosity=args.verbose, secret=secret).run()
@@ -23,7 +23,12 @@ dev_requirements = (
     'pytest',
     'pytest-cov',
     'pytest-benchmark',
-    'line_profiler'
+    'line_profiler',
+    'lazrs',
+)
+
+laz_requirements = (
+    'lazrs',
 )
 
 doc_requirements = (
@@ -75,7 +80,8 @@ setup(
     test_suite="tests",
     extras_require={
         'dev': dev_requirements,
-        'doc': doc_requirements
+        'doc': doc_requirements,
+        'laz': laz_requirements,
     },
     entry_points={
         'console_scripts': ['py3dtiles=py3dtiles.command_line:main'],
@@ -1,10 +1,24 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import json
+import multiprocessing
 import os
+import pytest
 from pytest import approx, raises, fixture
 import shutil
+import signal
 
-from py3dtiles import convert_to_ecef
-from py3dtiles.convert import convert, SrsInMissingException
+import laspy
+import numpy as np
+import psutil
+
+import py3dtiles.convert
+from py3dtiles import convert_to_ecef, TileContentReader
+from py3dtiles.convert import convert, convert_async, is_ancestor_in_list, zmq_process, State, Worker, ZmqManager, \
+    SrsInMissingException
+from py3dtiles.points.progress import NodeProcessed, PntsWritten, PortionRead, Progress
+from py3dtiles.points.utils import ResponseType, name_to_filename
+from py3dtiles.utils import JobFailedException
 
 
 fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
@@ -60,6 +74,196 @@ def test_convert_with_srs(tmp_dir):
     assert os.path.exists(os.path.join(tmp_dir, 'r.pnts'))
 
 
+def test_convert_reprojection_max_error(tmp_dir):
+    convert('./tests/ripple.las', outfolder=tmp_dir, srs_in='2154', srs_out='4978', reprojection_max_error=0.001, jobs=1)
+    assert _count_points(tmp_dir) == 10201
+
+    with raises(ValueError):
+        convert('./tests/ripple.las', outfolder=tmp_dir, overwrite=True, srs_out='4978', reprojection_max_error=0)
+
+
+def test_convert_fraction(tmp_dir):
+    convert('./tests/ripple.las', outfolder=tmp_dir, fraction=10, decimation='voxel', jobs=1)
+    tileset = json.load(open(os.path.join(tmp_dir, 'tileset.json')))
+    point_count = sum(TileContentReader.read_file(os.path.join(tmp_dir, child['content']['uri']))
+                      .body.feature_table.header.points_length for child in tileset['root']['children'])
+    assert point_count == approx(1020, rel=0.1)
+
+    with raises(ValueError):
+        convert('./tests/ripple.las', outfolder=tmp_dir, overwrite=True, fraction=0)
+
+
+def test_convert_max_memory(tmp_dir):
+    # the memory is always exhausted, the jobs are sent one by one
+    convert('./tests/ripple.las', outfolder=tmp_dir, jobs=2, max_memory=1)
+    assert _count_points(tmp_dir) == 10201
+
+
+def test_convert_metrics(tmp_dir):
+    metrics_file = os.path.join(tmp_dir + '_metrics.jsonl')
+    try:
+        convert('./tests/ripple.las', outfolder=tmp_dir, jobs=2, metrics_file=metrics_file)
+        with open(metrics_file) as f:
+            lines = [json.loads(line) for line in f]
+    finally:
+        os.remove(metrics_file)
+
+    # the final state of the conversion is exported at the end
+    assert lines[-1]['points_total{state="written"}'] == 10201
+    assert lines[-1]['queue_size{queue="node_to_process"}'] == 0
+    assert lines[-1]['job_duration_seconds{stage="read"}']['count'] == 1
+
+
+def test_convert_trace(tmp_dir):
+    trace_file = os.path.join(tmp_dir + '_trace.json')
+    try:
+        convert('./tests/ripple.las', outfolder=tmp_dir, jobs=2, trace_file=trace_file)
+        with open(trace_file) as f:
+            events = json.load(f)['traceEvents']
+    finally:
+        os.remove(trace_file)
+
+    spans = [event for event in events if event['ph'] == 'X']
+    assert {span['cat'] for span in spans} == {'read', 'process', 'write', 'tileset'}
+    # a track by process: the manager and the 2 workers
+    assert len([event for event in events if event['name'] == 'process_name']) == 3
+    read_spans = [span for span in spans if span['cat'] == 'read']
+    assert sum(span['args']['point_count'] for span in read_spans) == 10201
+    root_spans = [span for span in spans if span['name'] == 'r' and span['cat'] == 'process']
+    assert root_spans and all(span['args']['point_count'] > 0 for span in root_spans)
+    written = [span for span in spans if span['cat'] == 'write']
+    assert sum(span['args']['point_count'] for span in written) == 10201
+
+
+def test_convert_progress_callback(tmp_dir):
+    events = []
+    convert('./tests/ripple.las', outfolder=tmp_dir, jobs=2, progress_callback=events.append)
+
+    assert sum(event.point_count for event in events if isinstance(event, PortionRead)) == 10201
+    assert [event.remaining_portions for event in events if isinstance(event, PortionRead)][-1] == 0
+    assert sum(event.point_count for event in events if isinstance(event, NodeProcessed)) == 10201
+    written = {event.name: event.point_count for event in events if isinstance(event, PntsWritten)}
+    assert sum(written.values()) == 10201
+    assert all(os.path.exists(name_to_filename(tmp_dir, name.encode('ascii'), '.pnts')) for name in written)
+    progress = [event for event in events if isinstance(event, Progress)]
+    assert progress[-1].percent == approx(100)
+    assert all(event.points_per_second >= 0 and event.eta >= 0 for event in progress)
+
+    # only the points kept by the decimation are reported
+    events = []
+    convert('./tests/ripple.las', outfolder=tmp_dir, overwrite=True, jobs=2, fraction=10, progress_callback=events.append)
+    read = sum(event.point_count for event in events if isinstance(event, PortionRead))
+    assert read == sum(event.point_count for event in events if isinstance(event, NodeProcessed))
+    assert read == approx(1020, rel=0.2)
+
+
+def test_convert_async(tmp_dir):
+    async def run():
+        return [event async for event in convert_async('./tests/ripple.las', outfolder=tmp_dir, jobs=2)]
+
+    events = asyncio.run(run())
+    assert any(isinstance(event, PntsWritten) for event in events)
+    assert [event for event in events if isinstance(event, Progress)][-1].percent == approx(100)
+    assert os.path.exists(os.path.join(tmp_dir, 'tileset.json'))
+
+    async def run_invalid_files():
+        files = ['./tests/ripple.las', os.path.join(fixtures_dir, 'simple.xyz')]
+        return [event async for event in convert_async(files, outfolder=tmp_dir, overwrite=True)]
+
+    # the exceptions of the conversion are raised by the generator
+    with raises(ValueError):
+        asyncio.run(run_invalid_files())
+
+
+def test_convert_in_process(tmp_dir, monkeypatch):
+    def no_worker_process(*args):
+        raise AssertionError('The small pointclouds must be converted in process')
+
+    monkeypatch.setattr(py3dtiles.convert, 'ZmqManager', no_worker_process)
+    # and without taking a share of the cpus of the host
+    monkeypatch.setattr(py3dtiles.convert, 'HostCpuBudget', no_worker_process)
+    # by default for the small pointclouds
+    convert('./tests/ripple.las', outfolder=tmp_dir)
+    tileset_path = os.path.join(tmp_dir, 'tileset.json')
+    with open(tileset_path) as f:
+        tileset = json.load(f)
+    assert tileset['root']['children']
+
+    convert(os.path.join(fixtures_dir, 'simple.xyz'), outfolder=tmp_dir, overwrite=True, jobs=0)
+    assert os.path.exists(tileset_path)
+
+
+def test_convert_failed_job(tmp_dir, monkeypatch):
+    run = py3dtiles.convert.las_reader.run
+    calls = []
+
+    def fail_once(filename, offset_scale, portion, queue, spool, *args, **kwargs):
+        calls.append(portion)
+        if len(calls) == 1:
+            # the points sent before the error must be discarded
+            queue.send_multipart([ResponseType.NEW_TASK.value, b''] + spool.dumps(
+                np.zeros((10, 3), dtype=np.float32), np.zeros((10, 3), dtype=np.uint8)), copy=False)
+            raise OSError('read error')
+        return run(filename, offset_scale, portion, queue, spool, *args, **kwargs)
+
+    monkeypatch.setattr(py3dtiles.convert.las_reader, 'run', fail_once)
+    convert('./tests/ripple.las', outfolder=tmp_dir, jobs=0)
+    assert len(calls) == 2
+    assert os.path.exists(os.path.join(tmp_dir, 'tileset.json'))
+
+    def always_fail(*args, **kwargs):
+        raise OSError('read error')
+
+    monkeypatch.setattr(py3dtiles.convert.las_reader, 'run', always_fail)
+    with raises(JobFailedException):
+        convert('./tests/ripple.las', outfolder=tmp_dir, overwrite=True, jobs=0)
+
+    # the workers are stopped when the conversion fails
+    with raises(JobFailedException):
+        convert('./tests/ripple.las', outfolder=tmp_dir, overwrite=True, jobs=2)
+    assert multiprocessing.active_children() == []
+
+
+def test_convert_failed_write_job(tmp_dir, monkeypatch):
+    points_to_pnts = py3dtiles.convert.pnts_writer.points_to_pnts
+    calls = []
+
+    def fail_after_first_file(*args, **kwargs):
+        result = points_to_pnts(*args, **kwargs)
+        calls.append(args[0])
+        if len(calls) == 1:
+            # the job fails after writing a .pnts file, which is written again by the retry
+            raise OSError('write error')
+        return result
+
+    monkeypatch.setattr(py3dtiles.convert.pnts_writer, 'points_to_pnts', fail_after_first_file)
+    convert('./tests/ripple.las', outfolder=tmp_dir, jobs=0)
+    assert calls.count(calls[0]) == 2
+    assert _count_points(tmp_dir) == 10201
+
+
+def test_convert_dead_worker(tmp_dir, monkeypatch):
+    run = py3dtiles.convert.node_process.run
+    marker = tmp_dir + '_killed'
+
+    def crash_once(*args):
+        # the workers are forked: the first one processing a node is killed
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            return run(*args)
+        os.kill(os.getpid(), signal.SIGKILL)
+
+    monkeypatch.setattr(py3dtiles.convert.node_process, 'run', crash_once)
+    try:
+        convert('./tests/ripple.las', outfolder=tmp_dir, jobs=2)
+        assert os.path.exists(marker)
+    finally:
+        if os.path.exists(marker):
+            os.remove(marker)
+    assert os.path.exists(os.path.join(tmp_dir, 'tileset.json'))
+
+
 def test_convert_simple_xyz(tmp_dir):
     convert(os.path.join(fixtures_dir, 'simple.xyz'),
             outfolder=tmp_dir,
@@ -68,3 +272,218 @@ def test_convert_simple_xyz(tmp_dir):
             jobs=1)
     assert os.path.exists(os.path.join(tmp_dir, 'tileset.json'))
     assert os.path.exists(os.path.join(tmp_dir, 'r.pnts'))
+
+
+def test_is_ancestor_in_list():
+    assert is_ancestor_in_list(b'1234', {b'12': None})
+    assert is_ancestor_in_list(b'1234', {b'1234'})
+    assert is_ancestor_in_list(b'1234', {b''})
+    assert not is_ancestor_in_list(b'1234', {b'13', b'12345', b'2'})
+    assert not is_ancestor_in_list(b'', {b'1'})
+
+
+def test_state_node_order():
+    state = State([], 1)
+    state.add_tasks_to_process(b'12', b'task', 10)
+    state.add_tasks_to_process(b'1', b'task', 5)
+    state.add_tasks_to_process(b'3', b'task', 2)
+    state.add_tasks_to_process(b'3', b'task', 4)
+    state.add_tasks_to_process(b'4', b'task', 3)
+
+    # the shallowest nodes first, then the nodes with the most points
+    assert state.pop_node_to_process() == (b'3', [b'task', b'task'], 6)
+    assert state.pop_node_to_process() == (b'1', [b'task'], 5)
+
+    # a node being processed isn't returned until its processing is finished
+    state.processing_nodes[b'1'] = (1, 5, 0)
+    state.add_tasks_to_process(b'1', b'task', 1)
+    assert state.pop_node_to_process() == (b'4', [b'task'], 3)
+    assert state.pop_node_to_process() == (b'12', [b'task'], 10)
+    assert state.pop_node_to_process() is None
+    state.set_node_processed(b'1')
+    assert state.pop_node_to_process() == (b'1', [b'task'], 1)
+    assert state.pop_node_to_process() is None
+    assert not state.node_to_process
+
+
+def test_state_pop_portion():
+    state = State([('a.xyz', (0, 300, 0)), ('a.las', (0, 250))], 1)
+    assert state.pop_portion(100) == ('a.las', (0, 100))
+    assert state.pop_portion(100) == ('a.las', (100, 200))
+    assert state.pop_portion(100) == ('a.las', (200, 250))
+    # the xyz portions can't be split
+    assert state.pop_portion(100) == ('a.xyz', (0, 300, 0))
+    assert not state.point_cloud_file_parts
+
+
+def test_state_pop_laz_portion():
+    # the LAZ portions are split at the start of a chunk
+    state = State([('b.laz', (0, 300)), ('a.laz', (0, 250))], 1, {'a.laz': 60, 'b.laz': [0, 40, 200]})
+    assert state.pop_portion(100) == ('a.laz', (0, 60))
+    assert state.pop_portion(130) == ('a.laz', (60, 180))
+    assert state.pop_portion(10) == ('a.laz', (180, 240))
+    assert state.pop_portion(100) == ('a.laz', (240, 250))
+    assert state.pop_portion(100) == ('b.laz', (0, 40))
+    assert state.pop_portion(100) == ('b.laz', (40, 200))
+    assert state.pop_portion(10) == ('b.laz', (200, 300))
+    assert not state.point_cloud_file_parts
+
+
+def test_convert_laz(tmp_path, monkeypatch):
+    pytest.importorskip('lazrs')
+    monkeypatch.delenv('RAYON_NUM_THREADS', raising=False)
+    las = laspy.read('./tests/ripple.las')
+    las.write(str(tmp_path / 'ripple.laz'))
+
+    # the same tiles as the las file (the points read in a different order may be in other tiles)
+    point_counts = {}
+    for extension in ('las', 'laz'):
+        folder = str(tmp_path / extension)
+        convert(str(tmp_path / 'ripple.laz') if extension == 'laz' else './tests/ripple.las', outfolder=folder, jobs=1)
+        point_counts[extension] = {
+            f: TileContentReader.read_file(os.path.join(folder, f)).body.feature_table.header.points_length
+            for f in os.listdir(folder) if f.endswith('.pnts')}
+    assert point_counts['laz'].keys() == point_counts['las'].keys()
+    assert sum(point_counts['laz'].values()) == sum(point_counts['las'].values())
+
+    # the thread pool of lazrs is sized in the worker processes only
+    convert(str(tmp_path / 'ripple.laz'), outfolder=str(tmp_path / 'in_process'), jobs=0)
+    assert 'RAYON_NUM_THREADS' not in os.environ
+
+
+def test_convert_tcp(tmp_dir):
+    convert(os.path.join(os.path.dirname(os.path.abspath(__file__)), './ripple.las'),
+            outfolder=tmp_dir,
+            jobs=2,
+            bind_uri='tcp://127.0.0.1:*',
+            secret='secret')
+    assert os.path.exists(os.path.join(tmp_dir, 'tileset.json'))
+    assert os.path.exists(os.path.join(tmp_dir, 'r0.pnts'))
+
+    # anyone able to connect to the endpoint could run code on the workers
+    with raises(ValueError, match='secret'):
+        convert('./tests/ripple.las', outfolder=tmp_dir, overwrite=True, bind_uri='tcp://127.0.0.1:*')
+
+
+def test_remote_worker_registration():
+    zmq_manager = ZmqManager(
+        0, (None, 'octree_metadata', 'folder', True, 0, False, False), 'tcp://127.0.0.1:*', b'secret')
+
+    # a worker without parameters, like the ones started with the worker command on other hosts
+    remote_worker = multiprocessing.Process(target=zmq_process, args=(zmq_manager.uri,), kwargs={'secret': b'secret'})
+    remote_worker.start()
+
+    try:
+        client_id, response = zmq_manager.socket.recv_multipart()
+        assert response == ResponseType.REGISTER.value
+        zmq_manager.register_client(client_id)
+        assert zmq_manager.number_of_jobs == 1
+
+        client_id, response = zmq_manager.socket.recv_multipart()
+        assert response == ResponseType.IDLE.value
+        zmq_manager.add_idle_client(client_id)
+        assert zmq_manager.are_all_processes_idle()
+
+        zmq_manager.kill_all_processes()
+        client_id, response = zmq_manager.socket.recv_multipart()
+        assert response == ResponseType.HALTED.value
+
+        remote_worker.join(10)
+        assert remote_worker.exitcode == 0
+    finally:
+        if remote_worker.is_alive():
+            remote_worker.terminate()
+        zmq_manager.destroy()
+
+
+def test_remote_worker_authentication():
+    zmq_manager = ZmqManager(
+        0, (None, 'octree_metadata', 'folder', True, 0, False, False), 'tcp://127.0.0.1:*', b'secret')
+    try:
+        for secret in (b'other secret', None):
+            with raises(PermissionError):
+                Worker(zmq_manager.uri, secret=secret).run()
+        # the workers rejected never reached the manager
+        assert not zmq_manager.socket.poll(0)
+    finally:
+        zmq_manager.destroy()
+
+
+def test_concurrent_converts(tmp_dir):
+    # each conversion must use its own endpoint
+    os.mkdir(tmp_dir)
+    conversions = [
+        multiprocessing.Process(
+            target=convert,
+            args=(os.path.join(os.path.dirname(os.path.abspath(__file__)), './ripple.las'),),
+            kwargs={'outfolder': os.path.join(tmp_dir, str(i)), 'jobs': 2})
+        for i in range(2)
+    ]
+    [c.start() for c in conversions]
+    [c.join() for c in conversions]
+
+    for i, c in enumerate(conversions):
+        assert c.exitcode == 0
+        assert os.path.exists(os.path.join(tmp_dir, str(i), 'tileset.json'))
+
+
+def _convert_until_fourth_checkpoint(filename, outfolder):
+    save_checkpoint = py3dtiles.convert.save_checkpoint
+    count = [0]
+
+    def save_checkpoint_and_crash(*args):
+        save_checkpoint(*args)
+        count[0] += 1
+        if count[0] == 4:
+            # like a node reboot, nothing is cleaned
+            for child in psutil.Process().children(recursive=True):
+                child.kill()
+            os._exit(1)
+
+    py3dtiles.convert.save_checkpoint = save_checkpoint_and_crash
+    convert(filename, outfolder=outfolder, jobs=2, checkpoint_interval=1e-6)
+
+
+def test_convert_resume(tmp_dir):
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), './ripple.las')
+    interrupted = multiprocessing.Process(target=_convert_until_fourth_checkpoint, args=(filename, tmp_dir))
+    interrupted.start()
+    interrupted.join()
+    assert interrupted.exitcode == 1
+    assert not os.path.exists(os.path.join(tmp_dir, 'tileset.json'))
+
+    # the point count of the tileset is checked at the end of the conversion
+    convert(filename, outfolder=tmp_dir, jobs=2, resume=True)
+    assert os.path.exists(os.path.join(tmp_dir, 'tileset.json'))
+    assert not os.path.exists(os.path.join(tmp_dir, 'checkpoints'))
+
+    # the conversion is finished, there is no checkpoint to resume anymore
+    with raises(SystemExit):
+        convert(filename, outfolder=tmp_dir, jobs=2, resume=True)
+
+
+def _count_points(folder):
+    count = 0
+    for root, _, files in os.walk(folder):
+        for filename in files:
+            # the root tile contains a sample of the points of its children
+            if filename.endswith('.pnts') and filename != 'r.pnts':
+                tile = TileContentReader.read_file(os.path.join(root, filename))
+                count += tile.body.feature_table.header.points_length
+    return count
+
+
+def test_convert_incremental(tmp_dir):
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), './ripple.las')
+    convert(filename, outfolder=tmp_dir, jobs=2, incremental=True)
+    assert os.path.exists(os.path.join(tmp_dir, 'octree'))
+    count = _count_points(tmp_dir)
+    assert count == 10201
+
+    convert(filename, outfolder=tmp_dir, jobs=2, incremental=True)
+    assert _count_points(tmp_dir) == 2 * count
+    assert not os.path.exists(os.path.join(tmp_dir, 'tmp'))
+
+    # the points must be in the bounding box of the tileset
+    with raises(ValueError):
+        convert(os.path.join(fixtures_dir, 'with_srs.las'), outfolder=tmp_dir, incremental=True)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from pytest import approx, raises
+
+from py3dtiles.plan import occupied_cells, plan
+
+
+def test_occupied_cells():
+    # 64 cells of size 1, evenly filled
+    xyz = np.random.default_rng(0).uniform(0, 4, (100000, 3))
+    assert occupied_cells(xyz, 1, len(xyz)) == 64
+    assert occupied_cells(xyz[:500], 1, len(xyz)) == approx(64, abs=2)
+    # one point by cell in the sample: the number of cells can't be estimated
+    assert occupied_cells(xyz[:500], 0.001, len(xyz)) is None
+
+
+def test_plan(tmp_path):
+    estimations = plan(['./tests/ripple.las'], jobs=1, header_cache_file=str(tmp_path / 'headers.json'))
+    assert (tmp_path / 'headers.json').exists()
+    assert estimations['point_count'] == 10201
+    assert estimations['jobs'] == 1
+    assert sum(estimations['points_by_depth']) == 10201
+    assert len(estimations['points_by_depth']) == estimations['octree_depth'] + 1
+    assert estimations['tile_count'] >= estimations['octree_depth'] + 1
+    assert estimations['calibration_points_per_second'] > 0
+    assert estimations['peak_memory_per_worker_MB'] > 0
+
+
+def test_plan_invalid_files(tmp_path):
+    with raises(ValueError):
+        plan(['./tests/ripple.las', './tests/fixtures/simple.xyz'])
+
+    unreadable = tmp_path / 'unreadable.las'
+    unreadable.write_bytes(b'not a las file')
+    with raises(ValueError, match='None of the files could be read'):
+        plan([str(unreadable)])
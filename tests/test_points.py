@@ -1,11 +1,27 @@
+import multiprocessing
+import os
+import pickle
+
+import laspy
 import pytest
 import numpy as np
-from numpy.testing import assert_array_equal
+import psutil
+from pyproj import CRS, Transformer
+from numpy.testing import assert_allclose, assert_array_equal
 
+from py3dtiles.points.coordinates import to_octree_coordinates
+from py3dtiles.points.decimation import decimate
+from py3dtiles.points.header_cache import HeaderCache, sidecar_path
+from py3dtiles.points.host_budget import HostCpuBudget
+from py3dtiles.points.job_sizing import JobSizing
+from py3dtiles.points.metrics import Metrics
 from py3dtiles.points.points_grid import Grid
+from py3dtiles.points.reprojection import GridTransformer
 from py3dtiles.points.node import Node
-from py3dtiles.points.utils import compute_spacing, name_to_filename
+from py3dtiles.points.spool import Spool, SpoolFiles, split_tasks, spool_filename, task_point_count
+from py3dtiles.points.utils import CommandType, compute_spacing, filename_to_name, name_to_filename, NodeNameSet
 from py3dtiles.points.distance import is_point_far_enough
+from py3dtiles.points.task import las_reader, xyz_reader
 
 # test point
 xyz = np.array([0.25, 0.25, 0.25], dtype=np.float32)
@@ -97,3 +113,396 @@ def test_long_name_to_filename_with_short_split():
     long_tile_name = '110542453782'.encode("ascii")
     filename = name_to_filename('work/', long_tile_name, split_len=2)
     assert filename == 'work/11/05/42/45/37/r82'
+
+
+def test_filename_to_name():
+    assert filename_to_name('r') == b''
+    assert filename_to_name('11054245/r3782.pnts', suffix='.pnts') == b'110542453782'
+    assert filename_to_name('11/05/42/45/37/r82') == b'110542453782'
+
+
+def test_node_name_set():
+    names = NodeNameSet([b'', b'1', b'12', b'123', b'17', b'2'])
+    assert len(names) == 6
+    assert b'12' in names
+    assert b'3' not in names
+    assert b'4567' not in names
+
+    assert sorted(names.subtree(b'1')) == [b'1', b'12', b'123', b'17']
+    assert sorted(names.subtree(b'12')) == [b'12', b'123']
+    assert sorted(names.subtree(b'5')) == []
+    # the branches starting at an excluded name are skipped
+    assert sorted(names.subtree(b'', ({b'12'}, {b'2': None}))) == [b'', b'1', b'17']
+
+    names.discard(b'123')
+    names.discard(b'123')
+    names.discard(b'4')
+    assert len(names) == 5
+    assert sorted(names) == [b'', b'1', b'12', b'17', b'2']
+    assert names._find(b'123') is None
+
+    names.clear()
+    assert len(names) == 0
+    assert list(names) == []
+
+
+def test_job_sizing_latency():
+    job_sizing = JobSizing(4, 100_000_000, 8 * 1024 ** 3, target_latency=1.0)
+    assert job_sizing.portion_size == 1_000_000
+
+    # 1M points processed per second
+    job_sizing.job_finished(CommandType.PROCESS_JOBS.value, 500_000, 0.5)
+    assert job_sizing.process_batch_size == 1_000_000
+    # but every worker should get a batch
+    assert job_sizing.batch_size(2_000_000) == 500_000
+    assert job_sizing.batch_size(0) == JobSizing.MIN_BATCH_SIZE
+
+    # slow reads, the portions become smaller
+    job_sizing.job_finished(CommandType.READ_FILE.value, 1_000_000, 50)
+    assert job_sizing.portion_size == JobSizing.MIN_PORTION_SIZE
+
+    # the portions are split for the small files
+    assert JobSizing(4, 1_000_000, 8 * 1024 ** 3).portion_size == 250_000
+
+
+def test_job_sizing_memory():
+    MB = 1024 * 1024
+    job_sizing = JobSizing(4, 100_000_000, 1000 * MB)
+    job_sizing.update_memory(200 * MB, 0)
+    assert job_sizing.base_memory == 200 * MB
+
+    # 100 bytes per point in progress
+    job_sizing.update_memory(200 * MB + 4_000_000 * 100, 4_000_000)
+    assert job_sizing.max_point_in_progress == (800 - 200) * MB // 100
+    assert job_sizing.peak_memory == 200 * MB + 4_000_000 * 100
+
+    assert not job_sizing.is_memory_exhausted()
+
+    # over the limit, the points in progress must decrease
+    job_sizing.update_memory(1100 * MB, 6_000_000)
+    assert job_sizing.is_memory_exhausted()
+    assert job_sizing.max_point_in_progress <= 3_000_000
+
+
+def test_spool(tmp_path):
+    xyz = np.random.random((100, 3)).astype(np.float32)
+    rgb = np.random.randint(0, 255, (100, 3), dtype=np.uint8)
+
+    spool = Spool(str(tmp_path))
+    first = spool.dumps(xyz[:10], rgb[:10])
+    second = spool.dumps(xyz[10:], rgb[10:])
+    filename = spool.close()
+    assert spool_filename(first) == spool_filename(second) == filename
+    assert spool.close() is None
+
+    loaded_xyz, loaded_rgb = spool.loads(second)
+    assert_array_equal(loaded_xyz, xyz[10:])
+    assert_array_equal(loaded_rgb, rgb[10:])
+    assert loaded_xyz.ctypes.data % 16 == 0
+    # the arrays can be modified without modifying the file
+    loaded_xyz[0] = 0
+    assert_array_equal(spool.loads(second)[0], xyz[10:])
+
+    # the points are sent inline to the workers without access to the spool
+    inline = spool.inline(first)
+    assert spool_filename(inline) is None
+    loaded_xyz, loaded_rgb = Spool().loads(inline)
+    assert_array_equal(loaded_xyz, xyz[:10])
+    assert_array_equal(loaded_rgb, rgb[:10])
+    loaded_xyz[0] = 0
+
+    assert task_point_count(first) == 10
+    assert task_point_count(inline) == 10
+    assert len(first) == 1
+    assert len(inline) == 3
+    # the tasks are sent one after the other in the PROCESS_JOBS messages
+    tasks, remaining = split_tasks(first + inline + second + [b'next node'], 3)
+    assert tasks == [first, inline, second]
+    assert remaining == [b'next node']
+
+
+def test_spool_version(tmp_path):
+    task = Spool().dumps(np.zeros((1, 3)), np.zeros((1, 3)))
+    # a task of another version
+    task[0] = bytes([2]) + task[0][1:]
+    with pytest.raises(ValueError):
+        Spool().loads(task)
+
+
+def test_spool_files(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool_files = SpoolFiles(str(tmp_path))
+    tasks = [spool.dumps(np.zeros((1, 3)), np.zeros((1, 3))) for _ in range(2)]
+    for task in tasks:
+        spool_files.add(task)
+
+    spool_files.process(b'1', tasks[:1])
+    spool_files.processed(b'1')
+    filename = spool.close()
+    spool_files.close(filename)
+    assert (tmp_path / filename).exists()
+
+    # removed when the job is finished and all the tasks are processed
+    spool_files.process(b'2', tasks[1:])
+    spool_files.processed(b'2')
+    assert not (tmp_path / filename).exists()
+    assert not spool_files.references
+
+
+def test_metrics_prometheus(tmp_path):
+    filename = str(tmp_path / 'metrics.prom')
+    metrics = Metrics(filename)
+    metrics.set_gauge('queue_size', 3, queue='node_to_process')
+    metrics.set_counter('node_store_requests_total', 10, result='hit')
+    metrics.observe('job_duration_seconds', 0.2, stage='read')
+    metrics.observe('job_duration_seconds', 20, stage='read')
+    assert metrics.should_export()
+    metrics.export()
+    assert not metrics.should_export()
+
+    with open(filename) as f:
+        lines = f.read().split('\n')
+    assert '# TYPE py3dtiles_queue_size gauge' in lines
+    assert 'py3dtiles_queue_size{queue="node_to_process"} 3' in lines
+    assert 'py3dtiles_node_store_requests_total{result="hit"} 10' in lines
+    assert '# TYPE py3dtiles_job_duration_seconds histogram' in lines
+    assert 'py3dtiles_job_duration_seconds_bucket{stage="read",le="0.1"} 0' in lines
+    assert 'py3dtiles_job_duration_seconds_bucket{stage="read",le="0.25"} 1' in lines
+    assert 'py3dtiles_job_duration_seconds_bucket{stage="read",le="+Inf"} 2' in lines
+    assert 'py3dtiles_job_duration_seconds_count{stage="read"} 2' in lines
+
+
+def test_host_cpu_budget(tmp_path):
+    first = HostCpuBudget(tmp_path, refresh_interval=0)
+    assert first.share() == multiprocessing.cpu_count()
+
+    second = HostCpuBudget(tmp_path, refresh_interval=0)
+    assert first.share() == max(1, multiprocessing.cpu_count() // 2)
+    assert second.share() == first.share()
+
+    second.release()
+    assert first.share() == multiprocessing.cpu_count()
+
+
+def test_host_cpu_budget_ignore_dead_runs(tmp_path):
+    process = multiprocessing.Process(target=HostCpuBudget, args=(tmp_path,))
+    process.start()
+    process.join()
+
+    budget = HostCpuBudget(tmp_path, refresh_interval=0)
+    assert budget.count_runs() == 1
+
+
+def test_host_cpu_budget_reused_pid(tmp_path):
+    budget = HostCpuBudget(tmp_path, refresh_interval=0)
+    # a conversion killed without unregistering, whose pid is now used by another process
+    (tmp_path / f'{os.getpid()}-killed').write_text(repr(psutil.Process().create_time() - 100))
+    assert budget.count_runs() == 1
+    assert not (tmp_path / f'{os.getpid()}-killed').exists()
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason='the permissions are only checked on posix')
+def test_host_cpu_budget_folder_permissions(tmp_path):
+    budget = HostCpuBudget(tmp_path / 'runs')
+    assert (tmp_path / 'runs').stat().st_mode & 0o777 == 0o700
+    budget.release()
+
+    shared = tmp_path / 'shared'
+    shared.mkdir(mode=0o777)
+    shared.chmod(0o777)
+    with pytest.raises(PermissionError):
+        HostCpuBudget(shared)
+
+    (tmp_path / 'link').symlink_to(tmp_path / 'runs')
+    with pytest.raises(PermissionError):
+        HostCpuBudget(tmp_path / 'link')
+
+
+def test_header_cache(tmp_path, monkeypatch):
+    las = tmp_path / 'ripple.las'
+    las.write_bytes(open('tests/ripple.las', 'rb').read())
+    cache_file = tmp_path / 'cache' / 'headers.json'
+
+    infos = las_reader.init([str(las)], header_cache=HeaderCache(str(cache_file)))
+    assert cache_file.exists()
+
+    def fail(filename):
+        raise AssertionError('the header should be read from the cache')
+    with monkeypatch.context() as m:
+        m.setattr(las_reader, '_scan_header', fail)
+        cached_infos = las_reader.init([str(las)], header_cache=HeaderCache(str(cache_file)))
+    assert cached_infos['point_count'] == infos['point_count']
+    assert_array_equal(cached_infos['aabb'], infos['aabb'])
+    assert cached_infos['color_scale'] == infos['color_scale']
+    assert cached_infos['portions'] == infos['portions']
+
+    # a modified file is read again
+    with las.open('ab') as f:
+        f.write(b'\0')
+    cache = HeaderCache(str(cache_file))
+    assert cache.get(str(las), 'las') is None
+
+    # the deleted files are removed from the cache
+    cache.set(str(las), 'las', {})
+    las.unlink()
+    cache.save()
+    assert HeaderCache(str(cache_file)).entries == {}
+
+
+def test_las_header_srs(monkeypatch):
+    def no_pdal(filename):
+        raise AssertionError('the srs should be read from the header')
+    monkeypatch.setattr(las_reader, '_pdal_srs', no_pdal)
+
+    infos = las_reader.init(['tests/fixtures/with_srs.las'], srs_out='4978')
+    assert CRS(infos['srs_in']).to_epsg() == 3857
+
+
+def test_header_sidecar(tmp_path, monkeypatch):
+    xyz_file = tmp_path / 'simple.xyz'
+    xyz_file.write_bytes(open('tests/fixtures/simple.xyz', 'rb').read())
+
+    infos = xyz_reader.init([str(xyz_file)], header_cache=HeaderCache(sidecar=True))
+    assert (tmp_path / 'simple.xyz.py3dtiles.json').exists()
+    assert sidecar_path(str(xyz_file)) == str(tmp_path / 'simple.xyz.py3dtiles.json')
+
+    # another conversion, with another header cache, reads the sidecar
+    def fail(filename, executor=None):
+        raise AssertionError('the file should not be scanned again')
+    cache = HeaderCache(str(tmp_path / 'headers.json'))
+    with monkeypatch.context() as m:
+        m.setattr(xyz_reader, '_scan_file', fail)
+        cached_infos = xyz_reader.init([str(xyz_file)], header_cache=cache)
+    assert cached_infos['portions'] == infos['portions']
+    assert_array_equal(cached_infos['aabb'], infos['aabb'])
+    # and stores its entries
+    assert HeaderCache(str(tmp_path / 'headers.json')).get(str(xyz_file), 'xyz') is not None
+
+    # a modified file is read again
+    with xyz_file.open('a') as f:
+        f.write('1 2 3\n')
+    assert HeaderCache().get(str(xyz_file), 'xyz') is None
+
+
+@pytest.mark.parametrize('mode', ['random', 'stride', 'voxel'])
+def test_decimate(mode):
+    xyz = np.random.default_rng(0).uniform(0, 10, (100_000, 3))
+    indices = decimate(xyz, 10, mode)
+    assert len(indices) == pytest.approx(10_000, rel=0.05)
+    assert np.all(np.diff(indices) > 0)
+    assert len(decimate(xyz, 100, mode)) == len(xyz)
+
+
+@pytest.mark.parametrize('mode', ['random', 'stride'])
+def test_decimate_chunks(mode):
+    # the same points are kept whatever the chunks the file is read by
+    xyz = np.random.default_rng(0).uniform(0, 10, (10_000, 3))
+    chunks = np.concatenate([decimate(xyz[:3001], 7, mode), 3001 + decimate(xyz[3001:], 7, mode, start=3001)])
+    assert_array_equal(chunks, decimate(xyz, 7, mode))
+
+
+def test_las_mapped_reader(tmp_path):
+    # the memory mapped points are the ones decoded by laspy
+    with laspy.open('tests/ripple.las') as f:
+        portion = (1000, 7000)
+        mapped = list(las_reader._read_mapped('tests/ripple.las', f.header, portion, 2500))
+        decoded = list(las_reader._read_laspy(f, portion, 2500))
+    assert [len(chunk[0]) for chunk in mapped] == [2500, 2500, 1000]
+    for mapped_chunk, decoded_chunk in zip(mapped, decoded):
+        for mapped_values, decoded_values in zip(mapped_chunk, decoded_chunk):
+            assert_array_equal(mapped_values, decoded_values)
+
+    # the records with extra bytes
+    las = laspy.read('tests/ripple.las')
+    las.add_extra_dim(laspy.ExtraBytesParams(name='extra', type=np.float64))
+    las.extra = np.arange(len(las.points), dtype=np.float64)
+    las.write(str(tmp_path / 'extra.las'))
+    with laspy.open(str(tmp_path / 'extra.las')) as f:
+        mapped = list(las_reader._read_mapped(str(tmp_path / 'extra.las'), f.header, (0, 10201), 10201))
+    for mapped_values, values in zip(mapped[0], (las.x, las.y, las.z, las.red, las.green, las.blue)):
+        assert_array_equal(mapped_values, values)
+
+
+@pytest.mark.parametrize('rotated', [False, True])
+def test_to_octree_coordinates(rotated):
+    rng = np.random.default_rng(0)
+    points = rng.uniform(600_000, 700_000, (1000, 4))
+    rotation = np.linalg.qr(rng.normal(size=(3, 3)))[0] if rotated else None
+    offset_scale = (np.array([-600_000., -650_000., -700_000.]), np.array([0.01, 0.02, 0.03]), rotation, None)
+    # the columns of points aren't contiguous
+    x, y, z = points[:, 0], points[:, 1], points[:, 2]
+
+    expected = (points[:, :3] + offset_scale[0]) * offset_scale[1]
+    if rotated:
+        expected = np.dot(expected, rotation)
+    coords = to_octree_coordinates(x, y, z, offset_scale)
+    assert coords.dtype == np.float32 and coords.flags['C_CONTIGUOUS']
+    # the products of the rotation may be summed in another order than by np.dot
+    assert_allclose(coords, expected.astype(np.float32), rtol=1e-6)
+
+
+def test_grid_transformer():
+    transformer = Transformer.from_crs('epsg:2154', 'epsg:4978')
+    rng = np.random.default_rng(0)
+    x, y, z = rng.uniform(650_000, 651_000, 20_000), rng.uniform(6_860_000, 6_861_000, 20_000), rng.uniform(0, 300, 20_000)
+    exact = np.array(transformer.transform(x, y, z))
+
+    grid_transformer = GridTransformer(transformer, 0.001)
+    approximated = np.array(grid_transformer.transform(x, y, z))
+    assert grid_transformer._grid is not None
+    assert np.max(np.linalg.norm(approximated - exact, axis=0)) <= 0.001
+    # the transformer is sent to the workers without its grid
+    assert pickle.loads(pickle.dumps(grid_transformer))._grid is None
+
+    # no grid is precise enough
+    grid_transformer = GridTransformer(transformer, 1e-9)
+    assert_array_equal(grid_transformer.transform(x, y, z), exact)
+    assert grid_transformer._grid is None
+
+
+def test_xyz_parse():
+    assert_array_equal(xyz_reader._parse(b'1 2 3\n4 5 6'), [[1, 2, 3] + [np.nan] * 4, [4, 5, 6] + [np.nan] * 4])
+    assert_array_equal(xyz_reader._parse(b'1 2 3 9 10 20 30'), [[1, 2, 3, 9, 10, 20, 30]])
+    assert_array_equal(xyz_reader._parse(b'1 2 3 10 20 30'), [[1, 2, 3, np.nan, 10, 20, 30]])
+    # the lines with different numbers of values are parsed one by one
+    assert_array_equal(xyz_reader._parse(b'1 2 3 9\n4 5 6'), [[1, 2, 3, 9] + [np.nan] * 3, [4, 5, 6] + [np.nan] * 4])
+    with pytest.raises(ValueError):
+        xyz_reader._parse(b'1 2 3\n4 x 6')
+
+
+def test_xyz_blocks(tmp_path, monkeypatch):
+    points = np.random.default_rng(0).uniform(0, 100, (5000, 3)).round(3)
+    filename = tmp_path / 'points.xyz'
+    np.savetxt(filename, np.hstack((points, np.full((len(points), 3), 7))), fmt='%.3f %.3f %.3f %d %d %d')
+    monkeypatch.setattr(xyz_reader, 'SCAN_BLOCK_SIZE', 10_000)
+    monkeypatch.setattr(xyz_reader, 'READ_BLOCK_SIZE', 3_000)
+    monkeypatch.setattr(xyz_reader, 'PORTION_POINT_COUNT', 1000)
+
+    bounds = xyz_reader._block_bounds(filename, 10_000)
+    assert bounds[0][0] == 0 and bounds[-1][1] == filename.stat().st_size
+    assert all(end == start for (_, end), (start, _) in zip(bounds, bounds[1:]))
+
+    infos = xyz_reader.init([str(filename)])
+    assert infos['point_count'] == len(points)
+    assert_array_equal(infos['aabb'], [points.min(axis=0), points.max(axis=0)])
+    portions = [p for _, p in infos['portions']]
+    assert len(portions) > 1 and portions[0][0] == 0 and portions[-1][1] == len(points)
+    assert all(p[1] - p[0] >= 1000 for p in portions[:-1])
+
+    class Queue:
+        xyz = []
+
+        def send_multipart(self, parts, copy=True):
+            if len(parts) > 1:
+                self.xyz.append(parts[2])
+
+    class Identity:
+        def dumps(self, xyz, rgb):
+            assert_array_equal(rgb, 7)
+            return [xyz, rgb]
+
+    queue = Queue()
+    for portion in portions:
+        xyz_reader.run(str(filename), ([0, 0, 0], [1, 1, 1], None), portion, queue, Identity(), None, 0)
+    assert len(queue.xyz) > len(portions)
+    assert_array_equal(np.concatenate(queue.xyz), points.astype(np.float32))